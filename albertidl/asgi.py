@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'albertidl.settings')
 
 application = get_asgi_application()
+
+# Servicios de inferencia (solo en procesos servidores, no en manage.py)
+from modelos.servicios import iniciar_servicios  # noqa: E402
+
+iniciar_servicios()
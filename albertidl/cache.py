@@ -0,0 +1,179 @@
+"""
+Caché de respuestas para los endpoints de catálogo (blogs y modelos).
+
+Cada respuesta se guarda bajo una clave que incluye la versión de su grupo
+("blogs", "modelos"). Los signals post_save/post_delete de los modelos de un
+grupo incrementan esa versión, así que las entradas viejas dejan de usarse sin
+tener que buscarlas y vencen solas por timeout. Funciona con los backends
+locmem y de archivos de Django; con locmem cada proceso tiene su propio caché
+y solo ve las invalidaciones hechas en ese mismo proceso.
+
+Solo se guardan respuestas JSON a requests anónimos: los que traen cookie de
+sesión o Authorization, la API navegable de DRF (HTML con el token CSRF) y
+las respuestas que ponen cookies pasan siempre por la vista. Como en el caché
+de Django, las cabeceras del request que nombra el Vary de la respuesta entran
+en la clave.
+"""
+import hashlib
+import threading
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.http import HttpResponse, HttpResponseNotModified
+
+CABECERAS = ('Content-Type', 'ETag', 'Last-Modified', 'X-Total-Count', 'Link', 'Vary')
+# DRF negocia el formato (JSON o la API navegable) según Accept
+VARY_INICIAL = ('Accept',)
+
+
+def _cache():
+    return caches[getattr(settings, 'RESPUESTAS_CACHE_ALIAS', 'default')]
+
+
+class EstadisticasCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grupos = {}
+
+    def registrar(self, grupo, hit):
+        with self._lock:
+            contadores = self._grupos.setdefault(grupo, {'hits': 0, 'misses': 0, 'invalidaciones': 0})
+            contadores['hits' if hit else 'misses'] += 1
+
+    def invalidacion(self, grupo):
+        with self._lock:
+            self._grupos.setdefault(grupo, {'hits': 0, 'misses': 0, 'invalidaciones': 0})['invalidaciones'] += 1
+
+    def resumen(self):
+        with self._lock:
+            resumen = {}
+            for grupo, contadores in self._grupos.items():
+                consultas = contadores['hits'] + contadores['misses']
+                resumen[grupo] = dict(
+                    contadores, version=version(grupo), hit_rate=contadores['hits'] / consultas if consultas else 0.0,
+                )
+            return resumen
+
+
+estadisticas = EstadisticasCache()
+
+
+def version(grupo):
+    return _cache().get_or_set(f'respuestas:version:{grupo}', 1, timeout=None)
+
+
+def invalidar(grupo):
+    """Pasa el grupo a una versión nueva: todas sus respuestas cacheadas quedan obsoletas."""
+    clave = f'respuestas:version:{grupo}'
+    cache = _cache()
+    try:
+        cache.incr(clave)
+    except ValueError:
+        cache.set(clave, 2, timeout=None)
+    estadisticas.invalidacion(grupo)
+
+
+def registrar_invalidacion(modelo, *grupos):
+    """Invalida los `grupos` cada vez que se guarda o borra una instancia de `modelo`."""
+    def receptor(sender, **kwargs):
+        for grupo in grupos:
+            invalidar(grupo)
+
+    uid = f'respuestas:{modelo._meta.label}:{",".join(grupos)}'
+    post_save.connect(receptor, sender=modelo, weak=False, dispatch_uid=uid)
+    post_delete.connect(receptor, sender=modelo, weak=False, dispatch_uid=uid)
+
+
+def _url(request):
+    consulta = '&'.join(sorted(request.GET.urlencode().split('&')))
+    return hashlib.md5(f'{request.path}?{consulta}'.encode()).hexdigest()
+
+
+def _clave_vary(grupo, request):
+    return f'respuestas:{grupo}:vary:{_url(request)}'
+
+
+def _clave(grupo, request, vary):
+    valores = '|'.join(f'{cabecera}={request.headers.get(cabecera, "")}' for cabecera in vary)
+    firma = hashlib.md5(f'{_url(request)}|{valores}'.encode()).hexdigest()
+    return f'respuestas:{grupo}:{version(grupo)}:{firma}'
+
+
+def _vary(response):
+    """Cabeceras nombradas en el Vary de la respuesta (más Accept), o None con `Vary: *`."""
+    nombres = {c.strip().title() for c in response.get('Vary', '').split(',') if c.strip()}
+    if '*' in nombres:
+        return None
+    return tuple(sorted(nombres | set(VARY_INICIAL)))
+
+
+def _personalizado(request):
+    """El request trae sesión o credenciales: la respuesta puede depender del usuario."""
+    return 'HTTP_AUTHORIZATION' in request.META or settings.SESSION_COOKIE_NAME in request.COOKIES
+
+
+def _es_json(response):
+    tipo = response.get('Content-Type', '').split(';')[0].strip()
+    return tipo == 'application/json' or tipo.endswith('+json')
+
+
+def _servir(request, guardada):
+    etag = guardada['cabeceras'].get('ETag')
+    if etag and etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        if 'Vary' in guardada['cabeceras']:
+            response['Vary'] = guardada['cabeceras']['Vary']
+        return response
+    response = HttpResponse(guardada['contenido'], status=200)
+    for nombre, valor in guardada['cabeceras'].items():
+        response[nombre] = valor
+    return response
+
+
+def cachear_respuesta(grupo, timeout=None):
+    """
+    Decorador para vistas (funciones o `dispatch` de vistas de clase) que
+    cachea las respuestas JSON 200 a GET anónimos del `grupo`. Si la vista no
+    pone ETag se calcula uno sobre el contenido, así los hits también
+    responden 304.
+    """
+    def decorador(vista):
+        @wraps(vista)
+        def envuelta(request, *args, **kwargs):
+            if (
+                request.method != 'GET' or not getattr(settings, 'RESPUESTAS_CACHE', True)
+                or _personalizado(request)
+            ):
+                return vista(request, *args, **kwargs)
+
+            vary = _cache().get(_clave_vary(grupo, request), VARY_INICIAL)
+            clave = _clave(grupo, request, vary)
+            guardada = _cache().get(clave)
+            estadisticas.registrar(grupo, guardada is not None)
+            if guardada is not None:
+                return _servir(request, guardada)
+
+            response = vista(request, *args, **kwargs)
+            if response.status_code != 200 or getattr(response, 'streaming', False) or response.cookies:
+                return response
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+            vary_respuesta = _vary(response)
+            if not _es_json(response) or vary_respuesta is None:
+                return response
+            if vary_respuesta != vary:
+                _cache().set(_clave_vary(grupo, request), vary_respuesta, timeout=None)
+                clave = _clave(grupo, request, vary_respuesta)
+            if not response.has_header('ETag'):
+                response['ETag'] = '"%s"' % hashlib.md5(response.content).hexdigest()
+            guardada = {
+                'contenido': response.content,
+                'cabeceras': {nombre: response[nombre] for nombre in CABECERAS if response.has_header(nombre)},
+            }
+            _cache().set(clave, guardada, timeout or getattr(settings, 'RESPUESTAS_CACHE_TIMEOUT', 3600))
+            return response
+        return envuelta
+    return decorador
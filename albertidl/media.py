@@ -0,0 +1,179 @@
+"""
+Servido de MEDIA_ROOT (imágenes subidas y resultados) sin depender de DEBUG.
+
+Los archivos de MEDIA_ROOT se escriben una sola vez: las entradas se nombran
+por su sha256 y las salidas con un uuid, así que los nombres que llevan un hash
+(32 o más dígitos hexadecimales) se sirven con Cache-Control inmutable y el
+resto se revalida en cada uso. Se responden ETag/Last-Modified con 304,
+pedidos Range de un solo rango (206 y 416) y, si el cliente las acepta, las
+variantes `<archivo>.br` / `<archivo>.gz` generadas con
+`manage.py comprimir_media`. Con nginx delante conviene que sirva MEDIA_ROOT
+directamente con las mismas cabeceras y poner MEDIA_SERVIR = False.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+NOMBRE_INMUTABLE = re.compile(r"[0-9a-f]{32,}", re.IGNORECASE)
+RANGO = re.compile(r"^bytes=(\d*)-(\d*)$")
+# En orden de preferencia
+VARIANTES = (("br", ".br"), ("gzip", ".gz"))
+# Temporales de la ingesta y de publicar(), todavía incompletos
+SUFIJOS_OCULTOS = (".part", ".tmp")
+BLOQUE = 256 * 1024
+
+
+def cache_control(nombre):
+    if NOMBRE_INMUTABLE.search(os.path.basename(nombre)):
+        return f"public, max-age={getattr(settings, 'MEDIA_MAX_AGE', 365 * 24 * 3600)}, immutable"
+    return "public, no-cache"
+
+
+def codificaciones_aceptadas(cabecera):
+    aceptadas = set()
+    for parte in cabecera.split(","):
+        nombre, _, parametros = parte.partition(";")
+        clave, _, valor = parametros.partition("=")
+        try:
+            q = float(valor) if clave.strip() == "q" else 1.0
+        except ValueError:
+            q = 1.0
+        if q > 0:
+            aceptadas.add(nombre.strip().lower())
+    return aceptadas
+
+
+def _variante(ruta, original, request):
+    """(ruta, stat, codificación) de la variante precomprimida a servir, o del original."""
+    aceptadas = codificaciones_aceptadas(request.headers.get("Accept-Encoding", ""))
+    for codificacion, sufijo in VARIANTES:
+        if codificacion not in aceptadas:
+            continue
+        try:
+            st = os.stat(ruta + sufijo)
+        except OSError:
+            continue
+        # Una variante más vieja que el original quedó desactualizada
+        if st.st_mtime >= original.st_mtime:
+            return ruta + sufijo, st, codificacion
+    return ruta, original, None
+
+
+def _etag(st, codificacion):
+    sufijo = f"-{codificacion}" if codificacion else ""
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}{sufijo}"'
+
+
+def no_modificado(request, etag, mtime):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        etags = {valor.strip().removeprefix("W/") for valor in if_none_match.split(",")}
+        return "*" in etags or etag in etags
+    desde = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+    return desde is not None and int(mtime) <= desde
+
+
+def parsear_rango(cabecera, tamano):
+    """
+    (inicio, fin) inclusivos de un Range de un solo rango. None si el Range se
+    ignora (mal formado o con varios rangos: se responde el archivo entero) y
+    False si no se puede satisfacer (416).
+    """
+    m = RANGO.match(cabecera.strip())
+    if not m or m.groups() == ("", ""):
+        return None
+    inicio, fin = m.groups()
+    if inicio == "":
+        largo = int(fin)
+        if largo == 0 or tamano == 0:
+            return False
+        return max(0, tamano - largo), tamano - 1
+    inicio = int(inicio)
+    if fin != "" and int(fin) < inicio:
+        return None
+    if inicio >= tamano:
+        return False
+    return inicio, min(int(fin), tamano - 1) if fin != "" else tamano - 1
+
+
+def _if_range_vale(request, etag, mtime):
+    """If-Range: el Range solo se aplica si el archivo no cambió desde la copia del cliente."""
+    if_range = request.headers.get("If-Range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    fecha = parse_http_date_safe(if_range)
+    return fecha is not None and int(mtime) == fecha
+
+
+def _leer(ruta, inicio, largo):
+    with open(ruta, "rb") as f:
+        f.seek(inicio)
+        while largo > 0:
+            datos = f.read(min(BLOQUE, largo))
+            if not datos:
+                break
+            largo -= len(datos)
+            yield datos
+
+
+@require_safe
+def servir_media(request, ruta):
+    ruta = posixpath.normpath(ruta).lstrip("/")
+    completa = safe_join(settings.MEDIA_ROOT, ruta)
+    if completa.endswith(SUFIJOS_OCULTOS):
+        raise Http404("Archivo no encontrado")
+    try:
+        original = os.stat(completa)
+    except OSError:
+        raise Http404("Archivo no encontrado")
+    if not stat.S_ISREG(original.st_mode):
+        raise Http404("Archivo no encontrado")
+
+    # Los rangos se calculan sobre el archivo original, nunca sobre una variante
+    rango = request.headers.get("Range")
+    if rango is None:
+        servida, st, codificacion = _variante(completa, original, request)
+    else:
+        servida, st, codificacion = completa, original, None
+
+    etag = _etag(st, codificacion)
+    cabeceras = {
+        "ETag": etag,
+        "Last-Modified": http_date(st.st_mtime),
+        "Cache-Control": cache_control(completa),
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
+    }
+    if no_modificado(request, etag, st.st_mtime):
+        return HttpResponseNotModified(headers=cabeceras)
+
+    content_type = mimetypes.guess_type(completa)[0] or "application/octet-stream"
+    if rango is not None and _if_range_vale(request, etag, st.st_mtime):
+        tramo = parsear_rango(rango, st.st_size)
+        if tramo is False:
+            return HttpResponse(status=416, headers={**cabeceras, "Content-Range": f"bytes */{st.st_size}"})
+        if tramo is not None:
+            inicio, fin = tramo
+            response = StreamingHttpResponse(
+                _leer(servida, inicio, fin - inicio + 1), status=206, content_type=content_type, headers=cabeceras,
+            )
+            response["Content-Length"] = str(fin - inicio + 1)
+            response["Content-Range"] = f"bytes {inicio}-{fin}/{st.st_size}"
+            return response
+
+    response = FileResponse(open(servida, "rb"), content_type=content_type, filename=os.path.basename(completa))
+    for nombre, valor in cabeceras.items():
+        response[nombre] = valor
+    if codificacion:
+        response["Content-Encoding"] = codificacion
+    return response
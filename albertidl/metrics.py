@@ -0,0 +1,247 @@
+"""
+Métricas en formato de texto de Prometheus y cabeceras Server-Timing.
+
+Sin dependencias externas: contadores, medidores e histogramas simples en
+memoria del proceso, expuestos en `/metrics`. Los medidores pueden leer su
+valor de una función al momento de exponerlos (profundidad de la cola,
+aciertos del registro de modelos, etc.).
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.http import HttpResponse
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BUCKETS_BYTES = tuple(2 ** n * 1024 * 1024 for n in range(5, 15))  # 32 MB .. 16 GB
+
+_metricas = []
+
+
+def _etiquetas(nombres, valores):
+    if not nombres:
+        return ''
+    pares = ','.join(f'{n}="{str(v)}"' for n, v in zip(nombres, valores))
+    return '{' + pares + '}'
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+        _metricas.append(self)
+
+    def exponer(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {self.tipo}']
+        with self._lock:
+            valores = sorted(self._valores.items())
+        for clave, valor in valores:
+            lineas.append(f'{self.nombre}{_etiquetas(self.etiquetas, clave)} {valor}')
+        return lineas
+
+
+class Contador(_Metrica):
+    tipo = 'counter'
+
+    def inc(self, *etiquetas, valor=1):
+        with self._lock:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + valor
+
+    def valor(self, *etiquetas):
+        with self._lock:
+            return self._valores.get(etiquetas, 0)
+
+
+class Medidor(_Metrica):
+    """Gauge; con `funcion` el valor se lee al exponer (devuelve un número o {etiquetas: valor})."""
+    tipo = 'gauge'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None, tipo=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.funcion = funcion
+        if tipo:
+            self.tipo = tipo
+
+    def set(self, *etiquetas, valor):
+        with self._lock:
+            self._valores[etiquetas] = valor
+
+    def exponer(self):
+        if self.funcion is not None:
+            try:
+                valor = self.funcion()
+            except Exception:
+                valor = None
+            with self._lock:
+                if isinstance(valor, dict):
+                    self._valores = {tuple(k) if isinstance(k, tuple) else (k,): v for k, v in valor.items()}
+                elif valor is not None:
+                    self._valores = {(): valor}
+        return super().exponer()
+
+
+class Histograma(_Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(buckets)
+
+    def observar(self, valor, *etiquetas):
+        with self._lock:
+            datos = self._valores.get(etiquetas)
+            if datos is None:
+                datos = self._valores[etiquetas] = [[0] * len(self.buckets), 0.0, 0]
+            indice = bisect.bisect_left(self.buckets, valor)
+            if indice < len(self.buckets):
+                datos[0][indice] += 1
+            datos[1] += valor
+            datos[2] += 1
+
+    def exponer(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} histogram']
+        with self._lock:
+            valores = sorted((clave, ([*cuentas], suma, total)) for clave, (cuentas, suma, total) in self._valores.items())
+        nombres = self.etiquetas + ('le',)
+        for clave, (cuentas, suma, total) in valores:
+            acumulado = 0
+            for limite, cuenta in zip(self.buckets, cuentas):
+                acumulado += cuenta
+                lineas.append(f'{self.nombre}_bucket{_etiquetas(nombres, clave + (limite,))} {acumulado}')
+            lineas.append(f'{self.nombre}_bucket{_etiquetas(nombres, clave + ("+Inf",))} {total}')
+            lineas.append(f'{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {suma}')
+            lineas.append(f'{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {total}')
+        return lineas
+
+
+def exponer():
+    lineas = []
+    for metrica in _metricas:
+        lineas.extend(metrica.exponer())
+    return '\n'.join(lineas) + '\n'
+
+
+def metrics_view(request):
+    return HttpResponse(exponer(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# =========================
+# SERVER-TIMING
+# =========================
+_tiempos_peticion = contextvars.ContextVar('tiempos_peticion', default=None)
+
+peticiones_segundos = Histograma(
+    'http_peticion_segundos', 'Duración de las peticiones HTTP por vista', ('vista', 'metodo'),
+)
+
+
+@contextmanager
+def medir(etapa, histograma=None, *etiquetas):
+    """
+    Mide un bloque: lo agrega al Server-Timing de la petición en curso (si hay)
+    y, con `histograma`, lo observa con las `etiquetas` dadas.
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        tiempos = _tiempos_peticion.get()
+        if tiempos is not None:
+            tiempos.append((etapa, duracion))
+        if histograma is not None:
+            histograma.observar(duracion, *etiquetas)
+
+
+class ServerTimingMiddleware:
+    """
+    Agrega `Server-Timing` con el total, el tiempo en la base de datos y las
+    etapas medidas con `medir()`, y observa la duración por vista.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        tiempos = []
+        token = _tiempos_peticion.set(tiempos)
+        db = [0.0, 0]
+
+        def medir_sql(execute, sql, params, many, context):
+            inicio = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                db[0] += time.perf_counter() - inicio
+                db[1] += 1
+
+        inicio = time.perf_counter()
+        try:
+            with connection.execute_wrapper(medir_sql):
+                response = self.get_response(request)
+        finally:
+            _tiempos_peticion.reset(token)
+        total = time.perf_counter() - inicio
+
+        partes = [f'total;dur={total * 1000:.1f}', f'db;dur={db[0] * 1000:.1f};desc="{db[1]} consultas"']
+        partes += [f'{etapa};dur={duracion * 1000:.1f}' for etapa, duracion in tiempos]
+        response['Server-Timing'] = ', '.join(partes)
+
+        match = getattr(request, 'resolver_match', None)
+        vista = match.view_name if match is not None else 'sin_ruta'
+        peticiones_segundos.observar(total, vista, request.method)
+        return response
+
+
+# =========================
+# MEMORIA
+# =========================
+def rss_actual():
+    """RSS del proceso en bytes (Linux), o None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class PicoRSS:
+    """
+    Context manager que muestrea el RSS del proceso en un hilo mientras dura
+    el bloque y guarda el máximo en `pico`. Con varios trabajos en paralelo es
+    el pico del proceso durante el trabajo, no solo el de ese trabajo.
+    """
+
+    def __init__(self, intervalo=0.1):
+        self.intervalo = intervalo
+        self.pico = None
+        self._fin = threading.Event()
+
+    def _muestrear(self):
+        while True:
+            rss = rss_actual()
+            if rss is not None and (self.pico is None or rss > self.pico):
+                self.pico = rss
+            if self._fin.wait(self.intervalo):
+                return
+
+    def __enter__(self):
+        self._hilo = threading.Thread(target=self._muestrear, name='pico-rss', daemon=True)
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._fin.set()
+        self._hilo.join()
+        rss = rss_actual()
+        if rss is not None and (self.pico is None or rss > self.pico):
+            self.pico = rss
@@ -53,7 +53,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',  # debe ir primero
+    'albertidl.metrics.ServerTimingMiddleware',  # Server-Timing y duración por vista para /metrics
     'django.middleware.security.SecurityMiddleware',
+    'whitenoise.middleware.WhiteNoiseMiddleware',  # archivos estáticos, justo después de SecurityMiddleware
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -89,10 +91,25 @@ WSGI_APPLICATION = 'albertidl.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Los workers de predicción escriben mientras los requests leen e insertan:
+# - WAL: las lecturas no esperan a las escrituras (y viceversa)
+# - timeout: segundos que se espera el lock antes de "database is locked"
+# - IMMEDIATE: las transacciones toman el lock de escritura al empezar; si no,
+#   dos transacciones que leen y después escriben se bloquean entre sí y una
+#   falla enseguida sin esperar el timeout
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+        },
+        # La base de test es un archivo y no la de memoria compartida (que bloquea
+        # por tabla sin esperar el timeout): así los tests de concurrencia corren
+        # con WAL y las mismas opciones que producción
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
@@ -132,6 +149,23 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+# WhiteNoise sirve los estáticos desde STATIC_ROOT con las variantes .gz/.br
+# que genera `manage.py collectstatic` (correrlo al desplegar).
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+# Sin collectstatic el directorio no existe y WhiteNoise lo avisa en cada arranque
+STATIC_ROOT.mkdir(exist_ok=True)
+# Con True los estáticos llevan el hash en el nombre y se cachean para siempre,
+# pero con DEBUG = False toda plantilla que use {% static %} (la API navegable
+# de DRF, el admin) falla con ValueError si no se corrió collectstatic: activarlo
+# solo donde el despliegue lo corre siempre.
+STATIC_MANIFEST = False
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {
+        "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage" if STATIC_MANIFEST
+        else "whitenoise.storage.CompressedStaticFilesStorage",
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -146,6 +180,24 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # URL pública para acceder a los archivos subidos
 MEDIA_URL = '/media/'
 
+# Servido de MEDIA_ROOT por Django (albertidl/media.py), con o sin DEBUG.
+# False si un servidor web sirve MEDIA_URL directamente.
+MEDIA_SERVIR = True
+MEDIA_MAX_AGE = 365 * 24 * 3600  # Cache-Control de los archivos con hash en el nombre (inmutables)
+# Variantes .gz/.br de `manage.py comprimir_media`: solo estas extensiones y hasta este tamaño
+MEDIA_COMPRIMIR_EXTENSIONES = ("npy", "tif", "tiff", "bmp", "ppm", "json", "csv")
+MEDIA_COMPRIMIR_MAX_BYTES = 512 * 1024 * 1024
+
+# Retención de MEDIA_ROOT (modelos/retencion.py): las predicciones terminadas
+# que no se usan pasan a 'expired' y se borran sus archivos, las menos usadas
+# primero. Se aplica con `manage.py retencion_media` o con el barrido periódico.
+MEDIA_RETENCION_MAX_BYTES = None  # presupuesto total de MEDIA_ROOT, p.ej. 50 * 1024**3 (None = sin límite)
+MEDIA_RETENCION_MAX_DIAS = None  # días sin consultar una predicción antes de expirarla (None = sin límite)
+MEDIA_RETENCION_INTERVALO = None  # segundos entre barridos en el proceso web (None = solo con el comando)
+MEDIA_RETENCION_LOTE = 200  # predicciones por transacción
+MEDIA_RETENCION_MAX_SEGUNDOS = 5.0  # duración máxima de un barrido; el siguiente sigue donde quedó
+PREDICCION_ACCESOS_INTERVALO = 60.0  # segundos entre escrituras agrupadas de Prediccion.accessed_at
+
 
 CSRF_COOKIE_SAMESITE = 'Lax'
 
@@ -154,4 +206,137 @@ SESSION_COOKIE_SECURE = False
 CSRF_COOKIE_SECURE = False
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50 MB
-FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800
+# Los uploads grandes van a disco en lugar de quedar enteros en RAM
+# (las imágenes de predicción usan su propio handler, ver modelos/ingesta.py)
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5 MB
+
+# Patches por llamada al modelo en procesar_prediccion.
+# None = se elige automáticamente según la memoria libre.
+PREDICCION_BATCH_SIZE = None
+
+# Carpeta de los .h5 de IA_Model.model_file y de sus artefactos exportados
+MODELOS_DIR = os.path.join(BASE_DIR, 'capa_nitrurada', 'modelos')
+
+# Registro de modelos en memoria (modelos/registro.py)
+# Los límites son nominales: los bytes estiman solo los pesos y los modelos en
+# uso por un trabajo no se desalojan hasta que termina.
+MODELOS_REGISTRO_MAX_MODELOS = 2
+MODELOS_REGISTRO_MAX_BYTES = None  # p.ej. 2 * 1024**3
+MODELOS_REGISTRO_USAR_HASH = False  # evita recargar si cambia el mtime pero no el contenido
+MODELOS_REGISTRO_PRECARGA = False  # carga los modelos y corre una inferencia al arrancar
+
+# Pool de workers de predicción (modelos/trabajos.py)
+PREDICCION_WORKERS = 2
+PREDICCION_COLA_MAX = 16  # con la cola llena se responde 503 + Retry-After
+# Cada proceso renueva Prediccion.heartbeat_at de sus trabajos running; al
+# iniciar, se reencolan solo las running sin latido en 3 intervalos
+PREDICCION_LATIDO_SEGUNDOS = 30.0
+# Bytes de imágenes ya decodificadas que pueden esperar en la cola; pasado el
+# tope, los trabajos nuevos guardan solo la ruta y el worker decodifica el archivo
+PREDICCION_COLA_MAX_BYTES_IMAGENES = 512 * 1024 * 1024
+
+# "hilos": la inferencia corre en los hilos del proceso web.
+# "procesos": cada worker delega en su propio proceso (modelos/procesos.py),
+# con sus propios modelos en memoria; no usa el micro-batching entre trabajos.
+PREDICCION_BACKEND = "hilos"
+PREDICCION_PROCESOS_HILOS_INTRA = None  # hilos intra-op de TensorFlow/TFLite por proceso (None = todos)
+PREDICCION_PROCESOS_HILOS_INTER = None  # hilos inter-op de TensorFlow por proceso
+PREDICCION_PROCESOS_MAX_RSS = None  # bytes; el proceso se recicla al terminar un trabajo si los supera
+PREDICCION_PROCESOS_REINTENTOS = 1  # veces que se reencola un trabajo cuyo proceso se cayó
+
+# Micro-batching entre trabajos concurrentes del mismo modelo (modelos/motor.py)
+PREDICCION_MICROBATCH = True
+PREDICCION_MICROBATCH_MAX = 64  # patches por llamada; los lotes más grandes se parten entre llamadas
+PREDICCION_MICROBATCH_ESPERA_MS = 10  # espera máxima para juntar lotes de otros trabajos
+# Hijas de un lote que un worker corre a la vez para que el motor junte sus
+# patches en llamadas completas; cada una retiene su imagen decodificada
+PREDICCION_LOTE_PARALELAS = 4
+
+# Artefactos optimizados generados con `manage.py exportar_modelo`
+PREDICCION_USAR_OPTIMIZADO = True  # usar .tflite / SavedModel si existe y es más nuevo que el .h5
+PREDICCION_TFLITE_HILOS = None  # None = todos los núcleos
+
+# Guardar también el mapa de probabilidad crudo: None, "npz", "npy" o "png16"
+PREDICCION_FORMATO_MAPA = None
+PREDICCION_RENDER_MAX_LADO = 2048  # lado máximo de cada panel del PNG de salida (None = resolución completa)
+PREDICCION_PNG_COMPRESION = 6  # nivel zlib del PNG de salida (0-9): 1 es más rápido y deja archivos más grandes
+
+# Vista previa: las imágenes con lado mayor a 2x este valor pasan primero por el
+# modelo reducidas a ~este lado (sin solapamiento) y el resultado se publica en
+# Prediccion.preview_image antes de la pasada completa. None = sin vista previa.
+PREDICCION_VISTA_PREVIA = 1024
+
+# Caché de resultados por contenido (modelos/cache.py)
+PREDICCION_CACHE = True
+PREDICCION_CACHE_MAX_ENTRADAS = 1024
+PREDICCION_CACHE_MAX_EDAD = 7 * 24 * 3600  # segundos
+
+# Ingesta de uploads (modelos/ingesta.py)
+PREDICCION_MAX_UPLOAD_BYTES = 1024 * 1024 * 1024
+PREDICCION_MAX_PIXELES = 1_000_000_000
+
+# Lotes de predicción: POST /modelos/predict/<pk>/lote/ con varias imágenes o ZIPs
+# Un lote se acepta solo si todas sus imágenes sin resultado en caché entran juntas
+# en la cola (503 si no hay lugar, 413 si superan PREDICCION_COLA_MAX)
+PREDICCION_LOTE_MAX_IMAGENES = 16
+PREDICCION_LOTE_MAX_BYTES = 4 * 1024 * 1024 * 1024  # total descomprimido de los ZIPs
+
+# Ventana de fusión de patches solapados: "plana", "coseno" o "gauss"
+PREDICCION_VENTANA = "coseno"
+
+# Filtro de patches de fondo (FiltroPatches en capa_nitrurada/testing_model.py),
+# por model_file. Un patch con varianza, energía de bordes y rango de intensidad
+# (en [0, 1]) por debajo de los tres umbrales no pasa por el modelo y su
+# predicción se rellena con `relleno`. Calibrar con
+# `manage.py bench_inference --modelo <pk> --filtro`, p.ej.:
+# {"modelo_capa": {"varianza": 2e-4, "bordes": 0.01, "rango": 0.08, "relleno": 0.0}}
+PREDICCION_FILTRO_PATCHES = {}
+
+# Modo out-of-core (capa_nitrurada/bandas.py): las imágenes desde este tamaño se
+# leen por bandas de filas y el mapa se acumula en memmaps en disco, así la
+# memoria queda acotada por la altura de la banda y no por la imagen.
+PREDICCION_BANDAS_DESDE_PIXELES = 50_000_000  # None = nunca
+PREDICCION_BANDAS_FILAS = 4096  # filas de imagen por banda
+PREDICCION_BANDAS_DIR = None  # carpeta para los memmaps (None = temporal del sistema)
+# Solo el TIFF sin compresión o con Deflate se lee por partes; JPEG, PNG y TIFF
+# con LZW se decodifican enteros en memoria una vez. Por encima de este tamaño
+# se rechazan con 413 (None = sin límite)
+PREDICCION_BANDAS_MAX_PIXELES_DECODIFICADOS = 200_000_000
+
+# Avance de las predicciones (modelos/progreso.py): SSE en
+# /modelos/predicciones/<id>/eventos/ y long-poll en .../esperar/
+PREDICCION_PROGRESO_INTERVALO = 1.0  # segundos entre escrituras agrupadas del avance de todos los trabajos
+PREDICCION_EVENTOS_INTERVALO_DB = 2.0  # relectura de la base para trabajos de otros procesos
+PREDICCION_SSE_MAX_SEGUNDOS = 300  # el cliente reconecta con Last-Event-ID
+PREDICCION_LONGPOLL_MAX_SEGUNDOS = 30
+
+# Listado en bloque de predicciones, paginado por cursor
+PREDICCION_LISTADO_PAGINA = 100  # /modelos/predicciones/?page_size= permite hasta 500
+
+# API de blogs: tamaño de página si no se pasa ?limit= (None = todos, ?limit= acepta hasta 100)
+BLOGS_PAGINA = None
+
+# Caché de respuestas de blogs y modelos (albertidl/cache.py), invalidado por
+# signals. Con locmem cada proceso invalida solo su propio caché: con varios
+# workers usar el backend de archivos, p.ej.
+# {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": BASE_DIR / "cache"}
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    }
+}
+RESPUESTAS_CACHE = True
+RESPUESTAS_CACHE_ALIAS = "default"
+RESPUESTAS_CACHE_TIMEOUT = 3600  # segundos; la invalidación no depende de esto
+
+# Logs del pipeline de predicción (reemplazan a los print)
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "capa_nitrurada": {"handlers": ["console"], "level": "INFO", "propagate": False},
+        "modelos": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
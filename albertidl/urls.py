@@ -1,16 +1,24 @@
 
 from django.contrib import admin
-from django.urls import path, include
-from django.conf.urls.static import static
+import re
+
+from django.urls import path, include, re_path
 from django.conf import settings
 from . import views 
+from .media import servir_media
+from .metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('blogs/', include('blogs.urls')),
     path('modelos/', include('modelos.urls')),
     path("ping/", views.ping_view, name="ping"),
+    path("metrics", metrics_view, name="metrics"),
+    path("cache/stats/", views.cache_stats_view, name="cache_stats"),
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+# Imágenes subidas y resultados (albertidl/media.py), también sin DEBUG
+if getattr(settings, 'MEDIA_SERVIR', True):
+    urlpatterns += [
+        re_path(rf"^{re.escape(settings.MEDIA_URL.lstrip('/'))}(?P<ruta>.*)$", servir_media, name="media"),
+    ]
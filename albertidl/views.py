@@ -1,4 +1,11 @@
 from django.http import JsonResponse
 
+from .cache import estadisticas
+
 def ping_view(request):
     return JsonResponse({"message": "pong"})
+
+
+def cache_stats_view(request):
+    """Hits, misses, invalidaciones y versión de cada grupo del caché de respuestas."""
+    return JsonResponse(estadisticas.resumen())
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'albertidl.settings')
 
 application = get_wsgi_application()
+
+# Servicios de inferencia (solo en procesos servidores, no en manage.py)
+from modelos.servicios import iniciar_servicios  # noqa: E402
+
+iniciar_servicios()
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class BlogsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'blogs'
+
+    def ready(self):
+        from albertidl.cache import registrar_invalidacion
+        from .models import Author, Blog
+
+        registrar_invalidacion(Blog, 'blogs')
+        registrar_invalidacion(Author, 'blogs')
@@ -3,6 +3,7 @@ from django.db import models
 class Author(models.Model):
     name = models.CharField(max_length=100)
     image = models.URLField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)  # para ETag / Last-Modified del API de blogs
 
     def __str__(self):
         return self.name
@@ -17,6 +18,7 @@ class Blog(models.Model):
     read_time = models.CharField(max_length=20)
     image = models.URLField()
     is_featured = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.title} by {self.author}"
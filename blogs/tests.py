@@ -1,3 +1,124 @@
+import datetime
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from .models import Author, Blog
+
+
+class CacheBlogsTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.autor = Author.objects.create(name="Ana")
+        self.blog = Blog.objects.create(
+            title="Nitruración", category="metalurgia", date=datetime.date(2024, 1, 1),
+            read_time="5 min", image="https://example.com/a.png", author=self.autor,
+        )
+
+    def consultas(self, url, **cabeceras):
+        with CaptureQueriesContext(connection) as contexto:
+            response = self.client.get(url, **cabeceras)
+        return response, len(contexto.captured_queries)
+
+    def test_etag_responde_304(self):
+        response = self.client.get('/blogs/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        response = self.client.get('/blogs/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_segunda_consulta_sale_del_cache(self):
+        primera, _ = self.consultas('/blogs/')
+        segunda, consultas = self.consultas('/blogs/')
+        self.assertEqual(consultas, 0)
+        self.assertEqual(segunda.content, primera.content)
+        self.assertEqual(segunda['ETag'], primera['ETag'])
+        _, consultas = self.consultas('/blogs/', HTTP_IF_NONE_MATCH=primera['ETag'])
+        self.assertEqual(consultas, 0)
+
+    def test_guardar_invalida(self):
+        anterior = self.client.get('/blogs/')
+        self.blog.title = "Nitruración gaseosa"
+        self.blog.save()
+        response = self.client.get('/blogs/', HTTP_IF_NONE_MATCH=anterior['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], anterior['ETag'])
+        self.assertEqual(response.json()[0]['title'], "Nitruración gaseosa")
+
+    def test_requests_con_sesion_no_usan_el_cache(self):
+        self.client.get('/blogs/')
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = 'sesion'
+        _, consultas = self.consultas('/blogs/')
+        self.assertGreater(consultas, 0)
+        _, consultas = self.consultas('/blogs/', HTTP_AUTHORIZATION='Token abc')
+        self.assertGreater(consultas, 0)
+
+
+class ConsultasBlogsTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.blogs = [self.crear(i) for i in range(10)]
+
+    def crear(self, i):
+        autor = Author.objects.create(name=f"Autor {i}", image=f"https://example.com/{i}.png")
+        return Blog.objects.create(
+            title=f"Blog {i}", body="texto " * 100, category="metalurgia", date=datetime.date(2024, 1, 1),
+            read_time="5 min", image="https://example.com/a.png", author=autor, is_featured=i % 2 == 0,
+        )
+
+    def consultas(self, url):
+        caches['default'].clear()
+        with CaptureQueriesContext(connection) as contexto:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, [consulta['sql'] for consulta in contexto.captured_queries]
+
+    def test_sin_n_mas_1(self):
+        _, diez = self.consultas('/blogs/')
+        Blog.objects.exclude(id=self.blogs[0].id).delete()
+        _, uno = self.consultas('/blogs/')
+        # El aggregate del ETag y un SELECT con JOIN al autor
+        self.assertEqual(len(diez), 2)
+        self.assertEqual(len(uno), len(diez))
+        self.assertIn('JOIN', diez[1])
+        _, consultas = self.consultas('/blogs/popular/')
+        self.assertEqual(len(consultas), 2)
+
+    def test_solo_las_columnas_pedidas(self):
+        response, consultas = self.consultas('/blogs/?fields=id,title')
+        self.assertEqual(list(response.json()[0]), ['id', 'title'])
+        self.assertNotIn('"body"', consultas[1])
+        self.assertNotIn('JOIN', consultas[1])
+        response, consultas = self.consultas('/blogs/?fields=title,author')
+        self.assertEqual(response.json()[0], {'title': 'Blog 0', 'author': 'Autor 0'})
+        self.assertIn('JOIN', consultas[1])
+
+    def test_fields_invalido(self):
+        response = self.client.get('/blogs/?fields=id,clave')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(f'/blogs/{self.blogs[0].id}/?fields=otro').status_code, 400)
+
+    def test_limit_offset(self):
+        response, _ = self.consultas('/blogs/?limit=3&offset=3&fields=id')
+        self.assertEqual([fila['id'] for fila in response.json()], [blog.id for blog in self.blogs[3:6]])
+        self.assertEqual(response['X-Total-Count'], '10')
+        self.assertIn('offset=6', response['Link'].split(', ')[0])
+        self.assertIn('rel="next"', response['Link'])
+        self.assertIn('offset=0', response['Link'].split(', ')[1])
+        self.assertIn('rel="prev"', response['Link'])
+
+        response, _ = self.consultas('/blogs/?limit=3&offset=9&fields=id')
+        self.assertEqual(len(response.json()), 1)
+        self.assertNotIn('rel="next"', response['Link'])
+
+        response, _ = self.consultas('/blogs/?fields=id')
+        self.assertEqual(len(response.json()), 10)
+        self.assertFalse(response.has_header('Link'))
 
-# Create your tests here.
+    def test_limit_offset_invalidos(self):
+        for params in ('limit=a', 'offset=b', 'limit=0', 'offset=-1'):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(f'/blogs/?{params}').status_code, 400)
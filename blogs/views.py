@@ -1,38 +1,149 @@
-from django.shortcuts import render
-from django.http import JsonResponse
-from .models import Blog
+import hashlib
 
+from django.conf import settings
+from django.db.models import Count, Max
 from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from albertidl.cache import cachear_respuesta
 from .models import Blog
 
+# Campo serializado -> columnas que necesita (para no traer `body` si no se pide)
+CAMPOS = {
+    'id': ('id',),
+    'title': ('title',),
+    'description': ('description',),
+    'body': ('body',),
+    'author_image': ('author__image',),
+    'category': ('category',),
+    'date': ('date',),
+    'read_time': ('read_time',),
+    'image': ('image',),
+    'is_featured': ('is_featured',),
+    'author': ('author__name',),
+}
+
+LIMITE_MAXIMO = 100
+
+
+def serialize_blog(blog, campos=CAMPOS):
+    datos = {}
+    for campo in campos:
+        if campo == 'author':
+            datos[campo] = getattr(blog.author, 'name', None)
+        elif campo == 'author_image':
+            datos[campo] = getattr(blog.author, 'image', None)
+        else:
+            datos[campo] = getattr(blog, campo)
+    return datos
+
+
+def error(mensaje, status=400):
+    return JsonResponse({'error': mensaje}, status=status)
+
+
+def campos_pedidos(request):
+    """?fields=id,title,... ; None si algún campo no existe."""
+    fields = request.GET.get('fields')
+    if not fields:
+        return CAMPOS
+    campos = [campo.strip() for campo in fields.split(',') if campo.strip()]
+    if any(campo not in CAMPOS for campo in campos):
+        return None
+    return campos
+
+
+def consulta(campos, **filtros):
+    """Blogs con su autor en un solo JOIN, trayendo solo las columnas necesarias."""
+    columnas = {'id'} | {columna for campo in campos for columna in CAMPOS[campo]}
+    queryset = Blog.objects.filter(**filtros)
+    if any(columna.startswith('author__') for columna in columnas):
+        queryset = queryset.select_related('author')
+    return queryset.only(*columnas).order_by('id')
+
+
+def respuesta_condicional(request, queryset, datos_fn):
+    """
+    Responde 304 si el cliente ya tiene la versión actual. El ETag y el
+    Last-Modified salen de un único aggregate sobre los blogs y sus autores.
+    """
+    firma = queryset.order_by().aggregate(
+        total=Count('id'), blog=Max('updated_at'), autor=Max('author__updated_at'),
+    )
+    modificado = max(filter(None, (firma['blog'], firma['autor'])), default=None)
+    etag = '"%s"' % hashlib.md5(
+        repr((firma['total'], firma['blog'], firma['autor'], request.path, request.GET.urlencode())).encode()
+    ).hexdigest()
+    last_modified = int(modificado.timestamp()) if modificado else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = datos_fn(firma['total'])
+        if response.status_code != 200:
+            return response
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def lista_paginada(request, queryset, campos):
+    """
+    Lista paginada con ?limit= y ?offset=. Se mantiene la respuesta como array
+    JSON; el total va en X-Total-Count y las páginas vecinas en Link.
+    """
+    try:
+        limit = request.GET.get('limit')
+        limit = min(int(limit), LIMITE_MAXIMO) if limit else getattr(settings, 'BLOGS_PAGINA', None)
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        return error('limit y offset deben ser enteros')
+    if offset < 0 or (limit is not None and limit < 1):
+        return error('limit y offset fuera de rango')
+
+    def datos(total):
+        pagina = queryset[offset:offset + limit] if limit else queryset[offset:]
+        response = JsonResponse([serialize_blog(blog, campos) for blog in pagina], safe=False)
+        response['X-Total-Count'] = str(total)
+        if limit:
+            enlaces = []
+            url = request.build_absolute_uri(request.path)
+            otros = request.GET.copy()
+            otros['limit'] = limit
+            for rel, nuevo in (('next', offset + limit), ('prev', offset - limit)):
+                if 0 <= nuevo < total or (rel == 'prev' and offset > 0):
+                    otros['offset'] = max(nuevo, 0)
+                    enlaces.append(f'<{url}?{otros.urlencode()}>; rel="{rel}"')
+            if enlaces:
+                response['Link'] = ', '.join(enlaces)
+        return response
+
+    return respuesta_condicional(request, queryset, datos)
+
+
+@cachear_respuesta('blogs')
 def blog_list(request, pk=None):
-    def serialize_blog(blog):
-        return {
-            'id': blog.id,
-            'title': blog.title,
-            'description': blog.description,
-            'body': blog.body,
-            'author_image': getattr(blog.author, 'image', None),
-            'category': blog.category,
-            'date': blog.date,
-            'read_time': blog.read_time,
-            'image': blog.image,
-            'is_featured': blog.is_featured,
-            'author': getattr(blog.author, 'name', None)
-        }
+    campos = campos_pedidos(request)
+    if campos is None:
+        return error(f"fields inválido, valores posibles: {', '.join(CAMPOS)}")
 
     if pk:
-        try:
-            blog = Blog.objects.get(pk=pk)
-            return JsonResponse(serialize_blog(blog))
-        except Blog.DoesNotExist:
-            return JsonResponse({'error': 'Blog not found'}, status=404)
+        queryset = consulta(campos, pk=pk)
+
+        def datos(total):
+            blog = queryset.first()
+            if blog is None:
+                return JsonResponse({'error': 'Blog not found'}, status=404)
+            return JsonResponse(serialize_blog(blog, campos))
+
+        return respuesta_condicional(request, queryset, datos)
     else:
-        blogs = Blog.objects.all()
-        data = [serialize_blog(blog) for blog in blogs]
-        return JsonResponse(data, safe=False)
+        return lista_paginada(request, consulta(campos), campos)
 
 
+@cachear_respuesta('blogs')
 def featured_blog_list(request):
-    blogs = Blog.objects.filter(is_featured=True).values()
-    return JsonResponse(list(blogs), safe=False)
+    campos = campos_pedidos(request)
+    if campos is None:
+        return error(f"fields inválido, valores posibles: {', '.join(CAMPOS)}")
+    return lista_paginada(request, consulta(campos, is_featured=True), campos)
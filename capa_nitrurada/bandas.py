@@ -0,0 +1,222 @@
+"""
+Lectura por bandas de filas para micrografías que no entran en memoria.
+
+Los formatos sin compresión que Pillow guarda como un único bloque RGB crudo
+(TIFF sin compresión, PPM) se mapean directamente desde el archivo. Los TIFF
+en strips sin compresión o con Deflate se leen por trozos y se vuelcan a un
+caché crudo uint8 en disco, sin tener nunca la imagen entera en memoria. El
+resto (JPEG, PNG, TIFF con LZW o JPEG) Pillow solo lo decodifica entero: se
+decodifica una vez al caché y por eso modelos/ingesta.py los limita a
+PREDICCION_BANDAS_MAX_PIXELES_DECODIFICADOS.
+"""
+import os
+import tempfile
+import zlib
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+# Pillow rechaza imágenes de más de ~179 MP como posibles bombas de
+# descompresión; el límite propio se verifica en modelos/ingesta.py.
+Image.MAX_IMAGE_PIXELS = getattr(settings, "PREDICCION_MAX_PIXELES", 100_000_000)
+
+FILAS_POR_BLOQUE = 512  # filas que se convierten a la vez al crear el caché
+TROZO_BYTES = 1024 * 1024  # bytes que se leen (o descomprimen) a la vez de un TIFF en strips
+
+# Compresiones TIFF que se leen como flujo: ninguna y Deflate (zlib)
+COMPRESIONES_FLUJO = (1, 8, 32946)
+
+
+def requiere_bandas(path):
+    """True si la imagen supera PREDICCION_BANDAS_DESDE_PIXELES (solo lee el encabezado)."""
+    umbral = getattr(settings, "PREDICCION_BANDAS_DESDE_PIXELES", None)
+    if umbral is None:
+        return False
+    with Image.open(path) as img:
+        ancho, alto = img.size
+    return ancho * alto >= umbral
+
+
+def _desplazamiento_crudo(img):
+    """Offset de los píxeles si están guardados como un único bloque RGB crudo, o None."""
+    if img.mode != "RGB" or len(img.tile) != 1:
+        return None
+    decoder, extents, offset, args = img.tile[0]
+    if not isinstance(args, tuple):
+        args = (args,)
+    rawmode, stride, orientacion = (tuple(args) + (0, 1))[:3]
+    ancho, alto = img.size
+    if (
+        decoder != "raw" or rawmode != "RGB" or tuple(extents) != (0, 0, ancho, alto)
+        or stride not in (0, ancho * 3) or orientacion != 1
+    ):
+        return None
+    return offset
+
+
+def tiras_tiff(img):
+    """
+    (strips, compresión, muestras por píxel, predictor) de un TIFF en strips de
+    8 bits que se puede leer como flujo; None si hay que decodificarlo con Pillow.
+    """
+    if img.format != "TIFF":
+        return None
+    tags = img.tag_v2
+    bits = tags.get(258, 1)
+    bits = bits if isinstance(bits, tuple) else (bits,)
+    muestras = tags.get(277, 1)
+    fotometria = tags.get(262)
+    if (
+        tags.get(259, 1) not in COMPRESIONES_FLUJO or 273 not in tags or 279 not in tags
+        or set(bits) != {8} or tags.get(284, 1) != 1 or tags.get(317, 1) not in (1, 2)
+        or tags.get(274, 1) != 1
+        or not (fotometria == 1 and muestras in (1, 2) or fotometria == 2 and muestras in (3, 4))
+    ):
+        return None
+    offsets, tamanos = tags[273], tags[279]
+    offsets = offsets if isinstance(offsets, tuple) else (offsets,)
+    tamanos = tamanos if isinstance(tamanos, tuple) else (tamanos,)
+    return list(zip(offsets, tamanos)), tags.get(259, 1), muestras, tags.get(317, 1)
+
+
+def lectura_incremental(img):
+    """True si LectorBandas puede leer la imagen sin decodificarla entera."""
+    return _desplazamiento_crudo(img) is not None or tiras_tiff(img) is not None
+
+
+def _flujo_tiras(f, tiras, compresion):
+    """Bytes crudos de las filas, strip por strip, en trozos de a lo sumo TROZO_BYTES."""
+    for offset, tamano in tiras:
+        f.seek(offset)
+        descompresor = zlib.decompressobj() if compresion != 1 else None
+        while tamano > 0:
+            datos = f.read(min(TROZO_BYTES, tamano))
+            if not datos:
+                raise OSError("TIFF truncado")
+            tamano -= len(datos)
+            if descompresor is None:
+                yield datos
+                continue
+            while datos:
+                yield descompresor.decompress(datos, TROZO_BYTES)
+                datos = descompresor.unconsumed_tail
+        if descompresor is not None:
+            yield descompresor.flush()
+
+
+def agrupar_bandas(y_starts, patch_size, filas):
+    """
+    Agrupa los inicios de fila de los patches en bandas que ocupan como mucho
+    `filas` filas de la imagen (siempre al menos una fila de patches).
+    """
+    bandas, inicio = [], 0
+    for i in range(1, len(y_starts) + 1):
+        if i == len(y_starts) or y_starts[i] + patch_size - y_starts[inicio] > filas:
+            bandas.append(y_starts[inicio:i])
+            inicio = i
+    return bandas
+
+
+def extremos(mapa, filas=FILAS_POR_BLOQUE):
+    """(min, max) de un array o memmap 2D, recorriéndolo por bloques de filas."""
+    minimo, maximo = np.inf, -np.inf
+    for y in range(0, mapa.shape[0], filas):
+        bloque = mapa[y:y + filas]
+        minimo = min(minimo, bloque.min())
+        maximo = max(maximo, bloque.max())
+    return minimo, maximo
+
+
+class LectorBandas:
+    """
+    Imagen RGB uint8 (alto, ancho, 3) mapeada en memoria desde un archivo.
+    `pixeles` es un memmap de solo lectura: las bandas se cargan del disco a
+    medida que se acceden. Usar como context manager para borrar el caché.
+    """
+
+    def __init__(self, path, directorio=None):
+        self._cache = None
+        with Image.open(path) as img:
+            self.ancho, self.alto = img.size
+            self.pixeles = self._mapear(img, path)
+            if self.pixeles is None:
+                self.pixeles = self._crear_cache(img, path, directorio)
+
+    @property
+    def shape(self):
+        return (self.alto, self.ancho, 3)
+
+    def _mapear(self, img, path):
+        """Memmap directo sobre el archivo si los píxeles están guardados como RGB crudo."""
+        offset = _desplazamiento_crudo(img)
+        if offset is None:
+            return None
+        return np.memmap(path, dtype=np.uint8, mode="r", offset=offset, shape=self.shape)
+
+    def _crear_cache(self, img, path, directorio):
+        """
+        Vuelca los píxeles RGB a un archivo crudo. Los TIFF en strips se leen
+        por trozos; el resto se decodifica entero con Pillow y se convierte por
+        bloques de filas.
+        """
+        fd, self._cache = tempfile.mkstemp(suffix=".rgb", dir=directorio)
+        os.close(fd)
+        destino = np.memmap(self._cache, dtype=np.uint8, mode="w+", shape=self.shape)
+        tiras = tiras_tiff(img)
+        if tiras is not None:
+            self._copiar_tiras(path, destino, *tiras)
+        else:
+            img.load()
+            for y in range(0, self.alto, FILAS_POR_BLOQUE):
+                bloque = img.crop((0, y, self.ancho, min(y + FILAS_POR_BLOQUE, self.alto)))
+                destino[y:y + FILAS_POR_BLOQUE] = np.asarray(bloque.convert("RGB"))
+        destino.flush()
+        del destino
+        return np.memmap(self._cache, dtype=np.uint8, mode="r", shape=self.shape)
+
+    def _copiar_tiras(self, path, destino, tiras, compresion, muestras, predictor):
+        """Copia las filas completas a `destino` a medida que salen del flujo de strips."""
+        bytes_fila = self.ancho * muestras
+        pendiente = bytearray()
+        y = 0
+        with open(path, "rb") as f:
+            for trozo in _flujo_tiras(f, tiras, compresion):
+                pendiente += trozo
+                filas = min(len(pendiente) // bytes_fila, self.alto - y)
+                if not filas:
+                    continue
+                bloque = np.frombuffer(pendiente, dtype=np.uint8, count=filas * bytes_fila)
+                bloque = bloque.reshape(filas, self.ancho, muestras)
+                if predictor == 2:
+                    # Diferencia horizontal: cada muestra guarda la resta con la de su izquierda
+                    bloque = np.cumsum(bloque, axis=1, dtype=np.uint8)
+                destino[y:y + filas] = bloque[..., :3] if muestras >= 3 else bloque[..., :1]
+                del bloque
+                del pendiente[:filas * bytes_fila]
+                y += filas
+        if y < self.alto:
+            raise OSError(f"TIFF truncado: {y} de {self.alto} filas")
+
+    def leer(self, y0, y1):
+        """Filas [y0, y1) como vista sobre el memmap."""
+        return self.pixeles[y0:y1]
+
+    def submuestrear(self, paso):
+        """Copia en memoria de la imagen tomando una de cada `paso` filas y columnas."""
+        return np.ascontiguousarray(self.pixeles[::paso, ::paso])
+
+    def cerrar(self):
+        self.pixeles = None
+        if self._cache is not None:
+            try:
+                os.remove(self._cache)
+            except FileNotFoundError:
+                pass
+            self._cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
@@ -0,0 +1,44 @@
+"""
+Funciones de pérdida y métricas personalizadas con las que se entrenaron los
+modelos. Keras las necesita para deserializar los .h5; este es el único
+módulo de capa_nitrurada que importa TensorFlow, así que solo se carga cuando
+efectivamente se abre un modelo.
+"""
+import tensorflow as tf
+
+# =========================
+# FUNCIONES PERSONALIZADAS
+# =========================
+def dice_loss(y_true, y_pred, smooth=1e-6):
+    y_true_f = tf.keras.backend.flatten(y_true)
+    y_pred_f = tf.keras.backend.flatten(y_pred)
+    intersection = tf.keras.backend.sum(y_true_f * y_pred_f)
+    return 1 - (2. * intersection + smooth) / (
+        tf.keras.backend.sum(y_true_f) + tf.keras.backend.sum(y_pred_f) + smooth
+    )
+
+def focal_loss(y_true, y_pred, gamma=2., alpha=.25):
+    y_true = tf.keras.backend.flatten(y_true)
+    y_pred = tf.keras.backend.flatten(y_pred)
+    BCE = tf.keras.backend.binary_crossentropy(y_true, y_pred)
+    BCE_EXP = tf.keras.backend.exp(-BCE)
+    focal = alpha * tf.keras.backend.pow((1 - BCE_EXP), gamma) * BCE
+    return tf.keras.backend.mean(focal)
+
+def iou_metric(y_true, y_pred, smooth=1e-6):
+    y_pred = tf.cast(y_pred > 0.5, 'float32')
+    intersection = tf.keras.backend.sum(y_true * y_pred)
+    union = tf.keras.backend.sum(y_true) + tf.keras.backend.sum(y_pred) - intersection
+    return (intersection + smooth) / (union + smooth)
+
+def gradient_loss(y_true, y_pred):
+    dy_true, dx_true = tf.image.image_gradients(y_true)
+    dy_pred, dx_pred = tf.image.image_gradients(y_pred)
+    grad_diff = tf.abs(dy_true - dy_pred) + tf.abs(dx_true - dx_pred)
+    return tf.reduce_mean(grad_diff)
+
+def shape_aware_loss(y_true, y_pred, lambda_shape=0.9):
+    dice = dice_loss(y_true, y_pred)
+    focal = focal_loss(y_true, y_pred)
+    shape_term = gradient_loss(y_true, y_pred)
+    return dice + focal + lambda_shape * shape_term
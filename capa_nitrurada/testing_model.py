@@ -1,168 +1,660 @@
+import logging
 import os
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.utils import load_img, img_to_array
-import matplotlib.pyplot as plt
-from matplotlib.patches import Patch
+from PIL import Image
 from django.conf import settings
 import uuid
 
+from capa_nitrurada.bandas import LectorBandas, agrupar_bandas, extremos, requiere_bandas
+
+logger = logging.getLogger(__name__)
+
 # =========================
 # FUNCIONES AUXILIARES
 # =========================
+def calcular_inicios(longitud, patch_size, stride):
+    """Posiciones de inicio de los patches sobre un eje, incluyendo el borde final."""
+    inicios = np.arange(0, longitud - patch_size + 1, stride)
+    if inicios.size > 0 and inicios[-1] + patch_size < longitud:
+        inicios = np.append(inicios, longitud - patch_size)
+    return inicios.astype(int)
+
+def coordenadas_relativas(inicios, longitud, patch_size):
+    """
+    Tabla (n_inicios, patch_size) con la coordenada relativa de cada píxel.
+    Reproduce exactamente np.linspace(y/h, (y+patch_size)/h, patch_size, endpoint=False)
+    para todos los inicios a la vez.
+    """
+    inicio = inicios / longitud
+    paso = ((inicios + patch_size) / longitud - inicio) / patch_size
+    return np.arange(patch_size)[np.newaxis, :] * paso[:, np.newaxis] + inicio[:, np.newaxis]
+
+def iterar_lotes_patches(img, patch_size=256, stride=None, batch_size=32):
+    """
+    Generador de lotes de patches con coordenadas relativas (5 canales totales).
+    Los patches se leen de ventanas deslizantes (vistas, sin copia) sobre la imagen
+    y solo se materializa un lote float32 de `batch_size` patches por vez.
+    Una imagen uint8 se normaliza a [0, 1] lote por lote.
+    Devuelve tuplas (lote, coords).
+    """
+    h, w, _ = img.shape
+    if stride is None:
+        stride = patch_size
+
+    y_starts = calcular_inicios(h, patch_size, stride)
+    x_starts = calcular_inicios(w, patch_size, stride)
+    return iterar_lotes_region(img, y_starts, x_starts, h, w, patch_size, batch_size)
+
+def iterar_lotes_region(img, y_starts, x_starts, alto, ancho, patch_size=256, batch_size=32, y0=0):
+    """
+    Como iterar_lotes_patches, pero sobre una banda de filas de una imagen más
+    grande: `img` empieza en la fila absoluta `y0`, `y_starts`/`x_starts` son
+    absolutos y las coordenadas relativas se calculan sobre `alto` x `ancho`.
+    """
+    c = img.shape[2]
+    if y_starts.size == 0 or x_starts.size == 0:
+        return
+
+    # Canales de coordenadas: una fila/columna por inicio, se expanden por broadcasting
+    coords_y = coordenadas_relativas(y_starts, alto, patch_size)
+    coords_x = coordenadas_relativas(x_starts, ancho, patch_size)
+
+    # (h-p+1, w-p+1, p, p, c): vista de todas las ventanas posibles
+    ventanas = np.lib.stride_tricks.sliding_window_view(
+        img, (patch_size, patch_size), axis=(0, 1)
+    ).transpose(0, 1, 3, 4, 2)
+
+    indices_y, indices_x = np.divmod(np.arange(y_starts.size * x_starts.size), x_starts.size)
+    for inicio in range(0, indices_y.size, batch_size):
+        iy = indices_y[inicio:inicio + batch_size]
+        ix = indices_x[inicio:inicio + batch_size]
+
+        lote = np.empty((iy.size, patch_size, patch_size, c + 2), dtype=np.float32)
+        for k, (y, x) in enumerate(zip(y_starts[iy], x_starts[ix])):
+            lote[k, ..., :c] = ventanas[y - y0, x]
+        if img.dtype == np.uint8:
+            # Normalización diferida: solo se convierte a [0, 1] el lote en curso
+            lote[..., :c] /= 255.0
+        lote[..., c] = coords_x[ix][:, np.newaxis, :]
+        lote[..., c + 1] = coords_y[iy][:, :, np.newaxis]
+
+        yield lote, list(zip(y_starts[iy].tolist(), x_starts[ix].tolist()))
+
 def generar_patches_img(img, patch_size=256, stride=None):
     """Genera patches con coordenadas relativas (5 canales totales)."""
-    h, w, _ = img.shape
+    h, w, c = img.shape
     if stride is None:
         stride = patch_size
+    total = calcular_inicios(h, patch_size, stride).size * calcular_inicios(w, patch_size, stride).size
+    for lote, coords in iterar_lotes_patches(img, patch_size, stride, batch_size=max(total, 1)):
+        return lote, coords
+    return np.zeros((0, patch_size, patch_size, c + 2), dtype=np.float32), []
+
+# Las operaciones sobre la imagen completa (conversiones, división final) se
+# hacen por bandas de filas para no crear temporales del tamaño de la imagen
+FILAS_POR_BANDA = 512
+
+# Memoria estimada por patch durante la inferencia: la entrada de 5 canales
+# multiplicada por un factor empírico que cubre las activaciones de la U-Net.
+FACTOR_ACTIVACIONES = 48
+BATCH_SIZE_MAXIMO = 64
+
+def memoria_disponible():
+    """Devuelve los bytes de memoria física libre, o None si no se pueden leer."""
+    try:
+        with open("/proc/meminfo") as f:
+            for linea in f:
+                if linea.startswith("MemAvailable:"):
+                    return int(linea.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def elegir_batch_size(patch_shape, fraccion=0.25, maximo=BATCH_SIZE_MAXIMO):
+    """Elige cuántos patches enviar por llamada según la memoria libre."""
+    libre = memoria_disponible()
+    if not libre:
+        return 8
+    bytes_por_patch = int(np.prod(patch_shape)) * 4 * FACTOR_ACTIVACIONES
+    return int(max(1, min(maximo, libre * fraccion // bytes_por_patch)))
+
+# =========================
+# RECONSTRUCCIÓN
+# =========================
+@lru_cache(maxsize=8)
+def ventana_fusion(patch_size, tipo="plana", minimo=1e-3):
+    """
+    Pesos (patch_size, patch_size) float32 para promediar patches solapados:
+    - "plana": promedio simple
+    - "coseno": Hann 2D, baja hacia los bordes y elimina las costuras
+    - "gauss": gaussiana centrada (sigma = 1/4 del patch)
+    El mínimo evita pesos nulos en los bordes de la imagen, que cubre un solo patch.
+    Se comparte entre todos los patches (solo lectura).
+    """
+    if tipo == "plana":
+        ventana = np.ones((patch_size, patch_size), dtype=np.float32)
+    else:
+        t = (np.arange(patch_size) + 0.5) / patch_size
+        if tipo == "coseno":
+            perfil = np.sin(np.pi * t) ** 2
+        elif tipo == "gauss":
+            perfil = np.exp(-0.5 * ((t - 0.5) / 0.25) ** 2)
+        else:
+            raise ValueError(f"Ventana desconocida: {tipo}")
+        ventana = np.maximum(np.outer(perfil, perfil), minimo).astype(np.float32)
+    ventana.setflags(write=False)
+    return ventana
+
+class AcumuladorMosaico:
+    """
+    Acumula predicciones de patches solapados en dos arrays float32 (suma
+    ponderada y peso) que se actualizan in-place. `suma` y `peso` pueden ser
+    arrays preasignados o memmaps, p.ej. de np.lib.format.open_memmap.
+    """
+
+    def __init__(self, h, w, patch_size, ventana="plana", suma=None, peso=None):
+        self.patch_size = patch_size
+        self.plana = ventana == "plana"
+        self.ventana = ventana_fusion(patch_size, ventana)
+        self.suma = np.zeros((h, w), dtype=np.float32) if suma is None else suma
+        self.peso = np.zeros((h, w), dtype=np.float32) if peso is None else peso
+        self._tmp = np.empty((patch_size, patch_size), dtype=np.float32)
+
+    def agregar(self, pred, y, x):
+        p = self.patch_size
+        if self.plana:
+            self.suma[y:y+p, x:x+p] += pred
+            self.peso[y:y+p, x:x+p] += 1
+        else:
+            np.multiply(pred, self.ventana, out=self._tmp)
+            self.suma[y:y+p, x:x+p] += self._tmp
+            self.peso[y:y+p, x:x+p] += self.ventana
+
+    def agregar_lote(self, preds, coords):
+        for (y, x), pred in zip(coords, preds):
+            self.agregar(pred, y, x)
+
+    def finalizar(self, out=None):
+        """
+        Divide la suma por el peso y recorta a [0, 1], por bandas de filas para
+        no crear temporales del tamaño de la imagen. Sin `out` se reutiliza el
+        array de la suma (sin copias); `out` puede ser un array o memmap.
+        """
+        if out is None:
+            out = self.suma
+        for y in range(0, self.suma.shape[0], FILAS_POR_BANDA):
+            banda = slice(y, y + FILAS_POR_BANDA)
+            peso, destino = self.peso[banda], out[banda]
+            sin_cobertura = peso == 0
+            np.divide(self.suma[banda], peso, out=destino, where=~sin_cobertura)
+            destino[sin_cobertura] = 0
+            np.clip(destino, 0, 1, out=destino)
+        return out
+
+def _sigmoide(y, centro, intensidad):
+    y -= centro
+    y *= -intensidad
+    np.exp(y, out=y)
+    y += 1
+    np.reciprocal(y, out=y)
+    return y
+
+def realce_asimetrico(x, centro=0.45, intensidad=10, out=None, extremos=None):
+    """
+    Realce asimétrico:
+    - Empuja valores intermedios hacia abajo
+    - Eleva los altos
+    Con `out=x` se calcula in-place. `extremos` = (min, max) de `x` permite
+    normalizar un recorte o una versión submuestreada igual que el mapa completo.
+    Un mapa constante (todo fondo, o sin patches) no tiene contraste: queda en 0.
+    """
+    y = np.clip(x, 0, 1, out=out)
+    _sigmoide(y, centro, intensidad)
+    if extremos is None:
+        minimo, maximo = (y.min(), y.max()) if y.size else (0.0, 0.0)
+    else:
+        minimo, maximo = _sigmoide(np.clip(np.array(extremos, dtype=y.dtype), 0, 1), centro, intensidad)
+    rango = maximo - minimo
+    if not np.isfinite(rango) or rango <= 0:
+        y.fill(0)
+        return y
+    y -= minimo
+    y /= rango
+    return y
+
+# =========================
+# RENDERIZADO
+# =========================
+# Colores del colormap "Reds" de matplotlib (ColorBrewer, 9 clases)
+REDS = ["fff5f0", "fee0d2", "fcbba1", "fc9272", "fb6a4a", "ef3b2c", "cb181d", "a50f15", "67000d"]
+
+def _crear_lut(colores, n=256):
+    """LUT (n, 3) uint8 interpolando linealmente los colores, como LinearSegmentedColormap."""
+    anclas = np.array([[int(c[i:i + 2], 16) for i in (0, 2, 4)] for c in colores]) / 255.0
+    x = np.linspace(0, 1, n)
+    xp = np.linspace(0, 1, len(colores))
+    lut = np.stack([np.interp(x, xp, anclas[:, k]) for k in range(3)], axis=1)
+    return np.rint(lut * 255).astype(np.uint8)
+
+LUT_REDS = _crear_lut(REDS)
+
+SEPARACION = 16       # columnas blancas entre paneles
+ANCHO_BARRA = 24      # barra de color a la derecha del mapa
+
+def aplicar_colormap(mapa, lut=LUT_REDS):
+    """
+    Convierte un mapa en [0, 1] a RGB uint8 indexando la LUT (vmin=0, vmax=1).
+    Como el colormap de matplotlib, tolera valores no finitos: NaN y -inf
+    toman el color de 0 e inf el de 1.
+    """
+    n = len(lut)
+    valores = np.nan_to_num(mapa, nan=0.0, posinf=1.0, neginf=0.0)
+    indices = np.minimum((np.clip(valores, 0, 1) * n).astype(np.intp), n - 1)
+    return lut[indices]
+
+def _a_uint8(img):
+    if img.dtype == np.uint8:
+        return img
+    return np.rint(np.clip(img, 0, 1) * 255).astype(np.uint8)
 
-    y_starts = np.arange(0, h - patch_size + 1, stride)
-    if y_starts.size > 0 and y_starts[-1] + patch_size < h:
-        y_starts = np.append(y_starts, h - patch_size)
-    y_starts = y_starts.astype(int)
-
-    x_starts = np.arange(0, w - patch_size + 1, stride)
-    if x_starts.size > 0 and x_starts[-1] + patch_size < w:
-        x_starts = np.append(x_starts, w - patch_size)
-    x_starts = x_starts.astype(int)
-
-    patches, coords = [], []
-    for y in y_starts:
-        for x in x_starts:
-            patch = img[y:y+patch_size, x:x+patch_size, :]
-            yy = np.linspace(y/h, (y+patch_size)/h, patch_size, endpoint=False)
-            xx = np.linspace(x/w, (x+patch_size)/w, patch_size, endpoint=False)
-            coord_y, coord_x = np.meshgrid(yy, xx, indexing="ij")
-            coord_x = coord_x[..., np.newaxis]
-            coord_y = coord_y[..., np.newaxis]
-            patch_with_coords = np.concatenate([patch, coord_x, coord_y], axis=-1)
-
-            patches.append(patch_with_coords)
-            coords.append((y, x))
-    return np.array(patches, dtype=np.float32), coords
+def paso_render(shape, max_lado=None):
+    """Paso entero de submuestreo para que ningún lado supere `max_lado`."""
+    if not max_lado:
+        return 1
+    return max(1, -(-max(shape[:2]) // max_lado))
+
+def renderizar_resultado(img, mapa, lut=LUT_REDS, max_lado=None):
+    """
+    Compone imagen original | mapa coloreado | barra de color en un único
+    array RGB uint8, listo para codificar con Pillow. Con `max_lado` se
+    submuestrea con un paso entero (vista, sin copia) para acotar el tamaño.
+    """
+    paso = paso_render(mapa.shape, max_lado)
+    if paso > 1:
+        img, mapa = img[::paso, ::paso], mapa[::paso, ::paso]
+    h, w = mapa.shape
+    ancho = 2 * w + 2 * SEPARACION + ANCHO_BARRA
+    salida = np.full((h, ancho, 3), 255, dtype=np.uint8)
+    inicio_mapa = w + SEPARACION
+    for y in range(0, h, FILAS_POR_BANDA):
+        banda = slice(y, y + FILAS_POR_BANDA)
+        salida[banda, :w] = _a_uint8(img[banda, :, :3])
+        salida[banda, inicio_mapa:inicio_mapa + w] = aplicar_colormap(mapa[banda], lut)
+
+    # Barra de color vertical: 1 arriba, 0 abajo
+    gradiente = np.linspace(1, 0, h)[:, np.newaxis]
+    salida[:, ancho - ANCHO_BARRA:] = aplicar_colormap(gradiente, lut)
+    return salida
+
+def guardar_png(rgb, path, compress_level=None):
+    """
+    Codifica con Pillow. El nivel de zlib sale de PREDICCION_PNG_COMPRESION:
+    6 (el de Pillow) da archivos chicos para servir y guardar; 1 codifica
+    varias veces más rápido a cambio de archivos más grandes.
+    """
+    if compress_level is None:
+        compress_level = getattr(settings, 'PREDICCION_PNG_COMPRESION', 6)
+    Image.fromarray(rgb).save(path, format="PNG", compress_level=compress_level)
+
+def guardar_mapa(mapa, path_base, formato):
+    """
+    Guarda el mapa de probabilidad crudo para que el cliente lo renderice:
+    - "npz": float32 comprimido (`mapa`)
+    - "npy": float32 sin comprimir, se puede abrir con np.load(mmap_mode="r")
+    - "png16": PNG en escala de grises de 16 bits (0..65535 = 0..1)
+    Devuelve la ruta del archivo. "npz" y "npy" se escriben por bloques, así
+    que `mapa` puede ser un memmap más grande que la memoria.
+    """
+    if formato == "npz":
+        path = path_base + ".npz"
+        np.savez_compressed(path, mapa=mapa.astype(np.float32, copy=False))
+    elif formato == "npy":
+        path = path_base + ".npy"
+        np.save(path, mapa.astype(np.float32, copy=False))
+    elif formato == "png16":
+        path = path_base + ".png"
+        valores = np.rint(np.clip(mapa, 0, 1) * 65535).astype(np.uint16)
+        Image.fromarray(valores).save(path, format="PNG")
+    else:
+        raise ValueError(f"Formato de mapa desconocido: {formato}")
+    return path
+
+def cargar_imagen(img_path):
+    """Imagen RGB uint8 (h, w, 3); se normaliza más tarde, lote por lote."""
+    with Image.open(img_path) as img:
+        return np.asarray(img.convert("RGB"))
 
 # =========================
-# FUNCIONES PERSONALIZADAS
+# FILTRO DE PATCHES VACÍOS
 # =========================
-def dice_loss(y_true, y_pred, smooth=1e-6):
-    y_true_f = tf.keras.backend.flatten(y_true)
-    y_pred_f = tf.keras.backend.flatten(y_pred)
-    intersection = tf.keras.backend.sum(y_true_f * y_pred_f)
-    return 1 - (2. * intersection + smooth) / (
-        tf.keras.backend.sum(y_true_f) + tf.keras.backend.sum(y_pred_f) + smooth
-    )
-
-def focal_loss(y_true, y_pred, gamma=2., alpha=.25):
-    y_true = tf.keras.backend.flatten(y_true)
-    y_pred = tf.keras.backend.flatten(y_pred)
-    BCE = tf.keras.backend.binary_crossentropy(y_true, y_pred)
-    BCE_EXP = tf.keras.backend.exp(-BCE)
-    focal = alpha * tf.keras.backend.pow((1 - BCE_EXP), gamma) * BCE
-    return tf.keras.backend.mean(focal)
-
-def iou_metric(y_true, y_pred, smooth=1e-6):
-    y_pred = tf.cast(y_pred > 0.5, 'float32')
-    intersection = tf.keras.backend.sum(y_true * y_pred)
-    union = tf.keras.backend.sum(y_true) + tf.keras.backend.sum(y_pred) - intersection
-    return (intersection + smooth) / (union + smooth)
-
-def gradient_loss(y_true, y_pred):
-    dy_true, dx_true = tf.image.image_gradients(y_true)
-    dy_pred, dx_pred = tf.image.image_gradients(y_pred)
-    grad_diff = tf.abs(dy_true - dy_pred) + tf.abs(dx_true - dx_pred)
-    return tf.reduce_mean(grad_diff)
-
-def shape_aware_loss(y_true, y_pred, lambda_shape=0.9):
-    dice = dice_loss(y_true, y_pred)
-    focal = focal_loss(y_true, y_pred)
-    shape_term = gradient_loss(y_true, y_pred)
-    return dice + focal + lambda_shape * shape_term
+class FiltroPatches:
+    """
+    Saltea el modelo en los patches de fondo (resina, sustrato uniforme).
+    Cada patch se puntúa sobre la intensidad de sus canales de imagen,
+    submuestreada x2: varianza, energía de bordes (gradiente absoluto medio) y
+    rango. Si las tres quedan por debajo de sus umbrales el patch no pasa por
+    el modelo y su predicción se rellena con `relleno`. `omitidos` cuenta los
+    patches salteados.
+    """
+
+    def __init__(self, varianza=0.0, bordes=0.0, rango=0.0, relleno=0.0):
+        self.varianza = varianza
+        self.bordes = bordes
+        self.rango = rango
+        self.relleno = relleno
+        self.omitidos = 0
+
+    @staticmethod
+    def puntuar(lote):
+        """(varianza, bordes, rango) de cada patch de un lote float32 en [0, 1]."""
+        gris = lote[:, ::2, ::2, :lote.shape[-1] - 2].mean(axis=-1)
+        bordes = (
+            np.abs(np.diff(gris, axis=1)).mean(axis=(1, 2)) + np.abs(np.diff(gris, axis=2)).mean(axis=(1, 2))
+        ) / 2
+        return gris.var(axis=(1, 2)), bordes, gris.max(axis=(1, 2)) - gris.min(axis=(1, 2))
+
+    def mantener(self, lote):
+        """Máscara booleana de los patches que sí pasan por el modelo."""
+        varianza, bordes, rango = self.puntuar(lote)
+        mantener = (varianza >= self.varianza) | (bordes >= self.bordes) | (rango >= self.rango)
+        self.omitidos += int(mantener.size - np.count_nonzero(mantener))
+        return mantener
+
+class PrediccionCancelada(Exception):
+    """`notificar` la lanza para cortar el pipeline de una predicción cancelada."""
+
+def _sin_notificar(evento, **datos):
+    pass
+
+@contextmanager
+def cronometrar(tiempos, etapa):
+    """Suma en tiempos[etapa] los segundos que tarda el bloque."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        tiempos[etapa] = tiempos.get(etapa, 0.0) + time.perf_counter() - inicio
+
+def predecir_lotes(model, lotes, acumulador, total, notificar=_sin_notificar, tiempos=None, filtro=None):
+    """
+    Pasa cada lote (lote, coords) por el modelo y lo agrega al acumulador,
+    avisando el avance. Suma en `tiempos` los segundos de cada etapa:
+    "patches" (armado de lotes), "inferencia" (model.predict) y "fusion".
+    Con un `filtro` (FiltroPatches) solo los patches que no son fondo pasan
+    por el modelo; el tiempo de puntuarlos se suma en "filtro".
+    """
+    if tiempos is None:
+        tiempos = {}
+    for etapa in ("patches", "inferencia", "fusion"):
+        tiempos.setdefault(etapa, 0.0)
+    hechos = 0
+    notificar("progreso", etapa="inferencia", hechos=0, total=total)
+    lotes = iter(lotes)
+    while True:
+        t0 = time.perf_counter()
+        siguiente = next(lotes, None)
+        t1 = time.perf_counter()
+        tiempos["patches"] += t1 - t0
+        if siguiente is None:
+            break
+        lote, coords = siguiente
+        if filtro is None:
+            preds = model.predict(lote, batch_size=len(lote), verbose=0)[..., 0]
+        else:
+            mantener = filtro.mantener(lote)
+            t_filtro = time.perf_counter()
+            tiempos["filtro"] = tiempos.get("filtro", 0.0) + t_filtro - t1
+            t1 = t_filtro
+            if mantener.all():
+                preds = model.predict(lote, batch_size=len(lote), verbose=0)[..., 0]
+            else:
+                preds = np.full(lote.shape[:3], filtro.relleno, dtype=np.float32)
+                if mantener.any():
+                    elegidos = lote[mantener]
+                    preds[mantener] = model.predict(elegidos, batch_size=len(elegidos), verbose=0)[..., 0]
+        t2 = time.perf_counter()
+        tiempos["inferencia"] += t2 - t1
+        acumulador.agregar_lote(preds, coords)
+        tiempos["fusion"] += time.perf_counter() - t2
+        hechos += len(lote)
+        notificar("progreso", etapa="inferencia", hechos=hechos, total=total)
+    return tiempos
+
+def predecir_por_bandas(lector, model, directorio, patch_size=256, stride=None, batch_size=32,
+                        ventana="plana", filas_banda=4096, notificar=_sin_notificar, tiempos=None, filtro=None):
+    """
+    Predicción out-of-core: recorre la imagen en bandas de como mucho
+    `filas_banda` filas, pasa por el modelo solo los patches de cada banda y
+    acumula en memmaps dentro de `directorio`. Los patches se agregan en el
+    mismo orden que en memoria, así que el resultado es el mismo.
+    Devuelve el mapa final como memmap float32 (alto, ancho); los tiempos por
+    etapa se suman en `tiempos` como en predecir_lotes.
+    """
+    h, w = lector.alto, lector.ancho
+    if stride is None:
+        stride = patch_size
+    if tiempos is None:
+        tiempos = {}
+    suma = np.lib.format.open_memmap(os.path.join(directorio, "suma.npy"), mode="w+", dtype=np.float32, shape=(h, w))
+    peso = np.lib.format.open_memmap(os.path.join(directorio, "peso.npy"), mode="w+", dtype=np.float32, shape=(h, w))
+    acumulador = AcumuladorMosaico(h, w, patch_size, ventana=ventana, suma=suma, peso=peso)
+
+    y_starts = calcular_inicios(h, patch_size, stride)
+    x_starts = calcular_inicios(w, patch_size, stride)
+
+    def lotes():
+        for ys in agrupar_bandas(y_starts, patch_size, max(filas_banda, patch_size)):
+            y0 = int(ys[0])
+            banda = lector.leer(y0, int(ys[-1]) + patch_size)
+            yield from iterar_lotes_region(banda, ys, x_starts, h, w, patch_size, batch_size, y0=y0)
+            # Bajar a disco las filas ya escritas para que no se acumulen en RAM
+            suma.flush()
+            peso.flush()
+
+    predecir_lotes(model, lotes(), acumulador, y_starts.size * x_starts.size, notificar, tiempos, filtro)
+
+    with cronometrar(tiempos, "fusion"):
+        mapa = acumulador.finalizar()
+        mapa.flush()
+    del acumulador, peso
+    os.remove(os.path.join(directorio, "peso.npy"))
+    return mapa
 
 # =========================
-# CARGAR MODELO
+# VISTA PREVIA
 # =========================
+def factor_vista_previa(alto, ancho, lado, patch_size=256):
+    """
+    Factor entero de reducción para que el lado mayor quede en unos `lado`
+    píxeles, sin que el menor baje de un patch. 1 = no vale la pena.
+    """
+    factor = min(-(-max(alto, ancho) // lado), min(alto, ancho) // patch_size)
+    return factor if factor >= 2 else 1
+
+def reducir(img, factor):
+    """Copia reducida `factor` veces (promedio por bloques si es uint8)."""
+    if img.dtype == np.uint8:
+        return np.asarray(Image.fromarray(img).reduce(factor))
+    return np.ascontiguousarray(img[::factor, ::factor])
+
+def predecir_vista_previa(img, model, patch_size=256, batch_size=32):
+    """Mapa realzado de una imagen reducida, con patches sin solapamiento."""
+    h, w = img.shape[:2]
+    acumulador = AcumuladorMosaico(h, w, patch_size)
+    total = calcular_inicios(h, patch_size, patch_size).size * calcular_inicios(w, patch_size, patch_size).size
+    predecir_lotes(model, iterar_lotes_patches(img, patch_size, patch_size, batch_size), acumulador, total)
+    mapa = acumulador.finalizar()
+    return realce_asimetrico(mapa, out=mapa)
+
+def sin_prediccion(total, filtro):
+    """
+    Ningún patch pasó por el modelo (imagen más chica que un patch, o todos
+    los patches eran fondo): el mapa es constante y se renderiza en blanco.
+    """
+    return total == 0 or (filtro is not None and filtro.omitidos >= total)
+
+def url_publica(request, nombre):
+    url = settings.MEDIA_URL + nombre
+    if request is not None:
+        url = request.build_absolute_uri(url)
+    return url
 
 # =========================
 # FUNCIÓN PRINCIPAL
 # =========================
-def procesar_prediccion(img_path, model, request, visualizar=False):
+def procesar_prediccion(img_path, model, request, visualizar=False, batch_size=None,
+                        formato_mapa=None, notificar=None, ventana="plana", bandas=None, filtro=None,
+                        vista_previa=None):
     """
     Ejecuta el pipeline completo:
-    - Carga imagen
+    - Carga imagen (`img_path` puede ser una ruta o un array RGB uint8 ya decodificado)
     - Genera patches
-    - Predice y reconstruye
+    - Predice por lotes de `batch_size` patches (None = según memoria libre)
+      y reconstruye promediando los solapamientos con la `ventana` de fusión
     - Aplica realce asimétrico (solo esa versión)
     - Guarda y devuelve la URL pública
+    - Si `formato_mapa` es "npz", "npy" o "png16", guarda también el mapa crudo
+      y avisa su URL con notificar("mapa", url=...)
+    - Avisa el avance con notificar("progreso", etapa=..., hechos=..., total=...),
+      con etapa "carga", "inferencia" (hechos/total en patches) o "guardado"
+    - Al terminar avisa notificar("tiempos", etapas={etapa: segundos}, patches=n,
+      omitidos=m) con las etapas carga, patches, inferencia, fusion, render y
+      guardado (y filtro si se usó)
+    - `filtro` (dict con los umbrales de FiltroPatches, o None) saltea el
+      modelo en los patches de fondo; `omitidos` es cuántos se saltearon
+    - Con `vista_previa` (lado en píxeles) las imágenes más grandes pasan
+      primero por el modelo reducidas, sin solapamiento, y la URL de ese
+      resultado se avisa con notificar("previa", url=...) antes de la pasada
+      a resolución completa
+    - `notificar` puede lanzar PrediccionCancelada para cortar el pipeline
+    Con `bandas` (None = automático si la imagen supera
+    PREDICCION_BANDAS_DESDE_PIXELES) una ruta se procesa out-of-core con
+    predecir_por_bandas y la memoria queda acotada por la altura de la banda.
     """
-    print(f"\n=== Iniciando predicción para: {img_path} ===")
-    img = img_to_array(load_img(img_path)) / 255.0
-
     patch_size = 256
     stride = patch_size // 2
-    patches, coords = generar_patches_img(img, patch_size=patch_size, stride=stride)
+    if notificar is None:
+        notificar = _sin_notificar
+    if filtro is not None:
+        filtro = FiltroPatches(**filtro)
+    notificar("progreso", etapa="carga")
 
-    full_h, full_w = img.shape[:2]
-    full_pred = np.zeros((full_h, full_w))
-    count = np.zeros((full_h, full_w))
+    tiempos = {}
+    if isinstance(img_path, np.ndarray):
+        bandas = False
+        logger.info("Iniciando predicción para imagen de %dx%d", img_path.shape[1], img_path.shape[0])
+    else:
+        logger.info("Iniciando predicción para: %s", img_path)
+        if bandas is None:
+            bandas = requiere_bandas(img_path)
 
-    for coord, patch in zip(coords, patches):
-        y, x = coord
-        pred = model.predict(patch[np.newaxis, ...], verbose=0)[0, ..., 0]
-        full_pred[y:y+patch_size, x:x+patch_size] += pred
-        count[y:y+patch_size, x:x+patch_size] += 1
+    if batch_size is None:
+        batch_size = elegir_batch_size((patch_size, patch_size, 3 + 2))
 
-    full_pred = np.divide(full_pred, count, out=np.zeros_like(full_pred), where=count != 0)
-    full_pred = np.clip(full_pred, 0, 1)
+    base = f"output_image_realce_{uuid.uuid4().hex}"
+    nombre_unico = base + ".png"
+    output_path = os.path.join(settings.MEDIA_ROOT, nombre_unico)
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    render_max = getattr(settings, 'PREDICCION_RENDER_MAX_LADO', None)
 
-    # ==========================
-    # REALCE ASIMÉTRICO
-    # ==========================
-    def realce_asimetrico(x, centro=0.45, intensidad=10):
-        """
-        Realce asimétrico:
-        - Empuja valores intermedios hacia abajo
-        - Eleva los altos
-        """
-        x = np.clip(x, 0, 1)
-        y = 1 / (1 + np.exp(-intensidad * (x - centro)))
-        y = (y - y.min()) / (y.max() - y.min())
-        return y
+    def publicar_vista_previa(alto, ancho, leer_reducida):
+        factor = factor_vista_previa(alto, ancho, vista_previa, patch_size) if vista_previa else 1
+        if factor == 1:
+            return
+        notificar("progreso", etapa="previa")
+        with cronometrar(tiempos, "previa"):
+            reducida = leer_reducida(factor)
+            mapa = predecir_vista_previa(reducida, model, patch_size, batch_size)
+            guardar_png(renderizar_resultado(reducida, mapa, max_lado=render_max),
+                        os.path.join(settings.MEDIA_ROOT, base + "_previa.png"))
+        notificar("previa", url=url_publica(request, base + "_previa.png"))
+
+    def guardar_mapa_crudo(mapa):
+        with cronometrar(tiempos, "guardado"):
+            mapa_path = guardar_mapa(mapa, os.path.join(settings.MEDIA_ROOT, base + "_mapa"), formato_mapa)
+        notificar("mapa", url=url_publica(request, os.path.basename(mapa_path)))
+
+    if bandas:
+        directorio = getattr(settings, 'PREDICCION_BANDAS_DIR', None)
+        with tempfile.TemporaryDirectory(prefix="bandas-", dir=directorio) as tmp:
+            with cronometrar(tiempos, "carga"):
+                lector = LectorBandas(img_path, tmp)
+            with lector:
+                logger.info("Procesando %dx%d por bandas", lector.ancho, lector.alto)
+                publicar_vista_previa(lector.alto, lector.ancho, lector.submuestrear)
+                total = calcular_inicios(lector.alto, patch_size, stride).size * \
+                    calcular_inicios(lector.ancho, patch_size, stride).size
+                full_pred = predecir_por_bandas(
+                    lector, model, tmp, patch_size, stride, batch_size, ventana,
+                    filas_banda=getattr(settings, 'PREDICCION_BANDAS_FILAS', 4096), notificar=notificar,
+                    tiempos=tiempos, filtro=filtro,
+                )
+                notificar("progreso", etapa="guardado")
+                if formato_mapa:
+                    guardar_mapa_crudo(full_pred)
 
-    mapa = realce_asimetrico(full_pred)
+                # Solo se materializa la versión submuestreada que se renderiza;
+                # el realce se normaliza con los extremos del mapa completo
+                with cronometrar(tiempos, "render"):
+                    paso = paso_render(full_pred.shape, render_max)
+                    img = lector.submuestrear(paso)
+                    mapa = np.array(full_pred[::paso, ::paso])
+                    if sin_prediccion(total, filtro):
+                        mapa.fill(0)
+                    else:
+                        realce_asimetrico(mapa, out=mapa, extremos=extremos(full_pred))
+                del full_pred
+    else:
+        with cronometrar(tiempos, "carga"):
+            img = img_path if isinstance(img_path, np.ndarray) else cargar_imagen(img_path)
+        full_h, full_w, canales = img.shape
+        publicar_vista_previa(full_h, full_w, lambda factor: reducir(img, factor))
+        acumulador = AcumuladorMosaico(full_h, full_w, patch_size, ventana=ventana)
+
+        total = calcular_inicios(full_h, patch_size, stride).size * calcular_inicios(full_w, patch_size, stride).size
+        predecir_lotes(
+            model, iterar_lotes_patches(img, patch_size, stride, batch_size), acumulador, total, notificar, tiempos,
+            filtro,
+        )
+
+        notificar("progreso", etapa="guardado")
+        with cronometrar(tiempos, "fusion"):
+            full_pred = acumulador.finalizar()
+
+        # El mapa crudo se guarda antes de aplicar el realce in-place
+        if formato_mapa:
+            guardar_mapa_crudo(full_pred)
+
+        # ==========================
+        # REALCE ASIMÉTRICO
+        # ==========================
+        with cronometrar(tiempos, "render"):
+            if sin_prediccion(total, filtro):
+                full_pred.fill(0)
+                mapa = full_pred
+            else:
+                mapa = realce_asimetrico(full_pred, out=full_pred)
 
     # ==========================
     # GUARDAR RESULTADO
     # ==========================
-    nombre_unico = f"output_image_realce_{uuid.uuid4().hex}.png"
-    output_path = os.path.join(settings.MEDIA_ROOT, nombre_unico)
-    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    with cronometrar(tiempos, "render"):
+        rgb = renderizar_resultado(img, mapa, max_lado=render_max)
+    with cronometrar(tiempos, "guardado"):
+        guardar_png(rgb, output_path)
+    output_url = url_publica(request, nombre_unico)
 
-    plt.figure(figsize=(12, 5))
-    plt.subplot(1, 2, 1)
-    plt.imshow(img)
-    plt.title("Imagen Original")
-    plt.axis("off")
-
-    plt.subplot(1, 2, 2)
-    im = plt.imshow(mapa, cmap="Reds", vmin=0, vmax=1)
-    plt.title("Predicción (Realce Asimétrico)")
-    plt.axis("off")
-
-    cbar = plt.colorbar(im, fraction=0.046, pad=0.04)
-    cbar.set_label("Probabilidad de nitruro")
-
-    legend_elements = [
-        Patch(facecolor='white', edgecolor='black', label='Fondo'),
-        Patch(facecolor='red', edgecolor='black', label='Nitruro')
-    ]
-    plt.legend(handles=legend_elements, loc='lower right')
-
-    plt.tight_layout()
-    plt.savefig(output_path, dpi=150)
-    plt.close()
-
-    output_url = request.build_absolute_uri(settings.MEDIA_URL + nombre_unico)
-    print(f"✅ Imagen guardada en: {output_path}")
-    print(f"🌐 URL pública: {output_url}\n")
+    logger.info("Imagen guardada en %s (%s)", output_path, output_url)
+    omitidos = filtro.omitidos if filtro is not None else 0
+    if filtro is not None:
+        logger.info("Filtro de fondo: %d de %d patches omitidos", omitidos, total)
+    notificar("tiempos", etapas=tiempos, patches=total, omitidos=omitidos)
 
     return output_url
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import IA_Model, Prediccion
+from .models import IA_Model, LotePrediccion, Prediccion
 
 admin.site.register(IA_Model) 
-admin.site.register(Prediccion)
\ No newline at end of file
+admin.site.register(Prediccion)
+admin.site.register(LotePrediccion)
\ No newline at end of file
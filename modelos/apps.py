@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ModelosConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'modelos'
+
+    def ready(self):
+        from albertidl.cache import registrar_invalidacion
+        from blogs.models import Author
+        from .models import IA_Model
+
+        registrar_invalidacion(IA_Model, 'modelos')
+        # Borrar un Author pone en NULL IA_Model.author sin disparar signals de IA_Model
+        registrar_invalidacion(Author, 'modelos')
@@ -0,0 +1,55 @@
+"""
+Backends optimizados para servir los modelos exportados con `exportar_modelo`.
+
+Ambos exponen `predict(x, batch_size=None, verbose=0)` e `input_shape`, igual
+que un modelo Keras, así que el resto del pipeline no distingue el backend.
+"""
+import os
+import threading
+
+import numpy as np
+
+
+class ModeloTFLite:
+    """Intérprete TFLite (con el delegate XNNPACK por defecto en CPU)."""
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+
+        self.path = path
+        self._interprete = tf.lite.Interpreter(model_path=path, num_threads=num_threads or os.cpu_count())
+        self._entrada = self._interprete.get_input_details()[0]
+        self._salida = self._interprete.get_output_details()[0]
+        self._shape_actual = None
+        self._lock = threading.Lock()
+        self.input_shape = (None,) + tuple(int(d) for d in self._entrada["shape"][1:])
+
+    def count_params(self):
+        # El registro usa esto para estimar memoria; el archivo .tflite es una buena cota
+        return os.path.getsize(self.path) // 4
+
+    def predict(self, x, batch_size=None, verbose=0):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        with self._lock:
+            if self._shape_actual != x.shape:
+                self._interprete.resize_tensor_input(self._entrada["index"], x.shape)
+                self._interprete.allocate_tensors()
+                self._shape_actual = x.shape
+            self._interprete.set_tensor(self._entrada["index"], x)
+            self._interprete.invoke()
+            return self._interprete.get_tensor(self._salida["index"]).copy()
+
+
+class ModeloSavedModel:
+    """SavedModel exportado por Keras: un grafo `tf.function` con la firma `serve`."""
+
+    def __init__(self, path):
+        import tensorflow as tf
+
+        self.path = path
+        self._modelo = tf.saved_model.load(path)
+        spec = self._modelo.serve.input_signature[0]
+        self.input_shape = tuple(spec.shape.as_list())
+
+    def predict(self, x, batch_size=None, verbose=0):
+        return self._modelo.serve(np.asarray(x, dtype=np.float32)).numpy()
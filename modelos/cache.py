@@ -0,0 +1,134 @@
+"""
+Caché de resultados de predicción direccionado por contenido.
+
+La clave es el sha256 de la imagen subida más la versión del modelo servido
+(`registro.version_modelo`). Un hit devuelve una `Prediccion` ya terminada que
+apunta a los archivos existentes; si la misma imagen ya se está procesando, el
+pedido nuevo espera ese trabajo en lugar de lanzar otro.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Prediccion
+from .trabajos import ruta_media
+
+
+def _archivos_existen(pred):
+    urls = [pred.output_image, pred.output_map]
+    return all(os.path.exists(ruta_media(url)) for url in urls if url)
+
+
+class CacheResultados:
+    """
+    Índice LRU en memoria (clave -> id de Prediccion) acotado por cantidad de
+    entradas y por edad. Ante un miss en memoria se consulta la base, así el
+    caché sobrevive a reinicios.
+
+    `max_entradas` acota solo el índice: los resultados reutilizables de la
+    base los acota `max_edad`, contada desde la predicción que corrió el
+    modelo. Las copias que crea un hit (`copiar_de_cache`, sin `started_at`)
+    no son candidatas, así un resultado consultado seguido no rejuvenece y
+    sale del caché igual que los demás.
+    """
+
+    def __init__(self, max_entradas=1024, max_edad=7 * 24 * 3600):
+        self.max_entradas = max_entradas
+        self.max_edad = max_edad
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self._bloqueos = {}
+        self.hits = 0
+        self.misses = 0
+        self.deduplicadas = 0
+
+    def buscar(self, input_hash, model_version):
+        """Devuelve una Prediccion 'done' reutilizable o None."""
+        clave = (input_hash, model_version)
+        ahora = time.time()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and ahora - entrada[1] > self.max_edad:
+                del self._entradas[clave]
+                entrada = None
+
+        if entrada is not None:
+            pred = Prediccion.objects.filter(id=entrada[0], status='done').first()
+        else:
+            pred = (
+                Prediccion.objects.filter(
+                    input_hash=input_hash, model_version=model_version, status='done', started_at__isnull=False,
+                    created_at__gte=timezone.now() - timedelta(seconds=self.max_edad),
+                )
+                .order_by('-created_at').first()
+            )
+
+        if pred is None or not _archivos_existen(pred):
+            with self._lock:
+                self._entradas.pop(clave, None)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if clave not in self._entradas:
+                self._entradas[clave] = (pred.id, pred.created_at.timestamp())
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+        return pred
+
+    def en_curso(self, input_hash, model_version):
+        """Prediccion en cola o procesándose para la misma imagen y modelo, si hay."""
+        pred = (
+            Prediccion.objects.filter(
+                input_hash=input_hash, model_version=model_version, status__in=['queued', 'running'],
+            )
+            .order_by('created_at').first()
+        )
+        if pred is not None:
+            with self._lock:
+                self.deduplicadas += 1
+        return pred
+
+    @contextmanager
+    def bloqueo(self, input_hash, model_version):
+        """Serializa la búsqueda y creación de predicciones con la misma clave."""
+        clave = (input_hash, model_version)
+        with self._lock:
+            lock, usos = self._bloqueos.get(clave, (None, 0))
+            lock = lock or threading.Lock()
+            self._bloqueos[clave] = (lock, usos + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, usos = self._bloqueos[clave]
+                if usos == 1:
+                    del self._bloqueos[clave]
+                else:
+                    self._bloqueos[clave] = (lock, usos - 1)
+
+    def stats(self):
+        with self._lock:
+            consultas = self.hits + self.misses
+            return {
+                'entradas': len(self._entradas),
+                'hits': self.hits,
+                'misses': self.misses,
+                'deduplicadas': self.deduplicadas,
+                'hit_rate': self.hits / consultas if consultas else 0.0,
+            }
+
+
+cache_resultados = CacheResultados(
+    max_entradas=getattr(settings, 'PREDICCION_CACHE_MAX_ENTRADAS', 1024),
+    max_edad=getattr(settings, 'PREDICCION_CACHE_MAX_EDAD', 7 * 24 * 3600),
+)
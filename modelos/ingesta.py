@@ -0,0 +1,197 @@
+"""
+Ingesta de imágenes subidas para predicción.
+
+El upload se escribe por chunks directamente en `MEDIA_ROOT/entradas/`
+calculando su sha256 en la misma pasada (sin quedar entero en memoria) y se
+publica con un nombre direccionado por contenido, así dos uploads con el mismo
+nombre original nunca se pisan. La imagen se decodifica una sola vez a un array
+uint8 que se pasa directo al trabajo de inferencia, salvo las que superan
+`PREDICCION_BANDAS_DESDE_PIXELES`: esas se procesan por bandas desde el archivo.
+
+Los lotes (varias imágenes o un ZIP) pasan por el mismo camino: cada miembro
+del ZIP se extrae por chunks a su propio temporal, hasheándolo igual que un
+upload, y se corta si el total descomprimido supera el máximo del lote.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from PIL import Image
+
+from capa_nitrurada.bandas import lectura_incremental, requiere_bandas
+
+CARPETA_ENTRADAS = "entradas"
+
+EXTENSIONES = {"JPEG": ".jpg", "PNG": ".png", "TIFF": ".tif", "BMP": ".bmp", "WEBP": ".webp"}
+
+
+class ImagenInvalida(Exception):
+    def __init__(self, mensaje, status=400):
+        super().__init__(mensaje)
+        self.status = status
+
+
+def max_bytes():
+    return getattr(settings, "PREDICCION_MAX_UPLOAD_BYTES", 50 * 1024 * 1024)
+
+
+def max_pixeles():
+    return getattr(settings, "PREDICCION_MAX_PIXELES", 100_000_000)
+
+
+def max_pixeles_decodificados():
+    return getattr(settings, "PREDICCION_BANDAS_MAX_PIXELES_DECODIFICADOS", 200_000_000)
+
+
+def max_imagenes_lote():
+    return getattr(settings, "PREDICCION_LOTE_MAX_IMAGENES", 16)
+
+
+def max_bytes_lote():
+    return getattr(settings, "PREDICCION_LOTE_MAX_BYTES", 4 * 1024 * 1024 * 1024)
+
+
+def carpeta_entradas():
+    carpeta = os.path.join(settings.MEDIA_ROOT, CARPETA_ENTRADAS)
+    os.makedirs(carpeta, exist_ok=True)
+    return carpeta
+
+
+class ArchivoIngerido(UploadedFile):
+    """Upload ya escrito en un temporal dentro de MEDIA_ROOT, con su sha256."""
+
+    def __init__(self, file, name, content_type, size, charset, sha256):
+        super().__init__(file, name, content_type, size, charset)
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class IngestaUploadHandler(FileUploadHandler):
+    """
+    Upload handler que reemplaza a los de Django para la imagen de predicción:
+    hashea y escribe cada chunk y corta el upload si supera el máximo.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hash = hashlib.sha256()
+        self.tamano = 0
+        # Se borra solo al cerrarse; el archivo final se crea con un hard link
+        self.archivo = tempfile.NamedTemporaryFile(dir=carpeta_entradas(), suffix=".part")
+
+    def receive_data_chunk(self, raw_data, start):
+        self.tamano += len(raw_data)
+        if self.tamano > max_bytes():
+            self.archivo.close()
+            self.request.upload_excedido = True
+            raise SkipFile()
+        self.hash.update(raw_data)
+        self.archivo.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.archivo.flush()
+        self.archivo.seek(0)
+        return ArchivoIngerido(
+            self.archivo, self.file_name, self.content_type, file_size, self.charset, self.hash.hexdigest()
+        )
+
+
+def decodificar(path, pixeles=True):
+    """
+    Decodifica la imagen a un array RGB uint8 verificando su tamaño antes de
+    leer los píxeles. Devuelve (None, formato) si la imagen se va a procesar
+    por bandas o con `pixeles=False`: solo se valida el encabezado y el worker
+    la lee del archivo. Las imágenes por bandas que no se pueden leer por
+    partes (ver capa_nitrurada/bandas.py) se rechazan por encima de
+    PREDICCION_BANDAS_MAX_PIXELES_DECODIFICADOS.
+    """
+    try:
+        with Image.open(path) as img:
+            ancho, alto = img.size
+            if ancho * alto > max_pixeles():
+                raise ImagenInvalida(f"La imagen tiene {ancho}x{alto} píxeles, el máximo es {max_pixeles()}", 413)
+            formato = img.format
+            bandas = requiere_bandas(path)
+            limite = max_pixeles_decodificados()
+            if bandas and limite is not None and ancho * alto > limite and not lectura_incremental(img):
+                raise ImagenInvalida(
+                    f"La imagen tiene {ancho}x{alto} píxeles y en {formato} se decodifica entera: el máximo "
+                    f"es {limite}. Enviarla como TIFF sin compresión o con Deflate", 413,
+                )
+            arr = None if not pixeles or bandas else np.asarray(img.convert("RGB"))
+    except ImagenInvalida:
+        raise
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImagenInvalida("No se pudo decodificar la imagen") from e
+    return arr, formato
+
+
+def es_zip(archivo):
+    return zipfile.is_zipfile(archivo.temporary_file_path())
+
+
+def extraer_zip(archivo, maximo_imagenes):
+    """
+    Extrae los archivos de un ZIP subido como ArchivoIngerido (con su sha256),
+    salteando carpetas y archivos ocultos. Lanza ImagenInvalida si el ZIP está
+    dañado, tiene más de `maximo_imagenes` archivos o se descomprime a más de
+    PREDICCION_LOTE_MAX_BYTES (el tamaño declarado en el ZIP no se usa).
+    """
+    extraidos = []
+    total = 0
+    try:
+        with zipfile.ZipFile(archivo.temporary_file_path()) as zf:
+            for info in zf.infolist():
+                nombre = os.path.basename(info.filename)
+                if info.is_dir() or not nombre or nombre.startswith(".") or "__MACOSX" in info.filename:
+                    continue
+                if len(extraidos) >= maximo_imagenes:
+                    raise ImagenInvalida(f"El lote tiene más de {max_imagenes_lote()} imágenes", 413)
+                hash_ = hashlib.sha256()
+                destino = tempfile.NamedTemporaryFile(dir=carpeta_entradas(), suffix=".part")
+                extraidos.append(destino)
+                tamano = 0
+                with zf.open(info) as origen:
+                    while chunk := origen.read(1024 * 1024):
+                        tamano += len(chunk)
+                        total += len(chunk)
+                        if tamano > max_bytes() or total > max_bytes_lote():
+                            raise ImagenInvalida("El ZIP descomprimido supera el máximo permitido", 413)
+                        hash_.update(chunk)
+                        destino.write(chunk)
+                destino.flush()
+                extraidos[-1] = ArchivoIngerido(destino, nombre, None, tamano, None, hash_.hexdigest())
+    except (zipfile.BadZipFile, NotImplementedError, RuntimeError, EOFError, zlib.error) as e:
+        for extraido in extraidos:
+            extraido.close()
+        raise ImagenInvalida("No se pudo leer el ZIP") from e
+    except ImagenInvalida:
+        for extraido in extraidos:
+            extraido.close()
+        raise
+    return extraidos
+
+
+def publicar(archivo, formato):
+    """Publica el upload como `entradas/<sha256><ext>` y devuelve (path, url)."""
+    nombre = f"{CARPETA_ENTRADAS}/{archivo.sha256}{EXTENSIONES.get(formato, '')}"
+    destino = os.path.join(settings.MEDIA_ROOT, nombre)
+    if not os.path.exists(destino):
+        try:
+            os.link(archivo.temporary_file_path(), destino)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(archivo.temporary_file_path(), destino + ".tmp")
+            os.replace(destino + ".tmp", destino)
+    return destino, settings.MEDIA_URL + nombre
@@ -0,0 +1,299 @@
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from albertidl.metrics import PicoRSS, rss_actual
+from ...models import IA_Model
+from ...registro import cargar_modelo, ruta_servida
+
+TAMANOS = "512x512,2048x1536,8192x8192"
+TESTING_DATA = os.path.join(settings.BASE_DIR, "capa_nitrurada", "testing_data")
+# Umbrales de FiltroPatches si no se pasan ni están en PREDICCION_FILTRO_PATCHES
+FILTRO_DEFECTO = {"varianza": 2e-4, "bordes": 0.01, "rango": 0.08}
+# Etapas del pipeline en el orden en que corren; "generar_patches_img" se mide
+# aparte (arma todos los patches juntos) y no entra en el total
+ETAPAS = ("patches", "inferencia", "fusion", "realce", "render", "guardado")
+
+
+def unet_minima(patch_size=256, canales=5, semilla=0):
+    """U-Net chica inicializada al azar con la misma entrada que los modelos reales."""
+    import tensorflow as tf
+
+    tf.keras.utils.set_random_seed(semilla)
+    capas = tf.keras.layers
+    entrada = tf.keras.Input((patch_size, patch_size, canales))
+    c1 = capas.Conv2D(8, 3, padding="same", activation="relu")(entrada)
+    p1 = capas.MaxPooling2D()(c1)
+    c2 = capas.Conv2D(16, 3, padding="same", activation="relu")(p1)
+    p2 = capas.MaxPooling2D()(c2)
+    b = capas.Conv2D(32, 3, padding="same", activation="relu")(p2)
+    u2 = capas.Concatenate()([capas.UpSampling2D()(b), c2])
+    c3 = capas.Conv2D(16, 3, padding="same", activation="relu")(u2)
+    u1 = capas.Concatenate()([capas.UpSampling2D()(c3), c1])
+    c4 = capas.Conv2D(8, 3, padding="same", activation="relu")(u1)
+    salida = capas.Conv2D(1, 1, activation="sigmoid")(c4)
+    return tf.keras.Model(entrada, salida)
+
+
+def micrografia_sintetica(alto, ancho, semilla=0):
+    """Imagen RGB uint8 parecida a una micrografía: fondo con textura y una capa horizontal."""
+    rng = np.random.default_rng(semilla)
+    y = np.linspace(0, 1, alto, dtype=np.float32)[:, np.newaxis]
+    x = np.linspace(0, 1, ancho, dtype=np.float32)[np.newaxis, :]
+    gris = 0.45 + 0.1 * np.sin(40 * x) * np.cos(25 * y)
+    gris += np.where(np.abs(y - 0.3 - 0.02 * np.sin(12 * x)) < 0.05, 0.35, 0.0)
+    gris += rng.normal(0, 0.05, (alto, ancho)).astype(np.float32)
+    gris = np.clip(gris * 255, 0, 255).astype(np.uint8)
+    return np.repeat(gris[..., np.newaxis], 3, axis=2)
+
+
+def percentiles(valores):
+    valores = np.asarray(valores, dtype=np.float64) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(valores, 50)), 3),
+        "p90_ms": round(float(np.percentile(valores, 90)), 3),
+        "p99_ms": round(float(np.percentile(valores, 99)), 3),
+        "media_ms": round(float(valores.mean()), 3),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Mide cada etapa del pipeline de predicción sobre micrografías sintéticas "
+        "y compara contra un baseline guardado"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--modelo", help="pk o model_file de un IA_Model; sin esto se usa una U-Net chica al azar",
+        )
+        parser.add_argument("--tamanos", default=TAMANOS, help=f"Lista ALTOxANCHO separada por comas ({TAMANOS})")
+        parser.add_argument("--repeticiones", type=int, default=5)
+        parser.add_argument("--batch-size", type=int, default=16)
+        parser.add_argument(
+            "--max-mb-patches", type=int, default=1024,
+            help="Solo mide generar_patches_img si el arreglo de patches entra en estos MB",
+        )
+        parser.add_argument("--ventana", default="plana", choices=["plana", "coseno", "gauss"])
+        parser.add_argument("--salida", help="Archivo donde escribir el JSON (por defecto stdout)")
+        parser.add_argument("--baseline", help="JSON de una corrida anterior para comparar")
+        parser.add_argument(
+            "--tolerancia", type=float, default=0.15,
+            help="Empeoramiento relativo a partir del cual se marca una regresión",
+        )
+        parser.add_argument("--estricto", action="store_true", help="Terminar con error si hay regresiones")
+        parser.add_argument(
+            "--filtro", nargs="?", const="",
+            help="Compara el filtro de fondo contra la corrida completa sobre --imagenes. Umbrales "
+                 "opcionales como varianza=2e-4,bordes=0.01,rango=0.08 (por defecto los de "
+                 "PREDICCION_FILTRO_PATCHES para el modelo)",
+        )
+        parser.add_argument("--imagenes", default=TESTING_DATA, help="Carpeta de imágenes para --filtro")
+
+    def handle(self, *args, **options):
+        try:
+            tamanos = [tuple(int(v) for v in t.lower().split("x")) for t in options["tamanos"].split(",")]
+        except ValueError:
+            raise CommandError("--tamanos debe ser una lista ALTOxANCHO, p.ej. 512x512,2048x1536")
+
+        modelo, model_file, nombre_modelo = self.cargar(options["modelo"])
+        # Calentamiento: la primera llamada incluye la compilación del grafo
+        lote = np.zeros((options["batch_size"], 256, 256, 5), dtype=np.float32)
+        modelo.predict(lote, batch_size=len(lote), verbose=0)
+
+        resultados = {}
+        for alto, ancho in tamanos:
+            self.stderr.write(f"Midiendo {alto}x{ancho}...")
+            resultados[f"{alto}x{ancho}"] = self.medir_tamano(modelo, alto, ancho, options)
+
+        reporte = {
+            "meta": {
+                "modelo": nombre_modelo,
+                "batch_size": options["batch_size"],
+                "ventana": options["ventana"],
+                "repeticiones": options["repeticiones"],
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "cpus": os.cpu_count(),
+                "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "resultados": resultados,
+        }
+        if options["filtro"] is not None:
+            umbrales = self.umbrales(options["filtro"], model_file)
+            reporte["filtro"] = {
+                "umbrales": umbrales,
+                "imagenes": self.comparar_filtro(modelo, umbrales, options),
+            }
+        if options["baseline"]:
+            reporte["regresiones"] = self.comparar(reporte, options["baseline"], options["tolerancia"])
+
+        texto = json.dumps(reporte, indent=2)
+        if options["salida"]:
+            with open(options["salida"], "w") as f:
+                f.write(texto + "\n")
+            self.stderr.write(f"Resultados guardados en {options['salida']}")
+        else:
+            self.stdout.write(texto)
+
+        regresiones = reporte.get("regresiones", [])
+        for regresion in regresiones:
+            self.stderr.write(self.style.WARNING(
+                f"Regresión en {regresion['tamano']} / {regresion['metrica']}: "
+                f"{regresion['baseline']} -> {regresion['actual']}"
+            ))
+        if regresiones and options["estricto"]:
+            raise CommandError(f"{len(regresiones)} regresiones respecto del baseline")
+
+    def cargar(self, valor):
+        if not valor:
+            return unet_minima(), None, "unet_minima"
+        if valor.isdigit():
+            try:
+                valor = IA_Model.objects.get(pk=int(valor)).model_file
+            except IA_Model.DoesNotExist:
+                raise CommandError(f"No existe el IA_Model {valor}")
+        path = ruta_servida(valor)
+        if path is None:
+            raise CommandError(f"No existe el modelo '{valor}'")
+        return cargar_modelo(path), valor, os.path.basename(path)
+
+    def umbrales(self, valor, model_file):
+        if not valor:
+            return dict(getattr(settings, "PREDICCION_FILTRO_PATCHES", {}).get(model_file) or FILTRO_DEFECTO)
+        try:
+            return {clave.strip(): float(v) for clave, v in (par.split("=") for par in valor.split(","))}
+        except ValueError:
+            raise CommandError("--filtro debe tener la forma varianza=2e-4,bordes=0.01,rango=0.08")
+
+    def comparar_filtro(self, modelo, umbrales, options):
+        """IoU (mapa > 0.5) y tiempo de inferencia con el filtro contra la corrida completa."""
+        from capa_nitrurada.testing_model import (
+            AcumuladorMosaico, FiltroPatches, calcular_inicios, cargar_imagen, iterar_lotes_patches, predecir_lotes,
+        )
+
+        patch_size, stride = 256, 128
+        carpeta = options["imagenes"]
+        resultados = {}
+        for nombre in sorted(os.listdir(carpeta)) if os.path.isdir(carpeta) else []:
+            try:
+                img = cargar_imagen(os.path.join(carpeta, nombre))
+            except OSError:
+                continue
+            self.stderr.write(f"Filtro sobre {nombre}...")
+            alto, ancho = img.shape[:2]
+            total = calcular_inicios(alto, patch_size, stride).size * calcular_inicios(ancho, patch_size, stride).size
+
+            def correr(filtro):
+                acumulador = AcumuladorMosaico(alto, ancho, patch_size, ventana=options["ventana"])
+                tiempos = predecir_lotes(
+                    modelo, iterar_lotes_patches(img, patch_size, stride, options["batch_size"]),
+                    acumulador, total, tiempos={}, filtro=filtro,
+                )
+                return acumulador.finalizar(), tiempos
+
+            completo, t_completo = correr(None)
+            filtro = FiltroPatches(**umbrales)
+            filtrado, t_filtrado = correr(filtro)
+
+            mascara_completa, mascara_filtrada = completo > 0.5, filtrado > 0.5
+            union = np.logical_or(mascara_completa, mascara_filtrada).sum()
+            iou = np.logical_and(mascara_completa, mascara_filtrada).sum() / union if union else 1.0
+            resultados[nombre] = {
+                "patches": int(total),
+                "omitidos": filtro.omitidos,
+                "iou": round(float(iou), 4),
+                "error_absoluto_max": round(float(np.abs(completo - filtrado).max()), 4),
+                "inferencia_completa_ms": round(t_completo["inferencia"] * 1000, 1),
+                "inferencia_filtrada_ms": round(t_filtrado["inferencia"] * 1000, 1),
+                "filtro_ms": round(t_filtrado.get("filtro", 0.0) * 1000, 1),
+            }
+        if not resultados:
+            self.stderr.write(self.style.WARNING(f"No hay imágenes en {carpeta}"))
+        return resultados
+
+    def medir_tamano(self, modelo, alto, ancho, options):
+        from capa_nitrurada.testing_model import (
+            AcumuladorMosaico, calcular_inicios, cronometrar, generar_patches_img, guardar_png,
+            iterar_lotes_patches, predecir_lotes, realce_asimetrico, renderizar_resultado,
+        )
+        from django.conf import settings
+
+        patch_size, stride = 256, 128
+        img = micrografia_sintetica(alto, ancho)
+        total = calcular_inicios(alto, patch_size, stride).size * calcular_inicios(ancho, patch_size, stride).size
+        render_max = getattr(settings, "PREDICCION_RENDER_MAX_LADO", None)
+        # generar_patches_img materializa todos los patches float32 de una vez
+        medir_generar = total * patch_size * patch_size * 5 * 4 <= options["max_mb_patches"] * 2 ** 20
+
+        muestras = {etapa: [] for etapa in ("generar_patches_img",) + ETAPAS}
+        rss_inicial = rss_actual()
+        with PicoRSS() as memoria, tempfile.TemporaryDirectory() as tmp:
+            for _ in range(options["repeticiones"]):
+                tiempos = {}
+                if medir_generar:
+                    with cronometrar(tiempos, "generar_patches_img"):
+                        patches = generar_patches_img(img, patch_size, stride)
+                    del patches
+
+                acumulador = AcumuladorMosaico(alto, ancho, patch_size, ventana=options["ventana"])
+                predecir_lotes(
+                    modelo, iterar_lotes_patches(img, patch_size, stride, options["batch_size"]),
+                    acumulador, total, tiempos=tiempos,
+                )
+                with cronometrar(tiempos, "fusion"):
+                    mapa = acumulador.finalizar()
+                with cronometrar(tiempos, "realce"):
+                    realce_asimetrico(mapa, out=mapa)
+                with cronometrar(tiempos, "render"):
+                    rgb = renderizar_resultado(img, mapa, max_lado=render_max)
+                with cronometrar(tiempos, "guardado"):
+                    guardar_png(rgb, os.path.join(tmp, "salida.png"))
+
+                for etapa, segundos in tiempos.items():
+                    muestras[etapa].append(segundos)
+                del acumulador, mapa, rgb
+
+        inferencia = np.median(muestras["inferencia"])
+        return {
+            "patches": int(total),
+            "patches_por_segundo": round(total / inferencia, 2) if inferencia else None,
+            "etapas": {etapa: percentiles(valores) for etapa, valores in muestras.items() if valores},
+            "total": percentiles(np.sum([muestras[etapa] for etapa in ETAPAS], axis=0)),
+            "rss_pico_mb": round(memoria.pico / 2 ** 20, 1) if memoria.pico else None,
+            "rss_incremento_mb": (
+                round((memoria.pico - rss_inicial) / 2 ** 20, 1) if memoria.pico and rss_inicial else None
+            ),
+        }
+
+    def comparar(self, reporte, path, tolerancia):
+        """Compara p50 por etapa y patches/s contra el baseline; ignora diferencias de menos de 1 ms."""
+        try:
+            with open(path) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"No se pudo leer el baseline {path}: {e}")
+
+        regresiones = []
+        for tamano, actual in reporte["resultados"].items():
+            anterior = baseline.get("resultados", {}).get(tamano)
+            if anterior is None:
+                continue
+            metricas = [(f"{etapa}.p50_ms", medicion["p50_ms"], anterior.get("etapas", {}).get(etapa, {}).get("p50_ms"))
+                        for etapa, medicion in actual["etapas"].items()]
+            metricas.append(("total.p50_ms", actual["total"]["p50_ms"], anterior.get("total", {}).get("p50_ms")))
+            for metrica, valor, referencia in metricas:
+                if referencia is not None and valor > referencia * (1 + tolerancia) and valor - referencia > 1:
+                    regresiones.append({"tamano": tamano, "metrica": metrica, "baseline": referencia, "actual": valor})
+            valor, referencia = actual["patches_por_segundo"], anterior.get("patches_por_segundo")
+            if valor and referencia and valor < referencia / (1 + tolerancia):
+                regresiones.append(
+                    {"tamano": tamano, "metrica": "patches_por_segundo", "baseline": referencia, "actual": valor}
+                )
+        return regresiones
@@ -0,0 +1,93 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+PROHIBIDOS = "tensorflow,keras,matplotlib"
+
+# Corre en un intérprete limpio: arranca Django, importa las URLs y anota
+# desde qué archivo del proyecto se importó por primera vez cada módulo prohibido.
+SCRIPT = r"""
+import json, os, resource, sys, time, traceback
+
+inicio = time.perf_counter()
+base, prohibidos, modulos = sys.argv[1], set(sys.argv[2].split(",")), sys.argv[3].split(",")
+origen = {}
+
+
+class Detector:
+    def find_spec(self, nombre, path=None, target=None):
+        raiz = nombre.partition(".")[0]
+        if raiz in prohibidos and raiz not in origen:
+            pila = [f for f in traceback.extract_stack()[:-1] if f.filename.startswith(base)]
+            origen[raiz] = f"{pila[-1].filename[len(base) + 1:]}:{pila[-1].lineno}" if pila else "?"
+        return None
+
+
+sys.meta_path.insert(0, Detector())
+import django
+django.setup()
+import importlib
+for modulo in filter(None, modulos):
+    importlib.import_module(modulo)
+
+print(json.dumps({
+    "segundos": time.perf_counter() - inicio,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "prohibidos": {m: origen[m] for m in prohibidos if m in sys.modules},
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Verifica que arrancar Django y cargar las URLs no importe TensorFlow ni "
+        "matplotlib, y que el tiempo de arranque y el RSS queden bajo los límites"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--prohibidos", default=PROHIBIDOS, help=f"Módulos que no deben importarse ({PROHIBIDOS})")
+        parser.add_argument(
+            "--modulos", default=settings.ROOT_URLCONF,
+            help="Módulos a importar después de django.setup(), separados por comas",
+        )
+        parser.add_argument("--max-segundos", type=float, default=3.0)
+        parser.add_argument("--max-mb", type=float, default=250.0, help="Pico de RSS permitido")
+        parser.add_argument("--repeticiones", type=int, default=3, help="Se informa la mediana")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "albertidl.settings"))
+        corridas = []
+        for _ in range(options["repeticiones"]):
+            inicio = time.perf_counter()
+            proceso = subprocess.run(
+                [sys.executable, "-c", SCRIPT, str(settings.BASE_DIR), options["prohibidos"], options["modulos"]],
+                cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+            )
+            if proceso.returncode != 0:
+                raise CommandError(f"El proceso de prueba falló:\n{proceso.stderr}")
+            resultado = json.loads(proceso.stdout.strip().splitlines()[-1])
+            resultado["segundos_proceso"] = time.perf_counter() - inicio
+            corridas.append(resultado)
+
+        corridas.sort(key=lambda r: r["segundos"])
+        mediana = corridas[len(corridas) // 2]
+        self.stdout.write(
+            f"Arranque: {mediana['segundos']:.2f} s (proceso completo {mediana['segundos_proceso']:.2f} s), "
+            f"RSS pico {mediana['rss_mb']:.0f} MB"
+        )
+
+        errores = [
+            f"se importó {modulo} (desde {origen})" for modulo, origen in sorted(mediana["prohibidos"].items())
+        ]
+        if mediana["segundos"] > options["max_segundos"]:
+            errores.append(f"el arranque tardó {mediana['segundos']:.2f} s (máximo {options['max_segundos']} s)")
+        if mediana["rss_mb"] > options["max_mb"]:
+            errores.append(f"el RSS llegó a {mediana['rss_mb']:.0f} MB (máximo {options['max_mb']:.0f} MB)")
+        if errores:
+            raise CommandError("; ".join(errores))
+        self.stdout.write(self.style.SUCCESS("OK"))
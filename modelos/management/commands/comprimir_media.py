@@ -0,0 +1,57 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from whitenoise.compress import Compressor
+
+from albertidl.media import SUFIJOS_OCULTOS, VARIANTES
+
+
+class Command(BaseCommand):
+    help = (
+        "Genera las variantes .gz (y .br si está instalado brotli) de los archivos "
+        "comprimibles de MEDIA_ROOT, que albertidl/media.py sirve según Accept-Encoding. "
+        "Saltea los que ya tienen variantes al día; se puede correr periódicamente"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--extensiones", default=",".join(getattr(settings, "MEDIA_COMPRIMIR_EXTENSIONES", ())),
+            help="Extensiones a comprimir, separadas por comas",
+        )
+        parser.add_argument(
+            "--max-bytes", type=int, default=getattr(settings, "MEDIA_COMPRIMIR_MAX_BYTES", 512 * 1024 * 1024),
+            help="Los archivos más grandes no se comprimen (se leen enteros en memoria)",
+        )
+
+    def handle(self, *args, **options):
+        extensiones = tuple(f".{e.strip().lower()}" for e in options["extensiones"].split(",") if e.strip())
+        compresor = Compressor(extensions=[], quiet=True)
+        comprimidos = omitidos = 0
+        for carpeta, _, archivos in os.walk(settings.MEDIA_ROOT):
+            for nombre in archivos:
+                if not nombre.lower().endswith(extensiones) or nombre.endswith(SUFIJOS_OCULTOS):
+                    continue
+                ruta = os.path.join(carpeta, nombre)
+                st = os.stat(ruta)
+                if st.st_size > options["max_bytes"] or self._al_dia(ruta, st):
+                    omitidos += 1
+                    continue
+                variantes = compresor.compress(ruta)
+                comprimidos += 1
+                if variantes:
+                    self.stdout.write(f"{os.path.relpath(ruta, settings.MEDIA_ROOT)}: " + ", ".join(
+                        f"{os.path.splitext(v)[1]} {os.path.getsize(v) / st.st_size:.0%}" for v in variantes
+                    ))
+        self.stdout.write(self.style.SUCCESS(f"{comprimidos} archivos comprimidos, {omitidos} omitidos"))
+
+    @staticmethod
+    def _al_dia(ruta, st):
+        # Compressor copia el mtime del original a cada variante
+        for _, sufijo in VARIANTES:
+            try:
+                if os.stat(ruta + sufijo).st_mtime >= st.st_mtime:
+                    return True
+            except OSError:
+                pass
+        return False
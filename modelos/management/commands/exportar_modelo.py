@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from ...models import IA_Model
+from ...registro import (
+    cargar_modelo, cargar_modelo_keras, ruta_modelo, ruta_savedmodel, ruta_tflite,
+)
+
+TESTING_DATA = os.path.join(settings.BASE_DIR, "capa_nitrurada", "testing_data")
+
+
+class Command(BaseCommand):
+    help = (
+        "Exporta el .h5 de un IA_Model a un artefacto optimizado para CPU "
+        "(TFLite con XNNPACK o SavedModel) y lo compara con el original. El artefacto "
+        "recién se publica (y se empieza a servir) si su IoU contra el .h5 llega a --min-iou"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("modelo", help="pk del IA_Model o su model_file")
+        parser.add_argument("--formato", choices=["tflite", "savedmodel"], default="tflite")
+        parser.add_argument(
+            "--cuantizacion", choices=["ninguna", "float16", "dinamica"], default="ninguna",
+            help="Cuantización de pesos (solo TFLite): float16 o int8 de rango dinámico",
+        )
+        parser.add_argument("--imagenes", default=TESTING_DATA, help="Carpeta con imágenes para comparar")
+        parser.add_argument("--max-patches", type=int, default=64)
+        parser.add_argument("--batch-size", type=int, default=8)
+        parser.add_argument(
+            "--min-iou", type=float, default=0.99,
+            help="IoU mínimo contra el .h5 para publicar el artefacto (0 publica sin comparar)",
+        )
+
+    def handle(self, *args, **options):
+        model_file = self.resolver_model_file(options["modelo"])
+        h5 = ruta_modelo(model_file)
+        if not os.path.exists(h5):
+            raise CommandError(f"No existe {h5}")
+
+        self.stdout.write(f"Cargando {h5}...")
+        original = cargar_modelo_keras(h5)
+
+        # ruta_servida() sirve cualquier artefacto que no sea más viejo que el .h5:
+        # se exporta y se compara en un temporal y solo se publica si pasa
+        with tempfile.TemporaryDirectory() as tmp:
+            candidato = os.path.join(tmp, "savedmodel")
+            original.export(candidato, verbose=False)
+            if options["formato"] == "savedmodel":
+                destino = ruta_savedmodel(model_file)
+            else:
+                destino = ruta_tflite(model_file)
+                contenido = self.convertir_tflite(candidato, options["cuantizacion"])
+                candidato = os.path.join(tmp, "modelo.tflite")
+                with open(candidato, "wb") as f:
+                    f.write(contenido)
+
+            if options["min_iou"] > 0:
+                patches = self.patches_de_prueba(options["imagenes"], options["max_patches"])
+                if patches is None:
+                    raise CommandError(
+                        f"No hay imágenes para comparar en {options['imagenes']}; el artefacto no se publicó "
+                        "(--min-iou 0 lo publica sin comparar)"
+                    )
+                iou = self.comparar(original, cargar_modelo(candidato), patches, options["batch_size"])
+                if iou < options["min_iou"]:
+                    raise CommandError(
+                        f"IoU {iou:.4f} menor que --min-iou {options['min_iou']}: el artefacto no se publicó"
+                    )
+            self.publicar(candidato, destino)
+        self.stdout.write(f"Artefacto guardado en {destino}")
+
+        # Los procesos en marcha detectan el artefacto nuevo en la próxima predicción
+        self.stdout.write(self.style.SUCCESS(f"✅ {model_file} exportado a {options['formato']}"))
+
+    def publicar(self, candidato, destino):
+        if os.path.isdir(candidato):
+            shutil.rmtree(destino, ignore_errors=True)
+            shutil.move(candidato, destino)
+        else:
+            # Copia al lado del destino y reemplazo atómico
+            shutil.move(candidato, destino + ".tmp")
+            os.replace(destino + ".tmp", destino)
+
+    def resolver_model_file(self, valor):
+        if valor.isdigit():
+            try:
+                return IA_Model.objects.get(pk=int(valor)).model_file
+            except IA_Model.DoesNotExist:
+                raise CommandError(f"No existe el IA_Model {valor}")
+        if not IA_Model.objects.filter(model_file=valor).exists():
+            self.stdout.write(self.style.WARNING(f"'{valor}' no está registrado en ningún IA_Model"))
+        return valor
+
+    def convertir_tflite(self, savedmodel, cuantizacion):
+        import tensorflow as tf
+
+        converter = tf.lite.TFLiteConverter.from_saved_model(savedmodel)
+        if cuantizacion != "ninguna":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if cuantizacion == "float16":
+                converter.target_spec.supported_types = [tf.float16]
+        return converter.convert()
+
+    def patches_de_prueba(self, carpeta, max_patches):
+        from capa_nitrurada.testing_model import generar_patches_img
+
+        lotes = []
+        for nombre in sorted(os.listdir(carpeta)) if os.path.isdir(carpeta) else []:
+            try:
+                img = np.asarray(Image.open(os.path.join(carpeta, nombre)).convert("RGB"), dtype=np.float32) / 255.0
+            except OSError:
+                continue
+            patches, _ = generar_patches_img(img, patch_size=256, stride=128)
+            lotes.append(patches)
+        if not lotes:
+            return None
+        return np.concatenate(lotes)[:max_patches]
+
+    def comparar(self, original, optimizado, patches, batch_size):
+        def correr(modelo):
+            # Una pasada de calentamiento para no medir la inicialización
+            modelo.predict(patches[:batch_size], batch_size=batch_size, verbose=0)
+            inicio = time.perf_counter()
+            preds = [
+                modelo.predict(patches[i:i + batch_size], batch_size=batch_size, verbose=0)
+                for i in range(0, len(patches), batch_size)
+            ]
+            return np.concatenate(preds)[..., 0], time.perf_counter() - inicio
+
+        pred_h5, t_h5 = correr(original)
+        pred_opt, t_opt = correr(optimizado)
+
+        mascara_h5 = pred_h5 > 0.5
+        mascara_opt = pred_opt > 0.5
+        union = np.logical_or(mascara_h5, mascara_opt).sum()
+        iou = np.logical_and(mascara_h5, mascara_opt).sum() / union if union else 1.0
+
+        self.stdout.write(f"Patches comparados: {len(patches)}")
+        self.stdout.write(f"IoU vs .h5: {iou:.4f}  (error absoluto máximo {np.abs(pred_h5 - pred_opt).max():.2e})")
+        self.stdout.write(
+            f".h5: {len(patches) / t_h5:.1f} patches/s  |  optimizado: {len(patches) / t_opt:.1f} patches/s  "
+            f"|  speedup x{t_h5 / t_opt:.2f}"
+        )
+        return iou
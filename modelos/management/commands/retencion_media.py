@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...retencion import Retencion
+
+
+def megabytes(valor):
+    return f"{valor / 1024 / 1024:.1f} MB"
+
+
+class Command(BaseCommand):
+    help = (
+        "Aplica la retención de MEDIA_ROOT: expira las predicciones terminadas sin usar "
+        "en --max-dias y, mientras MEDIA_ROOT supere --max-bytes, las menos usadas, "
+        "borrando sus archivos. Sin --max-segundos corre hasta cumplir el presupuesto"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-bytes", type=int, default=getattr(settings, "MEDIA_RETENCION_MAX_BYTES", None))
+        parser.add_argument("--max-dias", type=float, default=getattr(settings, "MEDIA_RETENCION_MAX_DIAS", None))
+        parser.add_argument("--lote", type=int, default=getattr(settings, "MEDIA_RETENCION_LOTE", 200))
+        parser.add_argument("--max-segundos", type=float, default=None, help="Cortar el barrido a los N segundos")
+        parser.add_argument(
+            "--huerfanos", type=float, metavar="DIAS", default=None,
+            help="Borrar también los archivos sin predicción que los use y sin modificar en DIAS días",
+        )
+        parser.add_argument("--simular", action="store_true", help="Solo informar lo que se borraría")
+
+    def handle(self, *args, **options):
+        if options["max_bytes"] is None and options["max_dias"] is None and options["huerfanos"] is None:
+            raise CommandError(
+                "Sin presupuesto: configurar MEDIA_RETENCION_MAX_BYTES / MEDIA_RETENCION_MAX_DIAS "
+                "o pasar --max-bytes, --max-dias o --huerfanos"
+            )
+
+        retencion = Retencion(
+            max_bytes=options["max_bytes"], max_dias=options["max_dias"], lote=options["lote"],
+            max_segundos=options["max_segundos"] if options["max_segundos"] is not None else float("inf"),
+        )
+        prefijo = "[simulación] " if options["simular"] else ""
+        resultado = retencion.barrer(simular=options["simular"])
+        self.stdout.write(
+            f"{prefijo}{resultado['expiradas']} predicciones expiradas, {resultado['archivos']} archivos, "
+            f"{megabytes(resultado['bytes_liberados'])} liberados"
+        )
+        if "uso_inicial" in resultado:
+            self.stdout.write(
+                f"{prefijo}MEDIA_ROOT: {megabytes(resultado['uso_inicial'])} -> {megabytes(resultado['uso_final'])} "
+                f"(presupuesto {megabytes(options['max_bytes'])})"
+            )
+        if not resultado["completo"]:
+            self.stdout.write(self.style.WARNING("Se agotó el tiempo: el próximo barrido sigue donde quedó"))
+        elif resultado.get("uso_final", 0) > (options["max_bytes"] or float("inf")):
+            self.stdout.write(self.style.WARNING(
+                "No quedan predicciones para expirar y MEDIA_ROOT sigue sobre el presupuesto (ver --huerfanos)"
+            ))
+
+        if options["huerfanos"] is not None:
+            huerfanos = retencion.huerfanos(options["huerfanos"], simular=options["simular"])
+            self.stdout.write(
+                f"{prefijo}Huérfanos: {huerfanos['archivos']} archivos, "
+                f"{megabytes(huerfanos['bytes_liberados'])} liberados"
+            )
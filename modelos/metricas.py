@@ -0,0 +1,100 @@
+"""
+Métricas del pipeline de predicción, expuestas en /metrics (albertidl/metrics.py).
+
+Las etapas del trabajo (carga, patches, inferencia, fusion, render, guardado)
+las reporta procesar_prediccion con notificar("tiempos", ...); las de la
+vista (upload, decodificacion, publicacion) se miden en IA_ModelDetailView y
+también salen en su cabecera Server-Timing.
+"""
+from albertidl.metrics import BUCKETS_BYTES, Contador, Histograma, Medidor
+
+etapa_segundos = Histograma(
+    'prediccion_etapa_segundos', 'Duración de cada etapa de una predicción', ('etapa',),
+)
+trabajos_total = Contador('prediccion_trabajos_total', 'Trabajos terminados por estado final', ('estado',))
+patches_total = Contador('prediccion_patches_total', 'Patches de las imágenes procesadas')
+patches_omitidos_total = Contador(
+    'prediccion_patches_omitidos_total', 'Patches de fondo que el filtro salteó sin pasar por el modelo',
+)
+patches_por_segundo = Medidor(
+    'prediccion_patches_por_segundo', 'Patches por segundo de inferencia del último trabajo',
+)
+procesos_reinicios_total = Contador(
+    'prediccion_procesos_reinicios_total', 'Procesos de inferencia caídos a mitad de un trabajo',
+)
+progreso_escrituras_total = Contador(
+    'prediccion_progreso_escrituras_total', 'Transacciones del escritor agrupado de progreso',
+)
+progreso_filas_total = Contador(
+    'prediccion_progreso_filas_total', 'Filas de progreso escritas por el escritor agrupado',
+)
+retencion_expiradas_total = Contador(
+    'prediccion_retencion_expiradas_total', 'Predicciones expiradas por la retención de MEDIA_ROOT',
+)
+retencion_bytes_total = Contador(
+    'prediccion_retencion_bytes_liberados_total', 'Bytes de MEDIA_ROOT borrados por la retención',
+)
+rss_pico_bytes = Histograma(
+    'prediccion_rss_pico_bytes', 'Pico de RSS del proceso durante cada trabajo', buckets=BUCKETS_BYTES,
+)
+
+
+def _ejecutor():
+    from .trabajos import ejecutor
+    return ejecutor
+
+
+def _registro():
+    from .registro import registro
+    return registro
+
+
+def _cache_resultados():
+    from .cache import cache_resultados
+    return cache_resultados.stats()
+
+
+def _cache_respuestas(campo):
+    from albertidl.cache import estadisticas
+    return {grupo: datos[campo] for grupo, datos in estadisticas.resumen().items()}
+
+
+Medidor('prediccion_cola_pendientes', 'Trabajos esperando en la cola', funcion=lambda: _ejecutor().pendientes())
+Medidor('prediccion_en_curso', 'Trabajos procesándose', funcion=lambda: _ejecutor().en_curso)
+Medidor('modelos_registro_cargados', 'Modelos en memoria', funcion=lambda: len(_registro().cargados()))
+Medidor('modelos_registro_hits_total', 'Aciertos del registro de modelos', funcion=lambda: _registro().hits, tipo='counter')
+Medidor('modelos_registro_misses_total', 'Cargas de modelos', funcion=lambda: _registro().misses, tipo='counter')
+Medidor(
+    'modelos_registro_desalojos_total', 'Modelos desalojados del registro',
+    funcion=lambda: _registro().desalojos, tipo='counter',
+)
+Medidor(
+    'prediccion_cache_hits_total', 'Predicciones servidas del caché de resultados',
+    funcion=lambda: _cache_resultados()['hits'], tipo='counter',
+)
+Medidor(
+    'prediccion_cache_misses_total', 'Consultas al caché de resultados sin acierto',
+    funcion=lambda: _cache_resultados()['misses'], tipo='counter',
+)
+Medidor(
+    'prediccion_cache_deduplicadas_total', 'Pedidos unidos a un trabajo en curso',
+    funcion=lambda: _cache_resultados()['deduplicadas'], tipo='counter',
+)
+Medidor(
+    'respuestas_cache_hits_total', 'Aciertos del caché de respuestas por grupo', ('grupo',),
+    funcion=lambda: _cache_respuestas('hits'), tipo='counter',
+)
+Medidor(
+    'respuestas_cache_misses_total', 'Fallos del caché de respuestas por grupo', ('grupo',),
+    funcion=lambda: _cache_respuestas('misses'), tipo='counter',
+)
+
+
+def registrar_tiempos(etapas, patches, omitidos=0):
+    """Observa los tiempos por etapa de un trabajo terminado."""
+    for etapa, segundos in etapas.items():
+        etapa_segundos.observar(segundos, etapa)
+    patches_total.inc(valor=patches)
+    patches_omitidos_total.inc(valor=omitidos)
+    if etapas.get('inferencia'):
+        patches_por_segundo.set(valor=round((patches - omitidos) / etapas['inferencia'], 2))
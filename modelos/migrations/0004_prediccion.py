@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0003_ia_model_model_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Prediccion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('input_image', models.URLField()),
+                ('output_image', models.URLField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('status', models.CharField(choices=[('queued', 'En cola'), ('running', 'Procesando'), ('done', 'Terminada'), ('error', 'Error')], default='queued', max_length=20)),
+                ('ia_model', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='modelos.ia_model')),
+            ],
+        ),
+    ]
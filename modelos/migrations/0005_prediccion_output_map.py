@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0004_prediccion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='output_map',
+            field=models.URLField(blank=True, null=True),
+        ),
+    ]
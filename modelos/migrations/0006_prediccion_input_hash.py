@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0005_prediccion_output_map'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='input_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='prediccion',
+            name='model_version',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+    ]
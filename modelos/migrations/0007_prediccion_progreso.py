@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0006_prediccion_input_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='progress_done',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='prediccion',
+            name='progress_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='prediccion',
+            name='stage',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0007_prediccion_progreso'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='prediccion',
+            name='inference_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='prediccion',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='prediccion',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='prediccion',
+            index=models.Index(fields=['status', 'created_at'], name='prediccion_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prediccion',
+            index=models.Index(fields=['created_at'], name='prediccion_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prediccion',
+            index=models.Index(fields=['ia_model', 'created_at'], name='prediccion_modelo_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0008_prediccion_tiempos_indices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='skipped_patches',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0009_prediccion_skipped_patches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='preview_image',
+            field=models.URLField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='prediccion',
+            name='status',
+            field=models.CharField(choices=[('queued', 'En cola'), ('running', 'Procesando'), ('done', 'Terminada'), ('error', 'Error'), ('cancelled', 'Cancelada')], default='queued', max_length=20),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0010_prediccion_vista_previa_cancelada'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='original_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.CreateModel(
+            name='LotePrediccion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, default='', max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('ia_model', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='modelos.ia_model')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='prediccion',
+            name='lote',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='predicciones', to='modelos.loteprediccion'),
+        ),
+    ]
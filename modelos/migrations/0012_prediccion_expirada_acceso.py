@@ -0,0 +1,37 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:17
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+
+def acceso_inicial(apps, schema_editor):
+    # Las filas existentes tomarían la fecha de la migración: usar la de su último uso conocido
+    Prediccion = apps.get_model('modelos', 'Prediccion')
+    Prediccion.objects.update(accessed_at=Coalesce(F('finished_at'), F('created_at')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0011_lote_prediccion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='accessed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(acceso_inicial, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='prediccion',
+            name='status',
+            field=models.CharField(choices=[('queued', 'En cola'), ('running', 'Procesando'), ('done', 'Terminada'), ('error', 'Error'), ('cancelled', 'Cancelada'), ('expired', 'Expirada')], default='queued', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='prediccion',
+            index=models.Index(fields=['status', 'accessed_at'], name='prediccion_acceso_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelos', '0012_prediccion_expirada_acceso'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediccion',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
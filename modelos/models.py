@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from blogs.models import Author
 
 class IA_Model(models.Model):
@@ -15,12 +16,66 @@ class IA_Model(models.Model):
     def __str__(self):
         return self.title
 
+class LotePrediccion(models.Model):
+    # Varias imágenes para un mismo modelo; cada una es una Prediccion con lote=este
+    ia_model = models.ForeignKey(IA_Model, on_delete=models.CASCADE)
+    name = models.CharField(max_length=200, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Lote {self.id} para {self.ia_model.title}"
+
 class Prediccion(models.Model):
+    # Máquina de estados: queued -> running -> done / error; queued o running -> cancelled;
+    # done / error / cancelled -> expired cuando la retención borra sus archivos
+    STATUS_CHOICES = [
+        ('queued', 'En cola'),
+        ('running', 'Procesando'),
+        ('done', 'Terminada'),
+        ('error', 'Error'),
+        ('cancelled', 'Cancelada'),
+        ('expired', 'Expirada'),
+    ]
+
     ia_model = models.ForeignKey(IA_Model, on_delete=models.CASCADE)
+    lote = models.ForeignKey(
+        LotePrediccion, on_delete=models.CASCADE, blank=True, null=True, related_name='predicciones',
+    )
+    original_name = models.CharField(max_length=255, blank=True, default='')  # nombre del archivo subido
     input_image = models.URLField()
     output_image = models.URLField(blank=True, null=True)
+    preview_image = models.URLField(blank=True, null=True)  # resultado a baja resolución, antes del final
+    output_map = models.URLField(blank=True, null=True)  # mapa de probabilidad crudo (.npz / PNG 16 bits)
     created_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=20, default='pending')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    # Avance publicado por el worker: etapa actual y patches procesados / totales
+    stage = models.CharField(max_length=20, blank=True, default='')
+    progress_done = models.PositiveIntegerField(default=0)
+    progress_total = models.PositiveIntegerField(default=0)
+    # Tiempos del trabajo; inference_ms es solo el tiempo dentro del modelo
+    queued_at = models.DateTimeField(blank=True, null=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    # Lo renueva periódicamente el proceso que corre el trabajo: al reiniciar solo
+    # se reencolan las running con el latido vencido (su proceso ya no está)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    inference_ms = models.PositiveIntegerField(blank=True, null=True)
+    skipped_patches = models.PositiveIntegerField(blank=True, null=True)  # salteados por el filtro de fondo
+    # Clave del caché de resultados: sha256 de la imagen + versión del modelo
+    input_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    model_version = models.CharField(max_length=16, blank=True, null=True)
+    # Último uso (creación o consulta del estado), para la retención LRU de MEDIA_ROOT
+    accessed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # status + created_at también sirve para filtrar solo por status
+            # y para recuperar los pendientes en orden al reiniciar
+            models.Index(fields=['status', 'created_at'], name='prediccion_status_idx'),
+            models.Index(fields=['created_at'], name='prediccion_created_idx'),
+            models.Index(fields=['ia_model', 'created_at'], name='prediccion_modelo_idx'),
+            models.Index(fields=['status', 'accessed_at'], name='prediccion_acceso_idx'),
+        ]
 
     def __str__(self):
         return f"Predicción para {self.ia_model.title} en {self.created_at}"    
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""
+Motor de inferencia con micro-batching entre pedidos.
+
+Cuando varios trabajos usan el mismo modelo a la vez, sus lotes de patches se
+juntan en una sola llamada al modelo (hasta `max_batch` patches, esperando como
+máximo `max_espera` segundos) y cada resultado vuelve a su trabajo. Un lote más
+grande que `max_batch` se parte entre llamadas, así el resto de un trabajo
+completa la llamada con patches de otro. Si hay un único trabajo activo no se
+espera: el lote se despacha en cuanto llega.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class _Pedido:
+    """Lote de un trabajo; `enviadas` y `listas` cuentan sus filas despachadas y resueltas."""
+    __slots__ = ("x", "evento", "resultado", "error", "enviadas", "listas")
+
+    def __init__(self, x):
+        self.x = x
+        self.evento = threading.Event()
+        self.resultado = None
+        self.error = None
+        self.enviadas = 0
+        self.listas = 0
+
+    def restantes(self):
+        return len(self.x) - self.enviadas
+
+
+class MotorInferencia:
+    def __init__(self, modelo, max_batch=64, max_espera=0.01):
+        self.modelo = modelo
+        self.max_batch = max_batch
+        self.max_espera = max_espera
+        self._pedidos = deque()
+        self._cond = threading.Condition()
+        self._sesiones = 0
+        self._cerrado = False
+        self.llamadas = 0
+        self.patches = 0
+        self._hilo = threading.Thread(target=self._despachar, name="motor-inferencia", daemon=True)
+        self._hilo.start()
+
+    @contextmanager
+    def sesion(self):
+        """Registra un trabajo activo; mientras haya varios, los lotes se esperan entre sí."""
+        self.abrir_sesion()
+        try:
+            yield self
+        finally:
+            self.cerrar_sesion()
+
+    def abrir_sesion(self):
+        with self._cond:
+            self._sesiones += 1
+
+    def cerrar_sesion(self):
+        """Devuelve las sesiones que siguen abiertas."""
+        with self._cond:
+            self._sesiones -= 1
+            self._cond.notify_all()
+            return self._sesiones
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """Misma interfaz que `model.predict`: bloquea hasta tener las predicciones de `x`."""
+        pedido = _Pedido(x)
+        with self._cond:
+            self._pedidos.append(pedido)
+            self._cond.notify_all()
+        pedido.evento.wait()
+        if pedido.error is not None:
+            raise pedido.error
+        return pedido.resultado
+
+    def cerrar(self):
+        """El hilo termina cuando se vacían los pedidos y las sesiones en curso."""
+        with self._cond:
+            self._cerrado = True
+            self._cond.notify_all()
+
+    def _tomar_lote(self):
+        """
+        Espera pedidos y arma un lote de hasta `max_batch` filas (con el lock
+        tomado). Devuelve tramos (pedido, inicio, fin); un pedido que no entra
+        entero queda al frente con el resto para la llamada siguiente.
+        """
+        while not self._pedidos:
+            if self._cerrado and self._sesiones == 0:
+                return None
+            self._cond.wait()
+
+        # Otros trabajos activos podrían sumar patches: esperar hasta max_espera
+        limite = time.monotonic() + self.max_espera
+        while (
+            sum(p.restantes() for p in self._pedidos) < self.max_batch
+            and len(self._pedidos) < self._sesiones
+        ):
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            self._cond.wait(restante)
+
+        lote = []
+        filas = 0
+        while self._pedidos and filas < self.max_batch:
+            pedido = self._pedidos[0]
+            inicio = pedido.enviadas
+            fin = min(len(pedido.x), inicio + self.max_batch - filas)
+            pedido.enviadas = fin
+            if fin == len(pedido.x) or pedido.error is not None:
+                self._pedidos.popleft()
+            if pedido.error is not None:
+                continue
+            lote.append((pedido, inicio, fin))
+            filas += fin - inicio
+        return lote
+
+    def _despachar(self):
+        while True:
+            with self._cond:
+                lote = self._tomar_lote()
+            if lote is None:
+                return
+            if not lote:
+                continue
+            try:
+                if len(lote) == 1:
+                    pedido, inicio, fin = lote[0]
+                    x = pedido.x[inicio:fin]
+                else:
+                    x = np.concatenate([pedido.x[inicio:fin] for pedido, inicio, fin in lote])
+                preds = self.modelo.predict(x, batch_size=len(x), verbose=0)
+                self.llamadas += 1
+                self.patches += len(x)
+                posicion = 0
+                for pedido, inicio, fin in lote:
+                    parte = preds[posicion:posicion + fin - inicio]
+                    posicion += fin - inicio
+                    if inicio == 0 and fin == len(pedido.x):
+                        pedido.resultado = parte
+                    else:
+                        if pedido.resultado is None:
+                            pedido.resultado = np.empty((len(pedido.x),) + parte.shape[1:], dtype=parte.dtype)
+                        pedido.resultado[inicio:fin] = parte
+                    pedido.listas += fin - inicio
+            except Exception as e:
+                logger.exception("Falló una llamada al modelo")
+                for pedido, _, _ in lote:
+                    pedido.error = e
+            for pedido, _, _ in lote:
+                if pedido.error is not None or pedido.listas == len(pedido.x):
+                    pedido.evento.set()
+
+
+_motores = {}
+_lock = threading.Lock()
+
+
+def _obtener(model_file, modelo):
+    """Motor de `model_file` para `modelo`; se llama con `_lock` tomado."""
+    motor = _motores.get(model_file)
+    if motor is None or motor.modelo is not modelo:
+        if motor is not None:
+            motor.cerrar()
+        motor = MotorInferencia(
+            modelo,
+            max_batch=getattr(settings, 'PREDICCION_MICROBATCH_MAX', 64),
+            max_espera=getattr(settings, 'PREDICCION_MICROBATCH_ESPERA_MS', 10) / 1000,
+        )
+        _motores[model_file] = motor
+    return motor
+
+
+def _cerrar_sesion(model_file, motor):
+    with _lock:
+        if motor.cerrar_sesion() == 0:
+            motor.cerrar()
+            if _motores.get(model_file) is motor:
+                del _motores[model_file]
+
+
+@contextmanager
+def sesion_motor(model_file, modelo):
+    """
+    Sesión en el motor compartido para `model_file`; el motor se reemplaza si
+    el registro recargó el modelo. La sesión se abre con el lock tomado, así
+    otro trabajo no puede cerrar el motor entre que se obtiene y se usa: un
+    motor cerrado sigue atendiendo hasta que terminan sus sesiones.
+
+    El motor vive mientras tenga sesiones: al cerrarse la última se cierra y
+    sale de `_motores`, así no retiene un modelo que el registro ya desalojó.
+    """
+    with _lock:
+        motor = _obtener(model_file, modelo)
+        motor.abrir_sesion()
+    try:
+        yield motor
+    finally:
+        _cerrar_sesion(model_file, motor)
+
+
+def reservar_sesiones(model_file, modelo, cantidad):
+    """
+    Abre `cantidad` sesiones para trabajos que todavía no empezaron (las hijas
+    de un lote que corren juntas): desde ya el motor espera sus patches antes
+    de mandar un lote parcial. Devuelve una función por sesión que la cierra;
+    cada trabajo cierra la suya al abrir su propia sesión, o al terminar si no
+    llegó a usarla. Llamarla más de una vez no hace nada.
+    """
+    with _lock:
+        motor = _obtener(model_file, modelo)
+        for _ in range(cantidad):
+            motor.abrir_sesion()
+
+    def soltador():
+        abierta = [True]
+        lock = threading.Lock()
+
+        def soltar():
+            with lock:
+                if not abierta:
+                    return
+                abierta.clear()
+            _cerrar_sesion(model_file, motor)
+        return soltar
+
+    return [soltador() for _ in range(cantidad)]
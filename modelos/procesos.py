@@ -0,0 +1,271 @@
+"""
+Workers de inferencia en procesos separados (PREDICCION_BACKEND = "procesos").
+
+Cada hilo del ejecutor maneja su propio proceso hijo, que carga los modelos
+en su propio registro y corre `procesar_prediccion` completo: la inferencia no
+compite por el GIL ni por los hilos de TensorFlow con el proceso web, y la
+memoria de cada worker se puede acotar reciclándolo.
+
+La imagen decodificada pasa al hijo en un bloque de
+`multiprocessing.shared_memory` (el array no se serializa) y el hijo escribe
+las salidas en MEDIA_ROOT igual que un hilo; por el pipe solo viajan los
+eventos de `notificar` (más "carga_modelo" y "memoria", que mide el hijo) y
+la URL final. Si `notificar` lanza una excepción (p.ej. PrediccionCancelada)
+se le avisa "cancelar" al hijo, que corta en su próximo aviso. Si el hijo
+muere a mitad de un trabajo se lanza ProcesoCaido y el proceso se vuelve a
+levantar en el próximo trabajo.
+
+El hijo carga los settings del módulo, pero toma del proceso web los que
+deciden dónde lee y escribe (AJUSTES_HEREDADOS), por si se cambiaron en
+tiempo de ejecución.
+"""
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+AJUSTES_HEREDADOS = ("MEDIA_ROOT", "MEDIA_URL", "MODELOS_DIR")
+
+
+class ProcesoCaido(Exception):
+    """El proceso de inferencia terminó sin completar el trabajo."""
+
+    def __init__(self, exitcode):
+        super().__init__(f"El proceso de inferencia terminó con código {exitcode}")
+        self.exitcode = exitcode
+
+
+class ErrorRemoto(Exception):
+    """Excepción ocurrida dentro del proceso de inferencia; incluye su traceback."""
+
+    def __init__(self, mensaje, detalle):
+        super().__init__(f"{mensaje}\n{detalle}")
+
+
+class PeticionRemota:
+    """Reemplazo serializable del request: solo arma las URLs absolutas de las salidas."""
+
+    def __init__(self, origen):
+        self.origen = origen
+
+    @classmethod
+    def desde(cls, request):
+        if request is None:
+            return None
+        return cls(request.build_absolute_uri("/").rstrip("/"))
+
+    def build_absolute_uri(self, ruta):
+        if "://" in ruta:
+            return ruta
+        return f"{self.origen}/{ruta.lstrip('/')}"
+
+
+def _configurar_hilos(intra, inter):
+    """Hilos de TensorFlow/TFLite del hijo; tiene que correr antes de importar TensorFlow."""
+    from django.conf import settings
+
+    if intra:
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(intra)
+        os.environ["OMP_NUM_THREADS"] = str(intra)
+        settings.PREDICCION_TFLITE_HILOS = intra
+    if inter:
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(inter)
+
+
+def _principal(conexion, hilos_intra, hilos_inter, max_rss, ajustes=None):
+    """Bucle del proceso hijo: recibe tareas por `conexion` hasta recibir None."""
+    import django
+
+    django.setup()
+    _configurar_hilos(hilos_intra, hilos_inter)
+
+    from django.conf import settings
+    for nombre, valor in (ajustes or {}).items():
+        setattr(settings, nombre, valor)
+    from albertidl.metrics import PicoRSS, rss_actual
+    from capa_nitrurada.testing_model import PrediccionCancelada, procesar_prediccion
+    from .registro import registro
+
+    if getattr(settings, "MODELOS_REGISTRO_PRECARGA", False):
+        registro.precargar()
+
+    while True:
+        try:
+            tarea = conexion.recv()
+        except EOFError:
+            return
+        if tarea is None:
+            return
+        if tarea == "cancelar":
+            continue  # llegó cuando el trabajo ya había terminado
+
+        def notificar(evento, **datos):
+            conexion.send(("evento", evento, datos))
+            if conexion.poll() and conexion.recv() == "cancelar":
+                raise PrediccionCancelada()
+
+        bloque = imagen = entrada = None
+        try:
+            if tarea["imagen"] is not None:
+                nombre, shape, dtype = tarea["imagen"]
+                bloque = shared_memory.SharedMemory(name=nombre)
+                imagen = np.ndarray(shape, dtype=dtype, buffer=bloque.buf)
+            with PicoRSS() as memoria:
+                inicio = time.monotonic()
+                model = registro.get(tarea["model_file"])
+                notificar("carga_modelo", segundos=time.monotonic() - inicio)
+                if model is None:
+                    raise FileNotFoundError(f"El modelo '{tarea['model_file']}.h5' no existe.")
+                entrada = imagen if imagen is not None else tarea["input_path"]
+                url = procesar_prediccion(entrada, model, tarea["request"], notificar=notificar, **tarea["opciones"])
+            if memoria.pico is not None:
+                notificar("memoria", pico=memoria.pico)
+            reciclar = bool(max_rss) and (rss_actual() or 0) > max_rss
+            conexion.send(("fin", url, reciclar))
+        except Exception as e:
+            reciclar = False
+            conexion.send(("error", f"{type(e).__name__}: {e}", traceback.format_exc()))
+        finally:
+            del imagen, entrada
+            if bloque is not None:
+                bloque.close()
+        if reciclar:
+            logger.info("Proceso de inferencia %d supera el RSS máximo, se recicla", os.getpid())
+            return
+
+
+class ProcesoInferencia:
+    """Lado del proceso web de un worker hijo; no es thread-safe (un hilo por proceso)."""
+
+    def __init__(self, nombre, hilos_intra=None, hilos_inter=None, max_rss=None):
+        self.nombre = nombre
+        self.hilos_intra = hilos_intra
+        self.hilos_inter = hilos_inter
+        self.max_rss = max_rss
+        self.reinicios = 0
+        self._proceso = None
+        self._conexion = None
+
+    @property
+    def pid(self):
+        return self._proceso.pid if self._proceso is not None else None
+
+    def vivo(self):
+        return self._proceso is not None and self._proceso.is_alive()
+
+    def iniciar(self):
+        if self.vivo():
+            return
+        if self._proceso is not None:
+            self._cerrar_conexion()
+        from django.conf import settings
+        ajustes = {nombre: getattr(settings, nombre) for nombre in AJUSTES_HEREDADOS if hasattr(settings, nombre)}
+        # spawn: el hijo no hereda hilos ni el estado de TensorFlow del proceso web
+        contexto = multiprocessing.get_context("spawn")
+        self._conexion, hijo = contexto.Pipe()
+        self._proceso = contexto.Process(
+            target=_principal, args=(hijo, self.hilos_intra, self.hilos_inter, self.max_rss, ajustes),
+            name=self.nombre, daemon=True,
+        )
+        self._proceso.start()
+        hijo.close()
+        logger.info("Proceso de inferencia %s iniciado (pid %s)", self.nombre, self._proceso.pid)
+
+    def detener(self, timeout=5):
+        if self.vivo():
+            try:
+                self._conexion.send(None)
+            except OSError:
+                pass
+            self._proceso.join(timeout)
+            if self._proceso.is_alive():
+                self._proceso.terminate()
+                self._proceso.join()
+        self._cerrar_conexion()
+        self._proceso = None
+
+    def _cerrar_conexion(self):
+        if self._conexion is not None:
+            self._conexion.close()
+            self._conexion = None
+
+    def ejecutar(self, model_file, entrada, request, opciones, notificar):
+        """
+        Corre procesar_prediccion en el hijo y devuelve la URL de salida.
+        `entrada` es un array uint8 (va por memoria compartida) o una ruta.
+        Los eventos del hijo se pasan a `notificar` en este hilo.
+        """
+        if not self.vivo():
+            if self._proceso is not None:
+                self.reinicios += 1
+            self.iniciar()
+
+        bloque = None
+        tarea = {
+            "model_file": model_file,
+            "request": PeticionRemota.desde(request),
+            "opciones": opciones,
+            "imagen": None,
+            "input_path": None,
+        }
+        try:
+            if isinstance(entrada, np.ndarray):
+                bloque = shared_memory.SharedMemory(create=True, size=max(entrada.nbytes, 1))
+                np.ndarray(entrada.shape, dtype=entrada.dtype, buffer=bloque.buf)[...] = entrada
+                tarea["imagen"] = (bloque.name, entrada.shape, entrada.dtype.str)
+            else:
+                tarea["input_path"] = entrada
+            self._enviar(tarea)
+
+            while True:
+                mensaje = self._recibir()
+                if mensaje[0] == "evento":
+                    try:
+                        notificar(mensaje[1], **mensaje[2])
+                    except BaseException:
+                        self._cancelar()
+                        raise
+                elif mensaje[0] == "fin":
+                    if mensaje[2]:
+                        self._proceso.join()
+                    return mensaje[1]
+                else:
+                    raise ErrorRemoto(mensaje[1], mensaje[2])
+        finally:
+            if bloque is not None:
+                bloque.close()
+                bloque.unlink()
+
+    def _cancelar(self):
+        """Pide al hijo que corte el trabajo y espera a que quede libre."""
+        self._enviar("cancelar")
+        while True:
+            mensaje = self._recibir()
+            if mensaje[0] == "fin" and mensaje[2]:
+                self._proceso.join()
+            if mensaje[0] != "evento":
+                return
+
+    def _enviar(self, tarea):
+        try:
+            self._conexion.send(tarea)
+        except OSError:
+            raise ProcesoCaido(self._proceso.exitcode)
+
+    def _recibir(self, intervalo=0.5):
+        """Espera el próximo mensaje revisando que el hijo siga vivo."""
+        while True:
+            try:
+                if self._conexion.poll(intervalo):
+                    return self._conexion.recv()
+            except (EOFError, OSError):
+                self._proceso.join(1)
+                raise ProcesoCaido(self._proceso.exitcode)
+            if not self._proceso.is_alive():
+                raise ProcesoCaido(self._proceso.exitcode)
@@ -0,0 +1,248 @@
+"""
+Progreso de las predicciones publicado por los workers para las vistas async.
+
+Los workers (hilos) publican el estado de cada `Prediccion` en un canal en
+memoria y despiertan a las vistas suscriptas de su event loop con
+`call_soon_threadsafe`. El progreso también se guarda en la base para que lo
+vean otros procesos y el endpoint de estado: el último avance de cada trabajo
+se acumula en memoria y un único hilo escribe el de todos los trabajos en una
+sola transacción cada `PREDICCION_PROGRESO_INTERVALO` segundos, en vez de que
+cada worker compita por el lock de escritura de SQLite.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+
+from capa_nitrurada.testing_model import PrediccionCancelada
+from .metricas import progreso_escrituras_total, progreso_filas_total
+from .models import Prediccion
+
+logger = logging.getLogger(__name__)
+
+TERMINALES = ('done', 'error', 'cancelled', 'expired')
+
+CAMPOS = ('status', 'stage', 'progress_done', 'progress_total', 'preview_image', 'output_image', 'output_map')
+
+
+def estado_db(prediccion_id):
+    """Estado de la predicción leído de la base, o None si no existe."""
+    return Prediccion.objects.filter(id=prediccion_id).values('id', *CAMPOS).first()
+
+
+def version_estado(estado):
+    """Identificador corto del estado, para que el cliente pida solo cambios."""
+    datos = json.dumps([estado.get(campo) for campo in CAMPOS], default=str)
+    return hashlib.sha1(datos.encode()).hexdigest()[:12]
+
+
+class CanalProgreso:
+    """Último estado conocido de cada predicción y sus suscriptores async."""
+
+    def __init__(self, max_estados=1024):
+        self.max_estados = max_estados
+        self._estados = OrderedDict()
+        self._suscriptores = {}
+        self._lock = threading.Lock()
+
+    def publicar(self, prediccion_id, **datos):
+        """Actualiza el estado (desde cualquier hilo) y despierta a los suscriptores."""
+        with self._lock:
+            estado = self._estados.pop(prediccion_id, None) or {'id': prediccion_id}
+            estado.update(datos)
+            self._estados[prediccion_id] = estado
+            while len(self._estados) > self.max_estados:
+                self._estados.popitem(last=False)
+            suscriptores = list(self._suscriptores.get(prediccion_id, ()))
+        for loop, evento in suscriptores:
+            try:
+                loop.call_soon_threadsafe(evento.set)
+            except RuntimeError:
+                pass  # el loop ya se cerró
+
+    def estado(self, prediccion_id):
+        with self._lock:
+            estado = self._estados.get(prediccion_id)
+            return dict(estado) if estado is not None else None
+
+    def suscribir(self, prediccion_id):
+        """asyncio.Event del loop actual que se activa con cada publicación."""
+        evento = asyncio.Event()
+        with self._lock:
+            self._suscriptores.setdefault(prediccion_id, set()).add((asyncio.get_running_loop(), evento))
+        return evento
+
+    def desuscribir(self, prediccion_id, evento):
+        with self._lock:
+            suscriptores = self._suscriptores.get(prediccion_id, set())
+            suscriptores.discard((asyncio.get_running_loop(), evento))
+            if not suscriptores:
+                self._suscriptores.pop(prediccion_id, None)
+
+
+class EscritorProgreso:
+    """
+    Escritura agrupada del progreso en la base. `anotar` guarda el último
+    avance de cada predicción y un hilo los escribe todos juntos cada
+    `intervalo` segundos. Las filas que ya no están en 'running' quedan
+    marcadas como canceladas para que el worker corte. Si la escritura falla
+    (p.ej. "database is locked"), el avance se conserva para la próxima.
+    """
+
+    def __init__(self, intervalo=1.0):
+        self.intervalo = intervalo
+        self._pendientes = {}
+        self._canceladas = set()
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def anotar(self, prediccion_id, datos):
+        with self._lock:
+            self._pendientes.setdefault(prediccion_id, {}).update(datos)
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, name="progreso-db", daemon=True)
+                self._hilo.start()
+
+    def cancelada(self, prediccion_id):
+        with self._lock:
+            return prediccion_id in self._canceladas
+
+    def descartar(self, prediccion_id):
+        """El trabajo terminó: su escritura final ya incluye el último avance."""
+        with self._lock:
+            self._pendientes.pop(prediccion_id, None)
+            self._canceladas.discard(prediccion_id)
+
+    def vaciar(self):
+        """Escribe el avance pendiente en una transacción; devuelve las filas actualizadas."""
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+        if not pendientes:
+            return 0
+        canceladas = []
+        try:
+            with transaction.atomic():
+                for prediccion_id, datos in pendientes.items():
+                    if not Prediccion.objects.filter(id=prediccion_id, status='running').update(**datos):
+                        canceladas.append(prediccion_id)
+        except DatabaseError:
+            logger.warning("No se pudo escribir el progreso de %d predicciones", len(pendientes), exc_info=True)
+            with self._lock:
+                for prediccion_id, datos in pendientes.items():
+                    self._pendientes[prediccion_id] = {**datos, **self._pendientes.get(prediccion_id, {})}
+            return 0
+        progreso_escrituras_total.inc()
+        progreso_filas_total.inc(valor=len(pendientes))
+        with self._lock:
+            self._canceladas.update(canceladas)
+        return len(pendientes) - len(canceladas)
+
+    def _bucle(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.vaciar()
+            except Exception:
+                logger.exception("Error escribiendo el progreso")
+            finally:
+                # La conexión de este hilo no pasa por request_finished
+                close_old_connections()
+
+
+class PublicadorProgreso:
+    """
+    Callback `notificar` de un trabajo: publica cada evento en el canal y
+    anota el progreso en el escritor agrupado. `ultimo` guarda el avance
+    completo para incluirlo en la escritura final del trabajo.
+
+    Si la predicción se canceló lanza PrediccionCancelada, que corta el
+    pipeline: en este proceso se ve enseguida en el canal, y si se canceló
+    desde otro proceso, después de la próxima escritura del escritor (que ya
+    no encuentra la fila en 'running').
+    """
+
+    def __init__(self, prediccion_id, canal, escritor):
+        self.prediccion_id = prediccion_id
+        self.canal = canal
+        self.escritor = escritor
+        self.ultimo = {}
+
+    def progreso(self, etapa, hechos=None, total=None):
+        datos = {'stage': etapa}
+        if hechos is not None:
+            datos['progress_done'] = hechos
+        if total is not None:
+            datos['progress_total'] = total
+        self.ultimo.update(datos)
+        self.verificar()
+        self.canal.publicar(self.prediccion_id, status='running', **datos)
+        self.escritor.anotar(self.prediccion_id, datos)
+
+    def verificar(self):
+        estado = self.canal.estado(self.prediccion_id)
+        if estado is not None and estado.get('status') == 'cancelled':
+            raise PrediccionCancelada()
+        if self.escritor.cancelada(self.prediccion_id):
+            raise PrediccionCancelada()
+
+    def cerrar(self):
+        self.escritor.descartar(self.prediccion_id)
+
+
+canal_progreso = CanalProgreso()
+escritor_progreso = EscritorProgreso(intervalo=getattr(settings, 'PREDICCION_PROGRESO_INTERVALO', 1.0))
+
+
+def publicador(prediccion_id):
+    return PublicadorProgreso(prediccion_id, canal_progreso, escritor_progreso)
+
+
+async def leer_estado(prediccion_id):
+    """Estado del canal si el trabajo corre en este proceso; si no, el de la base."""
+    estado = canal_progreso.estado(prediccion_id)
+    if estado is None:
+        estado = await sync_to_async(estado_db)(prediccion_id)
+    return estado
+
+
+async def cambios_estado(prediccion_id, version=None, limite=30.0):
+    """
+    Generador async de (estado, version) cada vez que cambia el estado, hasta
+    que la predicción termina o pasan `limite` segundos. Si no hay cambios en
+    `PREDICCION_EVENTOS_INTERVALO_DB` segundos vuelve a leer la base (trabajos
+    de otros procesos) y entrega (None, version) como latido.
+    """
+    intervalo = getattr(settings, 'PREDICCION_EVENTOS_INTERVALO_DB', 2.0)
+    loop = asyncio.get_running_loop()
+    fin = loop.time() + limite
+    evento = canal_progreso.suscribir(prediccion_id)
+    try:
+        while True:
+            # Limpiar antes de leer: una publicación posterior no se pierde
+            evento.clear()
+            estado = await leer_estado(prediccion_id)
+            if estado is None:
+                return
+            actual = version_estado(estado)
+            if actual != version:
+                version = actual
+                yield estado, version
+            if estado['status'] in TERMINALES:
+                return
+            restante = fin - loop.time()
+            if restante <= 0:
+                return
+            try:
+                async with asyncio.timeout(min(restante, intervalo)):
+                    await evento.wait()
+            except TimeoutError:
+                yield None, version
+    finally:
+        canal_progreso.desuscribir(prediccion_id, evento)
@@ -0,0 +1,333 @@
+"""
+Registro de modelos cargados en memoria, compartido por todo el proceso.
+
+Los modelos se identifican por `IA_Model.model_file`. Se mantienen en memoria
+hasta `MODELOS_REGISTRO_MAX_MODELOS` modelos o `MODELOS_REGISTRO_MAX_BYTES`
+bytes, desalojando el menos usado, y se recargan si el archivo cambia.
+
+Los límites son nominales: los bytes son una estimación de los pesos (sin
+activaciones ni memoria del runtime) y un modelo tomado con `usar()` no se
+desaloja hasta que se suelta, porque sacarlo del registro no libera memoria
+mientras un trabajo lo usa y el siguiente pedido cargaría una segunda copia.
+Con varios modelos en uso a la vez el registro puede quedar sobre el límite;
+se ajusta al soltarlos.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def directorio_modelos():
+    return getattr(settings, "MODELOS_DIR", os.path.join(settings.BASE_DIR, "capa_nitrurada", "modelos"))
+
+
+def ruta_modelo(model_file):
+    return os.path.join(directorio_modelos(), f"{model_file}.h5")
+
+
+def ruta_tflite(model_file):
+    return os.path.join(directorio_modelos(), f"{model_file}.tflite")
+
+
+def ruta_savedmodel(model_file):
+    return os.path.join(directorio_modelos(), f"{model_file}_savedmodel")
+
+
+def ruta_servida(model_file):
+    """
+    Archivo que se usa para servir el modelo: el artefacto optimizado de
+    `exportar_modelo` si existe y no es más viejo que el .h5, o el .h5.
+    Devuelve None si no hay ninguno.
+    """
+    h5 = ruta_modelo(model_file)
+    mtime_h5 = os.path.getmtime(h5) if os.path.exists(h5) else None
+    if getattr(settings, "PREDICCION_USAR_OPTIMIZADO", True):
+        for path in (ruta_tflite(model_file), ruta_savedmodel(model_file)):
+            if os.path.exists(path) and (mtime_h5 is None or os.path.getmtime(path) >= mtime_h5):
+                return path
+    return h5 if mtime_h5 is not None else None
+
+
+def version_modelo(model_file):
+    """
+    Identificador corto de la versión servida del modelo (artefacto, mtime y
+    tamaño) y de los ajustes que cambian sus salidas: es la clave del caché
+    de resultados, así que un cambio de ventana o de formato no devuelve
+    resultados viejos.
+    """
+    path = ruta_servida(model_file)
+    if path is None:
+        return None
+    st = os.stat(path)
+    firma = f"{os.path.basename(path)}:{st.st_mtime_ns}:{st.st_size}"
+    firma += ":" + repr((
+        getattr(settings, "PREDICCION_VENTANA", "plana"),
+        getattr(settings, "PREDICCION_FORMATO_MAPA", None),
+        getattr(settings, "PREDICCION_RENDER_MAX_LADO", None),
+    ))
+    # Cambiar los umbrales del filtro de fondo cambia los resultados
+    filtro = getattr(settings, "PREDICCION_FILTRO_PATCHES", {}).get(model_file)
+    if filtro:
+        firma += f":{sorted(filtro.items())}"
+    return hashlib.sha1(firma.encode()).hexdigest()[:16]
+
+
+def hash_archivo(path, bloque=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for datos in iter(lambda: f.read(bloque), b""):
+            h.update(datos)
+    return h.hexdigest()
+
+
+def cargar_modelo_keras(path):
+    """Carga un .h5 con las funciones personalizadas de capa_nitrurada."""
+    import tensorflow as tf
+    from tensorflow.keras.models import load_model
+    from capa_nitrurada.perdidas import shape_aware_loss, iou_metric
+
+    # Solo aplicar memory growth si hay GPU
+    gpus = tf.config.list_physical_devices('GPU')
+    if gpus:
+        try:
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, True)
+        except RuntimeError as e:
+            logger.warning("No se pudo setear memory growth: %s", e)
+
+    return load_model(
+        path,
+        custom_objects={"shape_aware_loss": shape_aware_loss, "iou_metric": iou_metric}
+    )
+
+
+def cargar_modelo(path):
+    """Elige el backend según el artefacto: .tflite, SavedModel (directorio) o .h5."""
+    from .backends import ModeloSavedModel, ModeloTFLite
+
+    if path.endswith(".tflite"):
+        return ModeloTFLite(path, num_threads=getattr(settings, "PREDICCION_TFLITE_HILOS", None))
+    if os.path.isdir(path):
+        return ModeloSavedModel(path)
+    return cargar_modelo_keras(path)
+
+
+def estimar_bytes(modelo, path):
+    """Bytes que ocupa el modelo en memoria (pesos float32, o el tamaño del archivo)."""
+    try:
+        return int(modelo.count_params()) * 4
+    except Exception:
+        if os.path.isdir(path):
+            return sum(
+                os.path.getsize(os.path.join(raiz, nombre))
+                for raiz, _, nombres in os.walk(path) for nombre in nombres
+            )
+        return os.path.getsize(path)
+
+
+class _Entrada:
+    __slots__ = ("modelo", "firma", "hash", "bytes", "usos")
+
+    def __init__(self, modelo, firma, hash_, bytes_, usos=0):
+        self.modelo = modelo
+        self.firma = firma
+        self.hash = hash_
+        self.bytes = bytes_
+        # Trabajos que lo están usando (usar()); con usos no se desaloja
+        self.usos = usos
+
+
+class _Carga:
+    """Carga en curso: los pedidos concurrentes del mismo modelo esperan el mismo evento."""
+
+    def __init__(self, firma):
+        self.firma = firma
+        self.evento = threading.Event()
+        self.modelo = None
+        self.error = None
+
+
+class RegistroModelos:
+    """Caché LRU thread-safe de modelos, invalidada por cambios en el archivo."""
+
+    def __init__(self, max_modelos=None, max_bytes=None, usar_hash=False, cargador=cargar_modelo):
+        self.max_modelos = max_modelos
+        self.max_bytes = max_bytes
+        self.usar_hash = usar_hash
+        self.cargador = cargador
+        self._entradas = OrderedDict()
+        self._cargas = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.desalojos = 0
+
+    def get(self, model_file):
+        """Devuelve el modelo cargado, o None si el archivo no existe."""
+        return self._obtener(model_file, fijar=False)
+
+    @contextmanager
+    def usar(self, model_file):
+        """
+        Como get(), pero el modelo queda fijado en el registro mientras dura
+        el bloque: no se desaloja aunque se supere el límite.
+        """
+        modelo = self._obtener(model_file, fijar=True)
+        try:
+            yield modelo
+        finally:
+            if modelo is not None:
+                self._soltar(model_file, modelo)
+
+    def _obtener(self, model_file, fijar):
+        path = ruta_servida(model_file)
+        try:
+            st = os.stat(path)
+        except (TypeError, FileNotFoundError):
+            return None
+        firma = (path, st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            entrada = self._entradas.get(model_file)
+            if entrada is not None and entrada.firma == firma:
+                self._entradas.move_to_end(model_file)
+                self.hits += 1
+                entrada.usos += fijar
+                return entrada.modelo
+
+        # El archivo fue reemplazado: si el contenido es el mismo no hace falta recargar
+        if (
+            entrada is not None and self.usar_hash and entrada.firma[0] == path
+            and os.path.isfile(path) and hash_archivo(path) == entrada.hash
+        ):
+            with self._lock:
+                if self._entradas.get(model_file) is entrada:
+                    entrada.firma = firma
+                    self._entradas.move_to_end(model_file)
+                    self.hits += 1
+                    entrada.usos += fijar
+                    return entrada.modelo
+            # Se desalojó mientras se calculaba el hash
+            return self._obtener(model_file, fijar)
+
+        with self._lock:
+            carga = self._cargas.get(model_file)
+            propia = carga is None or carga.firma != firma
+            if propia:
+                carga = _Carga(firma)
+                self._cargas[model_file] = carga
+                self.misses += 1
+
+        if not propia:
+            carga.evento.wait()
+            if carga.error is not None:
+                raise carga.error
+            if not fijar:
+                return carga.modelo
+            # Para fijarlo hace falta la entrada: ya está cargada y es un hit
+            return self._obtener(model_file, fijar)
+
+        try:
+            logger.info("Cargando modelo %s", path)
+            modelo = self.cargador(path)
+            hash_ = hash_archivo(path) if self.usar_hash and os.path.isfile(path) else None
+            with self._lock:
+                self._entradas.pop(model_file, None)
+                self._entradas[model_file] = _Entrada(
+                    modelo, firma, hash_, estimar_bytes(modelo, path), usos=int(fijar),
+                )
+                self._desalojar()
+            carga.modelo = modelo
+            return modelo
+        except BaseException as e:
+            carga.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._cargas.get(model_file) is carga:
+                    del self._cargas[model_file]
+            carga.evento.set()
+
+    def _soltar(self, model_file, modelo):
+        with self._lock:
+            entrada = self._entradas.get(model_file)
+            # Si el registro lo recargó, la entrada vieja ya no está
+            if entrada is not None and entrada.modelo is modelo:
+                entrada.usos -= 1
+                self._desalojar()
+
+    def _desalojar(self):
+        """
+        Desaloja los modelos menos usados hasta respetar los límites (con el
+        lock tomado). Nunca desaloja los que están en uso ni el más reciente.
+        """
+        while len(self._entradas) > 1:
+            total = sum(e.bytes for e in self._entradas.values())
+            excede_cantidad = self.max_modelos is not None and len(self._entradas) > self.max_modelos
+            excede_bytes = self.max_bytes is not None and total > self.max_bytes
+            if not (excede_cantidad or excede_bytes):
+                break
+            libres = [mf for mf, e in list(self._entradas.items())[:-1] if not e.usos]
+            if not libres:
+                logger.info("Registro de modelos sobre el límite: los modelos restantes están en uso")
+                break
+            del self._entradas[libres[0]]
+            self.desalojos += 1
+            logger.info("Modelo %s desalojado del registro", libres[0])
+
+    def descartar(self, model_file=None):
+        """Quita un modelo (o todos) del registro."""
+        with self._lock:
+            if model_file is None:
+                self._entradas.clear()
+            else:
+                self._entradas.pop(model_file, None)
+
+    def cargados(self):
+        with self._lock:
+            return list(self._entradas)
+
+    def precargar(self, model_files=None, inferencia=True):
+        """Carga los modelos y opcionalmente corre una inferencia de prueba."""
+        if model_files is None:
+            from .models import IA_Model
+            model_files = (
+                IA_Model.objects.exclude(model_file__isnull=True).exclude(model_file="")
+                .values_list("model_file", flat=True).distinct()
+            )
+        for model_file in model_files:
+            try:
+                modelo = self.get(model_file)
+                if modelo is None:
+                    logger.warning("Precarga: no existe %s", ruta_modelo(model_file))
+                    continue
+                if inferencia:
+                    entrada = np.zeros((1,) + tuple(modelo.input_shape[1:]), dtype=np.float32)
+                    modelo.predict(entrada, verbose=0)
+                logger.info("Precarga de %s completa", model_file)
+            except Exception:
+                logger.exception("Falló la precarga de %s", model_file)
+
+
+registro = RegistroModelos(
+    max_modelos=getattr(settings, "MODELOS_REGISTRO_MAX_MODELOS", 2),
+    max_bytes=getattr(settings, "MODELOS_REGISTRO_MAX_BYTES", None),
+    usar_hash=getattr(settings, "MODELOS_REGISTRO_USAR_HASH", False),
+)
+
+
+def iniciar_precarga():
+    """Lanza la precarga en segundo plano si MODELOS_REGISTRO_PRECARGA está activo."""
+    if not getattr(settings, "MODELOS_REGISTRO_PRECARGA", False):
+        return None
+    hilo = threading.Thread(target=registro.precargar, name="precarga-modelos", daemon=True)
+    hilo.start()
+    return hilo
@@ -0,0 +1,296 @@
+"""
+Retención de MEDIA_ROOT con presupuesto de bytes y de edad.
+
+Las predicciones terminadas se expiran en orden LRU según `accessed_at` (la
+creación o la última consulta de su estado, individual, por SSE, long-poll,
+lote o listado, que se anota en memoria y se escribe agrupada): pasan a status 'expired' con las URLs de salida en NULL y
+se borran sus archivos. Un archivo se borra recién cuando ninguna predicción
+no expirada lo referencia: el caché de resultados y las entradas nombradas
+por sha256 comparten archivos entre filas, y esas filas siempre tienen el
+mismo `input_hash`, así que la verificación usa su índice.
+
+El barrido avanza por lotes chicos y corta al agotar `max_segundos`; el
+siguiente sigue donde quedó. Se corre con `manage.py retencion_media` o cada
+MEDIA_RETENCION_INTERVALO segundos en el proceso web.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+
+from .metricas import retencion_bytes_total, retencion_expiradas_total
+from .models import Prediccion
+from .trabajos import ruta_media
+
+logger = logging.getLogger(__name__)
+
+# Estados que se pueden expirar: queued y running todavía usan sus archivos
+RETENIBLES = ('done', 'error', 'cancelled')
+CAMPOS_URL = ('input_image', 'output_image', 'preview_image', 'output_map')
+# Variantes de albertidl/media.py que se borran junto con el archivo
+SUFIJOS_VARIANTES = ('', '.gz', '.br')
+
+
+class RegistroAccesos:
+    """
+    Consultas a predicciones pendientes de escribir en `accessed_at`. Se
+    escriben todas juntas en un UPDATE cada `intervalo` segundos, para no
+    sumar una escritura a cada lectura del estado.
+    """
+
+    def __init__(self, intervalo=60.0):
+        self.intervalo = intervalo
+        self._ids = set()
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def anotar(self, *ids):
+        with self._lock:
+            self._ids.update(ids)
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, name="accesos-db", daemon=True)
+                self._hilo.start()
+
+    def vaciar(self):
+        with self._lock:
+            ids, self._ids = self._ids, set()
+        if not ids:
+            return 0
+        try:
+            return Prediccion.objects.filter(id__in=ids).update(accessed_at=timezone.now())
+        except DatabaseError:
+            logger.warning("No se pudieron registrar %d accesos", len(ids), exc_info=True)
+            with self._lock:
+                self._ids.update(ids)
+            return 0
+
+    def _bucle(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.vaciar()
+            except Exception:
+                logger.exception("Error registrando accesos")
+            finally:
+                close_old_connections()
+
+
+def uso_media(raiz=None):
+    """Bytes ocupados por los archivos de MEDIA_ROOT."""
+    total = 0
+    pendientes = [raiz or settings.MEDIA_ROOT]
+    while pendientes:
+        try:
+            entradas = os.scandir(pendientes.pop())
+        except FileNotFoundError:
+            continue
+        with entradas:
+            for entrada in entradas:
+                try:
+                    if entrada.is_dir(follow_symlinks=False):
+                        pendientes.append(entrada.path)
+                    elif entrada.is_file(follow_symlinks=False):
+                        total += entrada.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    pass
+    return total
+
+
+def borrar_archivo(ruta):
+    """Borra el archivo y sus variantes precomprimidas; devuelve los bytes liberados."""
+    liberados = 0
+    for sufijo in SUFIJOS_VARIANTES:
+        try:
+            liberados += os.stat(ruta + sufijo).st_size
+            os.remove(ruta + sufijo)
+        except FileNotFoundError:
+            pass
+    return liberados
+
+
+class Retencion:
+    def __init__(self, max_bytes=None, max_dias=None, lote=200, max_segundos=5.0):
+        self.max_bytes = max_bytes
+        self.max_dias = max_dias
+        self.lote = lote
+        self.max_segundos = max_segundos
+
+    def barrer(self, simular=False):
+        """
+        Expira predicciones hasta cumplir los presupuestos o agotar el tiempo:
+        primero las no usadas en `max_dias`, después las menos usadas mientras
+        MEDIA_ROOT supere `max_bytes`. Con `simular` no se toca nada y solo se
+        estima lo que se liberaría.
+        """
+        fin = time.monotonic() + self.max_segundos
+        accesos.vaciar()
+        resultado = {'expiradas': 0, 'archivos': 0, 'bytes_liberados': 0, 'completo': True}
+        candidatas = Prediccion.objects.filter(status__in=RETENIBLES).order_by('accessed_at', 'id')
+
+        if self.max_dias is not None:
+            limite = timezone.now() - timedelta(days=self.max_dias)
+            for preds in self._lotes(candidatas.filter(accessed_at__lt=limite), simular):
+                if time.monotonic() > fin:
+                    resultado['completo'] = False
+                    return resultado
+                self._expirar(preds, resultado, simular)
+
+        if self.max_bytes is not None:
+            uso = uso_media()
+            resultado['uso_inicial'] = uso
+            if uso > self.max_bytes:
+                for preds in self._lotes(candidatas, simular):
+                    if time.monotonic() > fin:
+                        resultado['completo'] = False
+                        break
+                    uso -= self._expirar(preds, resultado, simular)
+                    if uso <= self.max_bytes:
+                        break
+            resultado['uso_final'] = uso
+        return resultado
+
+    def _lotes(self, consulta, simular):
+        """Lotes de `lote` filas en orden LRU."""
+        if simular:
+            lote = []
+            for pred in consulta.iterator(chunk_size=self.lote):
+                lote.append(pred)
+                if len(lote) == self.lote:
+                    yield lote
+                    lote = []
+            if lote:
+                yield lote
+            return
+        # Cada lote expirado sale de la consulta: siempre se vuelve a leer el principio
+        while preds := list(consulta[:self.lote]):
+            yield preds
+
+    def _expirar(self, preds, resultado, simular=False):
+        ids = [pred.id for pred in preds]
+        urls = {getattr(pred, campo) for pred in preds for campo in CAMPOS_URL} - {None, ''}
+        hashes = {pred.input_hash for pred in preds if pred.input_hash}
+
+        if simular:
+            expiradas = len(ids)
+            liberados, archivos = self._borrar(urls, hashes, ids, simular)
+        else:
+            # La expiración, la búsqueda de referencias y el borrado van en una sola
+            # transacción: en SQLite (IMMEDIATE) toma el lock de escritura, así una
+            # copia del caché o una subida de la misma imagen que cree una fila
+            # nueva queda antes (y se ve como referencia) o después (y ve la
+            # expiración o vuelve a publicar la entrada)
+            with transaction.atomic():
+                # Solo las que siguen terminadas: una cancelada o reencolada en el medio no se toca
+                expiradas = Prediccion.objects.filter(id__in=ids, status__in=RETENIBLES).update(
+                    status='expired', output_image=None, preview_image=None, output_map=None,
+                )
+                liberados, archivos = self._borrar(urls, hashes, ids, simular)
+
+        resultado['expiradas'] += expiradas
+        resultado['archivos'] += archivos
+        resultado['bytes_liberados'] += liberados
+        if not simular:
+            retencion_expiradas_total.inc(valor=expiradas)
+            retencion_bytes_total.inc(valor=liberados)
+        return liberados
+
+    def _borrar(self, urls, hashes, ids, simular):
+        """Borra los archivos de `urls` que ninguna fila no expirada usa; devuelve (bytes, archivos)."""
+        # Archivos que siguen en uso por otra fila (caché, misma entrada, o una que no se expiró)
+        vivas = set()
+        if hashes:
+            referencias = (
+                Prediccion.objects.filter(input_hash__in=hashes).exclude(status='expired')
+                .exclude(id__in=ids if simular else []).values_list(*CAMPOS_URL)
+            )
+            for fila in referencias:
+                vivas.update(fila)
+
+        liberados = archivos = 0
+        for url in urls - vivas:
+            ruta = ruta_media(url)
+            if simular:
+                tamano = sum(
+                    os.path.getsize(ruta + sufijo) for sufijo in SUFIJOS_VARIANTES if os.path.exists(ruta + sufijo)
+                )
+            else:
+                tamano = borrar_archivo(ruta)
+            if tamano:
+                archivos += 1
+                liberados += tamano
+        return liberados, archivos
+
+    def huerfanos(self, max_dias, simular=False):
+        """
+        Archivos de MEDIA_ROOT sin ninguna predicción no expirada que los
+        referencie y sin modificar en `max_dias` (salidas de versiones viejas,
+        temporales .part de uploads cortados). Recorre toda la tabla: es para
+        el comando, no para el barrido periódico.
+        """
+        usados = set()
+        filas = Prediccion.objects.exclude(status='expired').values_list(*CAMPOS_URL)
+        for fila in filas.iterator(chunk_size=2000):
+            usados.update(os.path.normpath(ruta_media(url)) for url in fila if url)
+
+        limite = time.time() - max_dias * 86400
+        resultado = {'archivos': 0, 'bytes_liberados': 0}
+        for carpeta, _, nombres in os.walk(settings.MEDIA_ROOT):
+            for nombre in nombres:
+                ruta = os.path.normpath(os.path.join(carpeta, nombre))
+                base = ruta[:-3] if ruta.endswith(('.gz', '.br')) else ruta
+                try:
+                    st = os.stat(ruta)
+                except FileNotFoundError:
+                    continue
+                if base in usados or st.st_mtime > limite:
+                    continue
+                if not simular:
+                    try:
+                        os.remove(ruta)
+                    except FileNotFoundError:
+                        continue
+                resultado['archivos'] += 1
+                resultado['bytes_liberados'] += st.st_size
+        if not simular:
+            retencion_bytes_total.inc(valor=resultado['bytes_liberados'])
+        return resultado
+
+
+def retencion():
+    return Retencion(
+        max_bytes=getattr(settings, 'MEDIA_RETENCION_MAX_BYTES', None),
+        max_dias=getattr(settings, 'MEDIA_RETENCION_MAX_DIAS', None),
+        lote=getattr(settings, 'MEDIA_RETENCION_LOTE', 200),
+        max_segundos=getattr(settings, 'MEDIA_RETENCION_MAX_SEGUNDOS', 5.0),
+    )
+
+
+def iniciar_barrido(intervalo):
+    """Barrido periódico en un hilo del proceso web; cada pasada dura a lo sumo MEDIA_RETENCION_MAX_SEGUNDOS."""
+
+    def bucle():
+        while True:
+            time.sleep(intervalo)
+            try:
+                resultado = retencion().barrer()
+                if resultado['expiradas']:
+                    logger.info(
+                        "Retención: %d predicciones expiradas, %d archivos y %d bytes liberados",
+                        resultado['expiradas'], resultado['archivos'], resultado['bytes_liberados'],
+                    )
+            except Exception:
+                logger.exception("Error en el barrido de retención")
+            finally:
+                close_old_connections()
+
+    hilo = threading.Thread(target=bucle, name="retencion-media", daemon=True)
+    hilo.start()
+    return hilo
+
+
+accesos = RegistroAccesos(intervalo=getattr(settings, 'PREDICCION_ACCESOS_INTERVALO', 60.0))
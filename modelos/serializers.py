@@ -1,7 +1,16 @@
 from rest_framework import serializers
-from .models import IA_Model
+from .models import IA_Model, Prediccion
 
 class IA_ModelSerializer(serializers.ModelSerializer):    
     class Meta:
         model = IA_Model
         fields = '__all__'
+
+class PrediccionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Prediccion
+        fields = [
+            'id', 'ia_model', 'lote', 'original_name', 'status', 'stage', 'progress_done', 'progress_total',
+            'input_image', 'preview_image', 'output_image', 'output_map', 'created_at',
+            'queued_at', 'started_at', 'finished_at', 'inference_ms', 'skipped_patches',
+        ]
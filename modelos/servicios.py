@@ -0,0 +1,17 @@
+"""Servicios de inferencia que arrancan junto con la aplicación WSGI/ASGI."""
+from django.conf import settings
+
+from .registro import iniciar_precarga
+from .retencion import iniciar_barrido
+from .trabajos import ejecutor
+
+
+def iniciar_servicios():
+    """
+    Precarga los modelos y levanta el pool de workers, recuperando los trabajos
+    pendientes, y el barrido de retención de MEDIA_ROOT si está configurado.
+    """
+    iniciar_precarga()
+    ejecutor.iniciar()
+    if getattr(settings, 'MEDIA_RETENCION_INTERVALO', None):
+        iniciar_barrido(settings.MEDIA_RETENCION_INTERVALO)
@@ -1,3 +1,1377 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, close_old_connections, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from capa_nitrurada.bandas import LectorBandas
+from capa_nitrurada.testing_model import (
+    PrediccionCancelada,
+    LUT_REDS, AcumuladorMosaico, aplicar_colormap, calcular_inicios, generar_patches_img, guardar_png,
+    iterar_lotes_patches, iterar_lotes_region, procesar_prediccion, realce_asimetrico,
+)
+from .backends import ModeloSavedModel, ModeloTFLite
+from .cache import cache_resultados
+from .ingesta import ImagenInvalida, decodificar
+from .metricas import procesos_reinicios_total, progreso_escrituras_total
+from .management.commands.check_startup import PROHIBIDOS, SCRIPT as SCRIPT_ARRANQUE
+from .management.commands.exportar_modelo import Command as ExportarModelo
+from .models import IA_Model, LotePrediccion, Prediccion
+from .motor import MotorInferencia, _motores, sesion_motor
+from .procesos import ProcesoInferencia
+from .progreso import TERMINALES, EscritorProgreso, canal_progreso
+from .registro import RegistroModelos, ruta_servida, version_modelo
+from .retencion import Retencion, accesos
+from .trabajos import ColaLlena, EjecutorPredicciones, Trabajo
+
+
+class ModeloFalso:
+    """Reemplazo de un modelo de Keras: predice el canal rojo de cada patch."""
+
+    def __init__(self):
+        self.llamadas = []
+
+    def predict(self, x, batch_size=None, verbose=0):
+        self.llamadas.append(len(x))
+        return x[..., :1].copy()
+
+
+class MediaTemporal:
+    """MEDIA_ROOT en un directorio temporal que se borra al terminar cada test."""
+
+    def setUp(self):
+        super().setUp()
+        self.media = tempfile.mkdtemp()
+        ajuste = override_settings(MEDIA_ROOT=self.media)
+        ajuste.enable()
+        self.addCleanup(ajuste.disable)
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+
+
+class EjecutorDetenido(EjecutorPredicciones):
+    """Ejecutor sin workers: los trabajos quedan en la cola para inspeccionarla."""
+
+    def iniciar(self, recuperar=True):
+        pass
+
+
+def png(nombre, semilla=0, forma=(64, 64, 3)):
+    arr = np.random.RandomState(semilla).randint(0, 255, forma, dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format="PNG")
+    return SimpleUploadedFile(nombre, buf.getvalue(), content_type="image/png")
+
+
+def guardar_imagen(directorio, arr, nombre="entrada.png"):
+    ruta = os.path.join(directorio, nombre)
+    Image.fromarray(arr).save(ruta)
+    return ruta
+
+
+class MapaConstanteTests(MediaTemporal, SimpleTestCase):
+    def test_realce_de_mapa_constante_queda_en_cero(self):
+        mapa = np.full((32, 32), 0.3, dtype=np.float32)
+        resultado = realce_asimetrico(mapa, out=mapa)
+        self.assertTrue(np.isfinite(resultado).all())
+        self.assertEqual(float(resultado.max()), 0.0)
+
+    def test_imagen_uniforme_con_filtro_no_falla(self):
+        img = np.full((600, 700, 3), 128, dtype=np.uint8)
+        modelo = ModeloFalso()
+        tiempos = {}
+        url = procesar_prediccion(
+            img, modelo, None, batch_size=8, filtro={"varianza": 1e-4, "bordes": 0.01, "rango": 0.05},
+            notificar=lambda evento, **datos: tiempos.update(datos) if evento == "tiempos" else None,
+        )
+        self.assertEqual(modelo.llamadas, [])
+        self.assertEqual(tiempos["omitidos"], tiempos["patches"])
+        self.assertTrue(os.path.exists(os.path.join(self.media, os.path.basename(url))))
+
+    def test_imagen_mas_chica_que_un_patch_no_falla(self):
+        for forma in ((120, 200, 3), (300, 200, 3)):
+            with self.subTest(forma=forma):
+                img = np.random.RandomState(0).randint(0, 255, forma, dtype=np.uint8)
+                url = procesar_prediccion(img, ModeloFalso(), None, batch_size=8)
+                self.assertTrue(os.path.exists(os.path.join(self.media, os.path.basename(url))))
+
+    def test_imagen_chica_por_bandas_no_falla(self):
+        ruta = guardar_imagen(self.media, np.full((200, 300, 3), 90, dtype=np.uint8))
+        url = procesar_prediccion(ruta, ModeloFalso(), None, batch_size=8, bandas=True)
+        self.assertTrue(os.path.exists(os.path.join(self.media, os.path.basename(url))))
+
+
+class ModeloMezcla(ModeloFalso):
+    """Predicción que depende de todos los canales, coordenadas incluidas."""
+
+    def predict(self, x, batch_size=None, verbose=0):
+        self.llamadas.append(len(x))
+        return x[..., 0:1] * 0.5 + x[..., 1:2] * x[..., 3:4] * 0.3 + x[..., 4:5] * 0.2
+
+
+class LotesInferenciaTests(MediaTemporal, SimpleTestCase):
+    def predecir(self, img, batch_size):
+        modelo = ModeloMezcla()
+        avisos = {}
+        url = procesar_prediccion(
+            img.copy(), modelo, None, batch_size=batch_size, formato_mapa="npy",
+            notificar=lambda evento, **datos: avisos.update({evento: datos}),
+        )
+        mapa = np.load(os.path.join(self.media, os.path.basename(avisos["mapa"]["url"])))
+        with Image.open(os.path.join(self.media, os.path.basename(url))) as salida:
+            return modelo.llamadas, mapa, np.asarray(salida)
+
+    def test_lotes_iguales_a_patch_por_patch(self):
+        img = np.random.RandomState(0).randint(0, 255, (600, 700, 3), dtype=np.uint8)
+        llamadas_uno, mapa_uno, salida_uno = self.predecir(img, 1)
+        llamadas_lote, mapa_lote, salida_lote = self.predecir(img, 7)
+        self.assertEqual(set(llamadas_uno), {1})
+        self.assertEqual(sum(llamadas_lote), len(llamadas_uno))
+        # El último lote queda a medio llenar
+        self.assertEqual(llamadas_lote[:-1], [7] * (len(llamadas_lote) - 1))
+        self.assertLess(llamadas_lote[-1], 7)
+        np.testing.assert_array_equal(mapa_lote, mapa_uno)
+        np.testing.assert_array_equal(salida_lote, salida_uno)
+
+
+class ArranqueTests(SimpleTestCase):
+    def test_arranque_no_importa_tensorflow_ni_matplotlib(self):
+        """El chequeo de `check_startup` en un intérprete limpio: URLs, WSGI y todos los módulos de las apps."""
+        import pkgutil
+
+        modulos = [settings.ROOT_URLCONF, settings.WSGI_APPLICATION.rpartition(".")[0]]
+        for app in apps.get_app_configs():
+            if app.path.startswith(str(settings.BASE_DIR)):
+                modulos += [
+                    f"{app.name}.{modulo.name}" for modulo in pkgutil.iter_modules([app.path])
+                    if modulo.name != "tests"
+                ]
+        proceso = subprocess.run(
+            [sys.executable, "-c", SCRIPT_ARRANQUE, str(settings.BASE_DIR), PROHIBIDOS, ",".join(modulos)],
+            cwd=settings.BASE_DIR, env=dict(os.environ, DJANGO_SETTINGS_MODULE="albertidl.settings"),
+            capture_output=True, text=True, timeout=120,
+        )
+        self.assertEqual(proceso.returncode, 0, proceso.stderr)
+        resultado = json.loads(proceso.stdout.strip().splitlines()[-1])
+        self.assertEqual(resultado["prohibidos"], {})
+        self.assertIn("modelos.views", modulos)
+
+
+class ColormapTests(SimpleTestCase):
+    def test_valores_no_finitos(self):
+        mapa = np.array([[np.nan, np.inf, -np.inf, 0.5]], dtype=np.float32)
+        rgb = aplicar_colormap(mapa)
+        np.testing.assert_array_equal(rgb[0, 0], LUT_REDS[0])
+        np.testing.assert_array_equal(rgb[0, 1], LUT_REDS[-1])
+        np.testing.assert_array_equal(rgb[0, 2], LUT_REDS[0])
+        np.testing.assert_array_equal(rgb[0, 3], LUT_REDS[128])
+
+
+class GuardarPngTests(MediaTemporal, SimpleTestCase):
+    def test_nivel_de_compresion_configurable(self):
+        y, x = np.mgrid[0:256, 0:256]
+        rgb = aplicar_colormap((np.sin(x / 9) * np.cos(y / 13) + 1) / 2)
+        tamanos = {}
+        for nivel in (0, 6):
+            ruta = os.path.join(self.media, f"salida_{nivel}.png")
+            with override_settings(PREDICCION_PNG_COMPRESION=nivel):
+                guardar_png(rgb, ruta)
+            with Image.open(ruta) as leida:
+                np.testing.assert_array_equal(np.asarray(leida), rgb)
+            tamanos[nivel] = os.path.getsize(ruta)
+        self.assertLess(tamanos[6], tamanos[0])
+
+
+class ColaTests(SimpleTestCase):
+    def test_reserva_cuenta_como_ocupada(self):
+        ejecutor = EjecutorDetenido(profundidad=3)
+        ejecutor.encolar(Trabajo(1, "m", "a.png"))
+        with ejecutor.reservar(2):
+            with self.assertRaises(ColaLlena):
+                ejecutor.encolar(Trabajo(2, "m", "b.png"))
+            with self.assertRaises(ColaLlena):
+                ejecutor.verificar_capacidad()
+            ejecutor.encolar(Trabajo(3, "m", "c.png"), forzar=True)
+            ejecutor.encolar(Trabajo(4, "m", "d.png"), forzar=True)
+        self.assertEqual(ejecutor.pendientes(), 3)
+        self.assertEqual(ejecutor._reservados, 0)
+
+    def test_imagenes_en_cola_acotadas_en_bytes(self):
+        ejecutor = EjecutorDetenido(max_bytes_imagenes=250_000)
+        for i in range(3):
+            ejecutor.encolar(Trabajo(i, "m", f"{i}.png", imagen=np.zeros((200, 200, 3), dtype=np.uint8)))
+        self.assertEqual([t.imagen is not None for t in ejecutor._cola], [True, True, False])
+        self.assertEqual(ejecutor.bytes_imagenes, 240_000)
+
+    def test_reserva_mayor_que_el_lugar_libre(self):
+        ejecutor = EjecutorDetenido(profundidad=3)
+        ejecutor.encolar(Trabajo(1, "m", "a.png"))
+        with self.assertRaises(ColaLlena):
+            with ejecutor.reservar(3):
+                pass
+        self.assertEqual(ejecutor._reservados, 0)
+
+
+class ApiPrediccion(MediaTemporal):
+    """Vistas de predicción con un modelo sin archivo y un ejecutor sin workers."""
+
+    def setUp(self):
+        super().setUp()
+        self.modelo = IA_Model.objects.create(title="m", model_file="m")
+        self.ejecutor = EjecutorDetenido(profundidad=3)
+        cache_resultados._entradas.clear()
+        # Consultas anotadas por otros tests: los ids se reusan entre tests
+        with accesos._lock:
+            accesos._ids.clear()
+        for objetivo, valor in (
+            ("modelos.views.ejecutor", self.ejecutor),
+            ("modelos.views.ruta_servida", mock.Mock(return_value="modelo.h5")),
+            ("modelos.views.version_modelo", mock.Mock(return_value="v1")),
+        ):
+            ajuste = mock.patch(objetivo, valor)
+            ajuste.start()
+            self.addCleanup(ajuste.stop)
+
+    def terminar(self, prediccion_id):
+        """Marca la predicción como terminada con un archivo de salida publicado."""
+        salida = f"salida_{prediccion_id}.png"
+        guardar_imagen(self.media, np.zeros((4, 4, 3), dtype=np.uint8), salida)
+        Prediccion.objects.filter(id=prediccion_id).update(
+            status="done", output_image=f"/media/{salida}", started_at=timezone.now(), finished_at=timezone.now(),
+        )
+
+
+class LoteColaTests(ApiPrediccion, TestCase):
+    def enviar(self, cantidad, semilla=0):
+        imagenes = [png(f"{i}.png", semilla + i) for i in range(cantidad)]
+        return self.client.post(f"/modelos/predict/{self.modelo.pk}/lote/", {"images": imagenes})
+
+    def test_lote_que_entra_se_encola_entero(self):
+        respuesta = self.enviar(3)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(self.ejecutor.pendientes(), 3)
+        self.assertEqual(Prediccion.objects.filter(status="queued").count(), 3)
+        self.assertEqual({t.lote for t in self.ejecutor._cola}, {respuesta.json()["lote_id"]})
+
+    def test_lote_sin_lugar_responde_503_sin_crear_nada(self):
+        self.ejecutor.encolar(Trabajo(0, "m", "a.png"))
+        respuesta = self.enviar(3)
+        self.assertEqual(respuesta.status_code, 503)
+        self.assertIn("Retry-After", respuesta)
+        self.assertEqual(self.ejecutor.pendientes(), 1)
+        self.assertFalse(LotePrediccion.objects.exists())
+        self.assertFalse(Prediccion.objects.exists())
+
+    def test_lote_mas_grande_que_la_cola_responde_413(self):
+        respuesta = self.enviar(4)
+        self.assertEqual(respuesta.status_code, 413)
+        self.assertEqual(self.ejecutor.pendientes(), 0)
+        self.assertFalse(Prediccion.objects.exists())
+
+
+class MotorTests(SimpleTestCase):
+    def motor(self, modelo, max_batch, max_espera=5.0):
+        motor = MotorInferencia(modelo, max_batch=max_batch, max_espera=max_espera)
+        self.addCleanup(motor.cerrar)
+        return motor
+
+    def concurrentes(self, motor, *lotes):
+        """Cada lote lo envía un trabajo con su propia sesión; devuelve los resultados."""
+        resultados = [None] * len(lotes)
+        for _ in lotes:
+            motor.abrir_sesion()
+
+        def trabajo(i):
+            try:
+                resultados[i] = motor.predict(lotes[i])
+            finally:
+                motor.cerrar_sesion()
+
+        hilos = [threading.Thread(target=trabajo, args=(i,)) for i in range(len(lotes))]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join(10)
+        return resultados
+
+    def test_dos_trabajos_comparten_una_llamada(self):
+        modelo = ModeloFalso()
+        a = np.random.rand(40, 8, 8, 3).astype(np.float32)
+        b = np.random.rand(24, 8, 8, 3).astype(np.float32)
+        ra, rb = self.concurrentes(self.motor(modelo, 64), a, b)
+        self.assertEqual(modelo.llamadas, [64])
+        np.testing.assert_array_equal(ra, a[..., :1])
+        np.testing.assert_array_equal(rb, b[..., :1])
+
+    def test_lote_mas_grande_que_el_maximo_se_parte(self):
+        modelo = ModeloFalso()
+        x = np.random.rand(80, 8, 8, 3).astype(np.float32)
+        motor = self.motor(modelo, 32)
+        with motor.sesion():
+            resultado = motor.predict(x)
+        self.assertEqual(modelo.llamadas, [32, 32, 16])
+        np.testing.assert_array_equal(resultado, x[..., :1])
+
+    def test_resto_de_un_trabajo_se_completa_con_otro(self):
+        modelo = ModeloFalso()
+        a = np.random.rand(40, 8, 8, 3).astype(np.float32)
+        b = np.random.rand(24, 8, 8, 3).astype(np.float32)
+        ra, rb = self.concurrentes(self.motor(modelo, 32), a, b)
+        self.assertEqual(modelo.llamadas, [32, 32])
+        np.testing.assert_array_equal(ra, a[..., :1])
+        np.testing.assert_array_equal(rb, b[..., :1])
+
+    def test_motor_reemplazado_atiende_sus_sesiones(self):
+        self.addCleanup(_motores.pop, "motor_test", None)
+        x = np.ones((4, 8, 8, 3), dtype=np.float32)
+        with sesion_motor("motor_test", ModeloFalso()) as viejo:
+            with sesion_motor("motor_test", ModeloFalso()) as nuevo:
+                self.assertIsNot(viejo, nuevo)
+                np.testing.assert_array_equal(viejo.predict(x), x[..., :1])
+                np.testing.assert_array_equal(nuevo.predict(x), x[..., :1])
+        for motor in (viejo, nuevo):
+            motor._hilo.join(5)
+            self.assertFalse(motor._hilo.is_alive())
+        self.assertNotIn("motor_test", _motores)
+
+    def test_modelo_desalojado_no_queda_en_un_motor(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        for nombre in ("motor_a", "motor_b"):
+            with open(os.path.join(media, f"{nombre}.h5"), "wb") as f:
+                f.write(b"pesos")
+        registro = RegistroModelos(max_modelos=1, cargador=lambda path: ModeloFalso())
+        x = np.ones((4, 8, 8, 3), dtype=np.float32)
+        with mock.patch("modelos.registro.ruta_servida", lambda model_file: os.path.join(media, f"{model_file}.h5")):
+            with registro.usar("motor_a") as modelo:
+                with sesion_motor("motor_a", modelo) as motor:
+                    motor.predict(x)
+            with registro.usar("motor_b") as modelo:
+                with sesion_motor("motor_b", modelo):
+                    self.assertEqual(registro.cargados(), ["motor_b"])
+                    self.assertNotIn("motor_a", _motores)
+        motor._hilo.join(5)
+        self.assertFalse(motor._hilo.is_alive())
+        self.assertEqual(_motores, {})
+
+
+class BandasTests(MediaTemporal, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.img = np.random.RandomState(1).randint(0, 255, (700, 301, 3), dtype=np.uint8)
+
+    def guardar_tiff(self, arr, **opciones):
+        ruta = os.path.join(self.media, "entrada.tif")
+        Image.fromarray(arr).save(ruta, strip_size=16 * 1024, **opciones)
+        return ruta
+
+    def assertLeeIgualQuePillow(self, ruta):
+        with Image.open(ruta) as img:
+            esperado = np.asarray(img.convert("RGB"))
+        with LectorBandas(ruta, self.media) as lector:
+            np.testing.assert_array_equal(np.asarray(lector.pixeles), esperado)
+
+    def test_tiff_por_strips(self):
+        casos = {
+            "deflate": (self.img, {"compression": "tiff_adobe_deflate"}),
+            "deflate_predictor": (self.img, {"compression": "tiff_adobe_deflate", "tiffinfo": {317: 2}}),
+            "deflate_gris": (self.img[..., 0], {"compression": "tiff_adobe_deflate"}),
+            "lzw": (self.img, {"compression": "tiff_lzw"}),
+            "crudo": (self.img, {}),
+        }
+        for nombre, (arr, opciones) in casos.items():
+            with self.subTest(nombre):
+                with mock.patch("capa_nitrurada.bandas.TROZO_BYTES", 4096):
+                    self.assertLeeIgualQuePillow(self.guardar_tiff(arr, **opciones))
+
+    def test_bandas_igual_que_en_memoria(self):
+        ruta = self.guardar_tiff(self.img, compression="tiff_adobe_deflate")
+        salidas = []
+        for bandas in (False, True):
+            with override_settings(PREDICCION_BANDAS_FILAS=300):
+                url = procesar_prediccion(ruta, ModeloFalso(), None, batch_size=8, bandas=bandas)
+            with Image.open(os.path.join(self.media, os.path.basename(url))) as salida:
+                salidas.append(np.asarray(salida))
+        np.testing.assert_array_equal(salidas[0], salidas[1])
+
+    @override_settings(PREDICCION_BANDAS_DESDE_PIXELES=100_000, PREDICCION_BANDAS_MAX_PIXELES_DECODIFICADOS=150_000)
+    def test_formatos_sin_lectura_por_partes_se_limitan(self):
+        png = guardar_imagen(self.media, self.img)
+        with self.assertRaises(ImagenInvalida) as error:
+            decodificar(png)
+        self.assertEqual(error.exception.status, 413)
+        arr, formato = decodificar(self.guardar_tiff(self.img, compression="tiff_adobe_deflate"))
+        self.assertIsNone(arr)
+        self.assertEqual(formato, "TIFF")
+
+
+class RegistroTests(MediaTemporal, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        for nombre in ("a", "b"):
+            with open(os.path.join(self.media, f"{nombre}.h5"), "wb") as f:
+                f.write(b"pesos")
+        ajuste = mock.patch(
+            "modelos.registro.ruta_servida", lambda model_file: os.path.join(self.media, f"{model_file}.h5"),
+        )
+        ajuste.start()
+        self.addCleanup(ajuste.stop)
+        self.registro = RegistroModelos(max_modelos=1, cargador=lambda path: ModeloFalso())
+
+    def test_modelo_en_uso_no_se_desaloja(self):
+        with self.registro.usar("a") as a:
+            self.registro.get("b")
+            self.assertEqual(self.registro.cargados(), ["a", "b"])
+            with self.registro.usar("a") as otra_vez:
+                self.assertIs(otra_vez, a)
+            self.assertEqual(self.registro.misses, 2)
+        # Al soltarlo vuelve a valer el límite: "a" se usó último y queda
+        self.assertEqual(self.registro.cargados(), ["a"])
+        self.assertEqual(self.registro.desalojos, 1)
+
+    def test_sin_uso_se_desaloja_el_menos_usado(self):
+        self.registro.get("a")
+        self.registro.get("b")
+        self.assertEqual(self.registro.cargados(), ["b"])
+        self.assertEqual(self.registro.desalojos, 1)
+
+
+class DirectorioModelos:
+    """MODELOS_DIR en un directorio temporal."""
+
+    def setUp(self):
+        super().setUp()
+        self.modelos = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.modelos, ignore_errors=True)
+        ajuste = override_settings(MODELOS_DIR=self.modelos)
+        ajuste.enable()
+        self.addCleanup(ajuste.disable)
+
+    def crear(self, nombre, mtime):
+        ruta = os.path.join(self.modelos, nombre)
+        if nombre.endswith("_savedmodel"):
+            os.makedirs(ruta)
+        else:
+            with open(ruta, "wb") as f:
+                f.write(b"pesos")
+        os.utime(ruta, (mtime, mtime))
+        return ruta
+
+
+class RutaServidaTests(DirectorioModelos, SimpleTestCase):
+    def test_sin_artefactos(self):
+        self.assertIsNone(ruta_servida("m"))
+        h5 = self.crear("m.h5", 1000)
+        self.assertEqual(ruta_servida("m"), h5)
+
+    def test_prefiere_el_artefacto_al_dia(self):
+        self.crear("m.h5", 1000)
+        tflite = self.crear("m.tflite", 2000)
+        savedmodel = self.crear("m_savedmodel", 2000)
+        self.assertEqual(ruta_servida("m"), tflite)
+        os.remove(tflite)
+        self.assertEqual(ruta_servida("m"), savedmodel)
+
+    def test_artefacto_mas_viejo_que_el_h5_no_se_sirve(self):
+        h5 = self.crear("m.h5", 2000)
+        self.crear("m.tflite", 1000)
+        self.assertEqual(ruta_servida("m"), h5)
+
+    def test_sin_h5_se_sirve_el_artefacto(self):
+        tflite = self.crear("m.tflite", 1000)
+        self.assertEqual(ruta_servida("m"), tflite)
+
+    def test_desactivado(self):
+        h5 = self.crear("m.h5", 1000)
+        self.crear("m.tflite", 2000)
+        with override_settings(PREDICCION_USAR_OPTIMIZADO=False):
+            self.assertEqual(ruta_servida("m"), h5)
+
+
+def guardar_modelo_keras(ruta):
+    """Modelo Keras de verdad, chico: una convolución 1x1 sobre los 5 canales de un patch."""
+    import keras
+
+    entrada = keras.Input((256, 256, 5))
+    modelo = keras.Model(entrada, keras.layers.Conv2D(1, 1, activation="sigmoid")(entrada))
+    modelo.save(ruta)
+    return modelo
+
+
+class VersionModeloTests(DirectorioModelos, SimpleTestCase):
+    def test_ajustes_que_cambian_la_salida_cambian_la_version(self):
+        self.crear("m.h5", 1000)
+        base = version_modelo("m")
+        self.assertEqual(version_modelo("m"), base)
+        for ajuste in (
+            {"PREDICCION_VENTANA": "gauss"},
+            {"PREDICCION_FORMATO_MAPA": "npz"},
+            {"PREDICCION_RENDER_MAX_LADO": 512},
+            {"PREDICCION_FILTRO_PATCHES": {"m": {"varianza": 1e-4}}},
+        ):
+            with self.subTest(ajuste=ajuste), override_settings(**ajuste):
+                self.assertNotEqual(version_modelo("m"), base)
+        # La compresión del PNG no cambia los píxeles
+        with override_settings(PREDICCION_PNG_COMPRESION=1):
+            self.assertEqual(version_modelo("m"), base)
+
+
+class ExportarModeloTests(DirectorioModelos, TestCase):
+    """Exporta un modelo Keras chico de verdad; tarda unos segundos por la conversión."""
+
+    def setUp(self):
+        super().setUp()
+        self.keras = guardar_modelo_keras(os.path.join(self.modelos, "m.h5"))
+        self.imagenes = os.path.join(self.modelos, "imagenes")
+        os.makedirs(self.imagenes)
+        rng = np.random.default_rng(0)
+        Image.fromarray(rng.integers(0, 256, (256, 384, 3), dtype=np.uint8)).save(
+            os.path.join(self.imagenes, "a.png")
+        )
+        self.x = rng.random((3, 256, 256, 5), dtype=np.float32)
+
+    def exportar(self, **opciones):
+        call_command(
+            "exportar_modelo", "m", imagenes=self.imagenes, max_patches=4, batch_size=2,
+            stdout=io.StringIO(), **opciones,
+        )
+
+    def test_tflite_se_publica_y_se_sirve(self):
+        self.exportar()
+        destino = os.path.join(self.modelos, "m.tflite")
+        self.assertEqual(ruta_servida("m"), destino)
+        modelo = ModeloTFLite(destino, num_threads=1)
+        self.assertEqual(modelo.input_shape, (None, 256, 256, 5))
+        for n in (3, 1):
+            np.testing.assert_allclose(modelo.predict(self.x[:n]), self.keras.predict(self.x[:n], verbose=0), atol=1e-5)
+
+    def test_savedmodel_se_publica_y_se_sirve(self):
+        self.exportar(formato="savedmodel")
+        destino = os.path.join(self.modelos, "m_savedmodel")
+        self.assertEqual(ruta_servida("m"), destino)
+        modelo = ModeloSavedModel(destino)
+        self.assertEqual(modelo.input_shape, (None, 256, 256, 5))
+        np.testing.assert_allclose(modelo.predict(self.x), self.keras.predict(self.x, verbose=0), atol=1e-5)
+
+    def test_iou_bajo_no_publica(self):
+        with mock.patch.object(ExportarModelo, "comparar", return_value=0.5):
+            with self.assertRaisesMessage(CommandError, "no se publicó"):
+                self.exportar()
+        self.assertEqual(sorted(os.listdir(self.modelos)), ["imagenes", "m.h5"])
+        self.assertEqual(ruta_servida("m"), os.path.join(self.modelos, "m.h5"))
+
+    def test_sin_imagenes_no_publica(self):
+        shutil.rmtree(self.imagenes)
+        with self.assertRaisesMessage(CommandError, "no se publicó"):
+            self.exportar()
+        self.assertFalse(os.path.exists(os.path.join(self.modelos, "m.tflite")))
+
+
+class ProcesosTests(MediaTemporal, DirectorioModelos, TransactionTestCase):
+    """Backend de procesos con hijos de verdad; cada hijo importa TensorFlow y tarda unos segundos."""
+
+    def setUp(self):
+        super().setUp()
+        guardar_modelo_keras(os.path.join(self.modelos, "m.h5"))
+        self.img = np.random.RandomState(0).randint(0, 255, (300, 400, 3), dtype=np.uint8)
+
+    def proceso(self):
+        proceso = ProcesoInferencia("inferencia-test")
+        self.addCleanup(proceso.detener)
+        return proceso
+
+    def test_imagen_por_memoria_compartida(self):
+        eventos = []
+        url = self.proceso().ejecutar(
+            "m", self.img, None, {"batch_size": 4}, lambda evento, **datos: eventos.append(evento),
+        )
+        # El hijo escribe en el MEDIA_ROOT del proceso web
+        with Image.open(os.path.join(self.media, os.path.basename(url))) as salida:
+            self.assertEqual(salida.height, 300)
+        self.assertIn("carga_modelo", eventos)
+        self.assertIn("tiempos", eventos)
+
+    def test_cancelar_deja_el_proceso_libre(self):
+        proceso = self.proceso()
+
+        def notificar(evento, **datos):
+            if evento == "progreso" and datos.get("etapa") == "inferencia":
+                raise PrediccionCancelada()
+
+        with self.assertRaises(PrediccionCancelada):
+            proceso.ejecutar("m", self.img, None, {"batch_size": 4}, notificar)
+        pid = proceso.pid
+        url = proceso.ejecutar("m", self.img, None, {"batch_size": 4}, lambda evento, **datos: None)
+        self.assertTrue(os.path.exists(os.path.join(self.media, os.path.basename(url))))
+        self.assertEqual((proceso.pid, proceso.reinicios), (pid, 0))
+
+    def test_proceso_caido_reencola_y_otro_proceso_termina(self):
+        modelo = IA_Model.objects.create(title="m", model_file="m")
+        ruta = guardar_imagen(self.media, self.img)
+        pred = Prediccion.objects.create(
+            ia_model=modelo, input_image="/media/entrada.png", status="queued", queued_at=timezone.now(),
+        )
+        ejecutor = EjecutorPredicciones(workers=1, backend="procesos", procesos={"reintentos": 1})
+        ejecutor.iniciar(recuperar=False)
+        self.addCleanup(lambda: [proceso.detener() for proceso in ejecutor.procesos])
+        caidos = procesos_reinicios_total.valor()
+
+        ejecutor.encolar(Trabajo(pred.id, "m", ruta, imagen=self.img))
+        limite = time.monotonic() + 30
+        while not Prediccion.objects.filter(id=pred.id, status="running").exists():
+            self.assertLess(time.monotonic(), limite)
+            time.sleep(0.02)
+        # El hijo ya tiene la tarea y todavía está importando TensorFlow
+        time.sleep(0.5)
+        proceso = ejecutor.procesos[0]
+        pid = proceso.pid
+        os.kill(pid, signal.SIGKILL)
+
+        limite = time.monotonic() + 120
+        while not Prediccion.objects.filter(id=pred.id, status__in=TERMINALES).exists():
+            self.assertLess(time.monotonic(), limite)
+            time.sleep(0.1)
+        pred.refresh_from_db()
+        self.assertEqual(pred.status, "done")
+        self.assertTrue(os.path.exists(os.path.join(self.media, os.path.basename(pred.output_image))))
+        self.assertEqual(procesos_reinicios_total.valor() - caidos, 1)
+        self.assertEqual(proceso.reinicios, 1)
+        self.assertNotEqual(proceso.pid, pid)
+
+
+class CacheCatalogoTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        IA_Model.objects.create(title="m", model_file="m")
+
+    def test_api_navegable_no_se_cachea(self):
+        for _ in range(2):
+            with CaptureQueriesContext(connection) as contexto:
+                response = self.client.get("/modelos/", HTTP_ACCEPT="text/html")
+            self.assertEqual(response.status_code, 200)
+            self.assertGreater(len(contexto.captured_queries), 0)
+
+    def test_json_se_cachea_con_vary(self):
+        self.client.get("/modelos/", HTTP_ACCEPT="application/json")
+        with CaptureQueriesContext(connection) as contexto:
+            response = self.client.get("/modelos/", HTTP_ACCEPT="application/json")
+        self.assertEqual(len(contexto.captured_queries), 0)
+        self.assertIn("Accept", response["Vary"])
+
+
+class MediaServidaTests(MediaTemporal, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.datos = bytes(range(256)) * 4
+        with open(os.path.join(self.media, "datos.npy"), "wb") as f:
+            f.write(self.datos)
+
+    def pedir(self, **cabeceras):
+        return self.client.get("/media/datos.npy", **cabeceras)
+
+    def test_rango_responde_206(self):
+        for rango, inicio, fin in (("bytes=10-19", 10, 19), ("bytes=1000-", 1000, 1023), ("bytes=-4", 1020, 1023)):
+            with self.subTest(rango=rango):
+                response = self.pedir(HTTP_RANGE=rango)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response["Content-Range"], f"bytes {inicio}-{fin}/1024")
+                self.assertEqual(b"".join(response.streaming_content), self.datos[inicio:fin + 1])
+
+    def test_rango_fuera_del_archivo_responde_416(self):
+        response = self.pedir(HTTP_RANGE="bytes=2000-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */1024")
+
+    def test_rango_mal_formado_responde_el_archivo_entero(self):
+        response = self.pedir(HTTP_RANGE="bytes=0-1,5-9")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.datos)
+
+    def test_etag_y_if_range(self):
+        etag = self.pedir()["ETag"]
+        self.assertEqual(self.pedir(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.pedir(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=etag).status_code, 206)
+        # Con un ETag viejo el Range se ignora y va el archivo entero
+        self.assertEqual(self.pedir(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"viejo"').status_code, 200)
+
+
+class ListadoPrediccionesTests(TestCase):
+    url = "/modelos/predicciones/"
+
+    def setUp(self):
+        modelo = IA_Model.objects.create(title="m", model_file="m")
+        inicio = timezone.now() - timedelta(days=10)
+        self.preds = []
+        for i, status in enumerate(["queued", "running", "done", "done", "error", "cancelled", "done"]):
+            pred = Prediccion.objects.create(ia_model=modelo, input_image=f"/media/{i}.png", status=status)
+            Prediccion.objects.filter(id=pred.id).update(created_at=inicio + timedelta(days=i))
+            self.preds.append(pred.id)
+        self.inicio = inicio
+
+    def ids(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [fila["id"] for fila in response.json()["results"]]
+
+    def test_filtros(self):
+        self.assertEqual(self.ids(ids=f"{self.preds[0]},{self.preds[3]}"), [self.preds[3], self.preds[0]])
+        self.assertEqual(self.ids(status="queued,error"), [self.preds[4], self.preds[0]])
+        desde, hasta = (self.inicio + timedelta(days=dias) for dias in (2, 4))
+        self.assertEqual(self.ids(desde=desde.isoformat(), hasta=hasta.isoformat()), [self.preds[3], self.preds[2]])
+
+    def test_paginacion_por_cursor(self):
+        vistos = []
+        url = self.url + "?page_size=3"
+        while url:
+            datos = self.client.get(url).json()
+            vistos += [fila["id"] for fila in datos["results"]]
+            url = datos["next"]
+        self.assertEqual(vistos, self.preds[::-1])
+
+    def test_filtros_invalidos(self):
+        for params in ({"ids": "1,a"}, {"status": "done,otro"}, {"desde": "ayer"}, {"ia_model": "x"}, {"lote": "x"}):
+            with self.subTest(params=params):
+                response = self.client.get(self.url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(next(iter(params)), response.json())
+
+    def test_consultas_constantes(self):
+        for page_size in (1, 7):
+            with self.subTest(page_size=page_size), self.assertNumQueries(1):
+                self.client.get(self.url, {"page_size": page_size})
+
+
+class RecuperacionTests(TestCase):
+    def test_solo_se_reencolan_las_running_sin_latido(self):
+        modelo = IA_Model.objects.create(title="m", model_file="m")
+        ahora = timezone.now()
+
+        def crear(status, latido=None):
+            return Prediccion.objects.create(
+                ia_model=modelo, input_image="/media/entradas/a.png", status=status, heartbeat_at=latido,
+            )
+
+        en_cola = crear("queued")
+        viva = crear("running", ahora - timedelta(seconds=10))
+        vencida = crear("running", ahora - timedelta(seconds=200))
+        sin_latido = crear("running")
+
+        ejecutor = EjecutorDetenido(latido=30.0)
+        self.assertEqual(ejecutor.recuperar_pendientes(), 3)
+        self.assertEqual(
+            sorted(trabajo.prediccion_id for trabajo in ejecutor._cola),
+            sorted([en_cola.id, vencida.id, sin_latido.id]),
+        )
+        viva.refresh_from_db()
+        vencida.refresh_from_db()
+        self.assertEqual(viva.status, "running")
+        self.assertEqual(vencida.status, "queued")
+        self.assertIsNone(vencida.heartbeat_at)
+
+
+class CacheResultadosTests(ApiPrediccion, TestCase):
+    def enviar(self):
+        return self.client.post(f"/modelos/predict/{self.modelo.pk}/", {"image": png("a.png")}).json()
+
+    def test_misma_imagen_se_deduplica_y_despues_sale_del_cache(self):
+        primera = self.enviar()
+        self.assertEqual(self.ejecutor.pendientes(), 1)
+
+        segunda = self.enviar()
+        self.assertTrue(segunda["deduplicada"])
+        self.assertEqual(segunda["prediccion_id"], primera["prediccion_id"])
+        self.assertEqual(self.ejecutor.pendientes(), 1)
+
+        self.terminar(primera["prediccion_id"])
+        tercera = self.enviar()
+        self.assertTrue(tercera["cache"])
+        copia = Prediccion.objects.get(id=tercera["prediccion_id"])
+        self.assertEqual(copia.status, "done")
+        self.assertEqual(copia.output_image, f"/media/salida_{primera['prediccion_id']}.png")
+        self.assertEqual(self.ejecutor.pendientes(), 1)
+
+    def test_salida_borrada_no_es_hit(self):
+        primera = self.enviar()
+        self.terminar(primera["prediccion_id"])
+        os.remove(os.path.join(self.media, f"salida_{primera['prediccion_id']}.png"))
+        respuesta = self.enviar()
+        self.assertNotIn("cache", respuesta)
+        self.assertEqual(self.ejecutor.pendientes(), 2)
+
+    def test_los_hits_no_renuevan_la_edad(self):
+        primera = self.enviar()
+        self.terminar(primera["prediccion_id"])
+        self.assertTrue(self.enviar()["cache"])
+        # Vence el resultado original; la copia recién creada no lo mantiene vivo
+        Prediccion.objects.filter(id=primera["prediccion_id"]).update(
+            created_at=timezone.now() - timedelta(seconds=cache_resultados.max_edad + 1),
+        )
+        cache_resultados._entradas.clear()
+        respuesta = self.enviar()
+        self.assertNotIn("cache", respuesta)
+        self.assertEqual(self.ejecutor.pendientes(), 2)
+
+
+class RetencionReferenciasTests(ApiPrediccion, TestCase):
+    def test_archivo_compartido_con_una_fila_viva_no_se_borra(self):
+        primera = self.client.post(f"/modelos/predict/{self.modelo.pk}/", {"image": png("a.png")}).json()
+        self.terminar(primera["prediccion_id"])
+        anterior = Prediccion.objects.get(id=primera["prediccion_id"])
+        # Otra subida de la misma imagen, todavía en cola
+        Prediccion.objects.create(
+            ia_model=self.modelo, input_image=anterior.input_image, status="queued", input_hash=anterior.input_hash,
+        )
+        Prediccion.objects.filter(id=anterior.id).update(accessed_at=timezone.now() - timedelta(days=2))
+
+        resultado = Retencion(max_dias=1).barrer()
+        self.assertEqual(resultado["expiradas"], 1)
+        self.assertTrue(os.path.exists(os.path.join(self.media, anterior.input_image.split("/media/", 1)[1])))
+        self.assertFalse(os.path.exists(os.path.join(self.media, f"salida_{anterior.id}.png")))
+
+    def test_copia_de_un_resultado_expirado_no_se_crea(self):
+        from .views import copiar_de_cache
+
+        primera = self.client.post(f"/modelos/predict/{self.modelo.pk}/", {"image": png("a.png")}).json()
+        self.terminar(primera["prediccion_id"])
+        anterior = Prediccion.objects.get(id=primera["prediccion_id"])
+        Prediccion.objects.filter(id=anterior.id).update(status="expired")
+        self.assertIsNone(copiar_de_cache(anterior, self.modelo))
+
+    def test_lote_con_hit_expirado_lo_procesa(self):
+        primera = self.client.post(f"/modelos/predict/{self.modelo.pk}/", {"image": png("0.png")}).json()
+        self.terminar(primera["prediccion_id"])
+        anterior = Prediccion.objects.get(id=primera["prediccion_id"])
+        self.ejecutor._cola.clear()
+
+        # La retención expira el resultado entre la búsqueda y la copia
+        Prediccion.objects.filter(id=anterior.id).update(status="expired")
+        with mock.patch.object(cache_resultados, "buscar", side_effect=[anterior, None]):
+            respuesta = self.client.post(f"/modelos/predict/{self.modelo.pk}/lote/", {"images": [png("0.png")]})
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()["cache"], 0)
+        self.assertEqual(self.ejecutor.pendientes(), 1)
+        self.assertEqual(LotePrediccion.objects.count(), 1)
+
+    def test_consultas_renuevan_el_acceso(self):
+        pred = Prediccion.objects.create(ia_model=self.modelo, input_image="/media/a.png", status="done")
+        viejo = timezone.now() - timedelta(days=3)
+        Prediccion.objects.filter(id=pred.id).update(accessed_at=viejo)
+        accesos.vaciar()
+        self.client.get(f"/modelos/predicciones/?ids={pred.id}")
+        accesos.vaciar()
+        pred.refresh_from_db()
+        self.assertGreater(pred.accessed_at, viejo)
+
+
+class EjecutorSimulado(EjecutorPredicciones):
+    """El camino real de escrituras de un trabajo, con una inferencia simulada que solo avisa progreso."""
+
+    pasos = 20
+
+    def _procesar_local(self, model_file, entrada, request, opciones, notificar):
+        for hechos in range(1, self.pasos + 1):
+            time.sleep(0.002)
+            notificar("progreso", etapa="inferencia", hechos=hechos, total=self.pasos)
+        return f"/media/stress_{entrada}.png"
+
+
+class EscriturasConcurrentesTests(TransactionTestCase):
+    """
+    Carga sobre la base de test: hilos que crean predicciones como la vista,
+    workers que las toman, avisan progreso y las terminan, y lectores del
+    estado. No tiene que haber errores de la base ni progreso perdido.
+    """
+
+    def test_sin_errores_ni_actualizaciones_perdidas(self):
+        trabajos, escritores, lectores = 60, 4, 2
+        modelo = IA_Model.objects.create(title="stress", model_file="stress")
+        ejecutor = EjecutorSimulado(workers=4, profundidad=trabajos)
+        errores, creadas = [], []
+        lock = threading.Lock()
+        terminar = threading.Event()
+        escrituras_inicio = progreso_escrituras_total.valor()
+
+        def escritor(cantidad):
+            try:
+                for _ in range(cantidad):
+                    try:
+                        pred = Prediccion.objects.create(
+                            ia_model=modelo, input_image="/media/stress.png", status="queued",
+                            queued_at=timezone.now(),
+                        )
+                    except OperationalError as e:
+                        errores.append(e)
+                        continue
+                    with lock:
+                        creadas.append(pred.id)
+                    ejecutor.encolar(Trabajo(pred.id, modelo.model_file, str(pred.id)))
+            finally:
+                close_old_connections()
+
+        def lector():
+            try:
+                while not terminar.is_set():
+                    with lock:
+                        ids = creadas[-20:]
+                    try:
+                        list(Prediccion.objects.filter(id__in=ids).values("id", "status", "progress_done"))
+                    except OperationalError as e:
+                        errores.append(e)
+                    time.sleep(0.005)
+            finally:
+                close_old_connections()
+
+        ejecutor.iniciar(recuperar=False)
+        hilos = [threading.Thread(target=escritor, args=(trabajos // escritores,)) for _ in range(escritores)]
+        hilos += [threading.Thread(target=lector) for _ in range(lectores)]
+        for hilo in hilos:
+            hilo.start()
+        try:
+            limite = time.monotonic() + 60
+            while time.monotonic() < limite:
+                if not Prediccion.objects.exclude(status__in=TERMINALES).exists() and len(creadas) == trabajos:
+                    break
+                time.sleep(0.05)
+        finally:
+            terminar.set()
+            for hilo in hilos:
+                hilo.join(10)
+
+        self.assertEqual(errores, [])
+        filas = list(Prediccion.objects.filter(ia_model=modelo).values("status", "progress_done"))
+        self.assertEqual(len(filas), trabajos)
+        self.assertEqual([f for f in filas if f["status"] != "done" or f["progress_done"] != EjecutorSimulado.pasos], [])
+        # El progreso se escribe agrupado: muchas menos transacciones que avisos
+        self.assertLess(progreso_escrituras_total.valor() - escrituras_inicio, trabajos * EjecutorSimulado.pasos // 10)
+
+
+class ModeloLento(ModeloFalso):
+    """ModeloFalso que tarda en cada llamada y anota lo que ve de la predicción en la base."""
+
+    def __init__(self, prediccion_id=None, espera=0.0):
+        super().__init__()
+        self.prediccion_id = prediccion_id
+        self.espera = espera
+        self.empezo = threading.Event()
+        self.previas = []
+
+    def predict(self, x, batch_size=None, verbose=0):
+        self.empezo.set()
+        if self.prediccion_id is not None:
+            self.previas.append(Prediccion.objects.get(id=self.prediccion_id).preview_image)
+        time.sleep(self.espera)
+        return super().predict(x, batch_size, verbose)
+
+
+class EjecutorModeloFalso(EjecutorPredicciones):
+    """Ejecutor real con el pipeline completo, pero con un modelo de prueba en vez del registro."""
+
+    def __init__(self, modelo, **kwargs):
+        super().__init__(**kwargs)
+        self.modelo = modelo
+
+    def _usar_modelo(self, model_file):
+        return contextlib.nullcontext(self.modelo)
+
+
+@override_settings(
+    PREDICCION_BATCH_SIZE=4, PREDICCION_VISTA_PREVIA=None,
+    PREDICCION_MICROBATCH_MAX=8, PREDICCION_MICROBATCH_ESPERA_MS=5000,
+)
+class LoteEmpaquetadoTests(MediaTemporal, TransactionTestCase):
+    """Las hijas de un lote corren juntas y el motor llena las llamadas con patches de varias imágenes."""
+
+    def setUp(self):
+        super().setUp()
+        self.modelo = IA_Model.objects.create(title="m", model_file="m")
+        self.lote = LotePrediccion.objects.create(ia_model=self.modelo)
+
+    def correr(self, cantidad, **kwargs):
+        modelo = ModeloFalso()
+        ejecutor = EjecutorModeloFalso(modelo, workers=1, **kwargs)
+        trabajos = []
+        for i in range(cantidad):
+            img = np.random.RandomState(i).randint(0, 255, (384, 512, 3), dtype=np.uint8)
+            pred = Prediccion.objects.create(
+                ia_model=self.modelo, lote=self.lote, input_image="/media/entrada.png",
+                status="queued", queued_at=timezone.now(),
+            )
+            self.addCleanup(canal_progreso._estados.pop, pred.id, None)
+            ruta = guardar_imagen(self.media, img, f"entrada_{i}.png")
+            trabajos.append(Trabajo(pred.id, "m", ruta, imagen=img, lote=self.lote.id))
+        ejecutor.encolar_lote(trabajos)
+        limite = time.monotonic() + 60
+        while ejecutor.en_curso or ejecutor.pendientes():
+            self.assertLess(time.monotonic(), limite)
+            time.sleep(0.02)
+        self.assertEqual(Prediccion.objects.filter(status="done").count(), cantidad)
+        return modelo.llamadas
+
+    def test_patches_de_varias_imagenes_en_llamadas_completas(self):
+        # 6 patches por imagen en lotes de 4: sueltas serían llamadas de 4 y 2
+        llamadas = self.correr(3, lote_paralelas=3)
+        self.assertEqual(sum(llamadas), 18)
+        self.assertEqual(llamadas, [8, 8, 2])
+        self.assertEqual(_motores, {})
+
+    def test_sin_paralelas_cada_imagen_va_sola(self):
+        self.assertEqual(self.correr(2, lote_paralelas=1), [4, 2, 4, 2])
+
+
+@override_settings(PREDICCION_BATCH_SIZE=1, PREDICCION_VISTA_PREVIA=None)
+class CancelarYPreviaTests(MediaTemporal, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.modelo = IA_Model.objects.create(title="m", model_file="m")
+        self.img = np.random.RandomState(0).randint(0, 255, (768, 1024, 3), dtype=np.uint8)
+
+    def crear(self, status="queued"):
+        pred = Prediccion.objects.create(
+            ia_model=self.modelo, input_image="/media/entrada.png", status=status, queued_at=timezone.now(),
+        )
+        self.addCleanup(canal_progreso._estados.pop, pred.id, None)
+        return pred
+
+    def correr(self, ejecutor, pred):
+        ejecutor.encolar(Trabajo(pred.id, "m", guardar_imagen(self.media, self.img), imagen=self.img))
+
+    def esperar(self, ejecutor, pred):
+        limite = time.monotonic() + 30
+        while ejecutor.en_curso or ejecutor.pendientes() or pred.id in ejecutor._corriendo:
+            self.assertLess(time.monotonic(), limite)
+            time.sleep(0.02)
+        pred.refresh_from_db()
+
+    def cancelar(self, pred):
+        return self.client.post(f"/modelos/predicciones/{pred.id}/cancelar/")
+
+    @override_settings(PREDICCION_VISTA_PREVIA=256)
+    def test_vista_previa_se_publica_antes_de_la_pasada_completa(self):
+        pred = self.crear()
+        modelo = ModeloLento(pred.id)
+        ejecutor = EjecutorModeloFalso(modelo, workers=1)
+        self.correr(ejecutor, pred)
+        self.esperar(ejecutor, pred)
+        self.assertEqual(pred.status, "done")
+        # 2 patches de la imagen reducida a 341x256 y después los de la completa
+        self.assertEqual(modelo.previas[:2], [None, None])
+        self.assertEqual(set(modelo.previas[2:]), {pred.preview_image})
+        self.assertTrue(os.path.exists(os.path.join(self.media, os.path.basename(pred.preview_image))))
+
+    def test_cancelar_una_en_proceso(self):
+        pred = self.crear()
+        modelo = ModeloLento(espera=0.02)
+        ejecutor = EjecutorModeloFalso(modelo, workers=1)
+        self.correr(ejecutor, pred)
+        self.assertTrue(modelo.empezo.wait(10))
+        response = self.cancelar(pred)
+        self.assertEqual(response.json(), {"id": pred.id, "status": "cancelled"})
+        self.esperar(ejecutor, pred)
+        self.assertEqual(pred.status, "cancelled")
+        self.assertIsNone(pred.output_image)
+        # 7x5 patches con solapamiento: cortó mucho antes del final
+        self.assertLess(len(modelo.llamadas), 35)
+        llamadas = len(modelo.llamadas)
+        time.sleep(0.1)
+        self.assertEqual(len(modelo.llamadas), llamadas)
+
+    def test_cancelar_una_en_cola(self):
+        pred = self.crear()
+        ejecutor = EjecutorDetenido(workers=1)
+        self.correr(ejecutor, pred)
+        self.assertEqual(self.cancelar(pred).status_code, 200)
+        # El worker que la saca de la cola no la toma
+        ejecutor.ejecutar(ejecutor._cola.popleft())
+        pred.refresh_from_db()
+        self.assertEqual(pred.status, "cancelled")
+        self.assertIsNone(pred.started_at)
+
+    def test_cancelar_terminada_o_inexistente(self):
+        pred = self.crear(status="done")
+        response = self.cancelar(pred)
+        self.assertEqual((response.status_code, response.json()["status"]), (409, "done"))
+        self.assertEqual(self.client.post("/modelos/predicciones/999999/cancelar/").status_code, 404)
+
+
+LINEA_PROMETHEUS = re.compile(
+    r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_]\w*="[^"]*",?)*\})? (-?[0-9.e+-]+|[+-]Inf|NaN)$'
+)
+
+
+def leer_metricas(texto):
+    """{(nombre, etiquetas): valor} del formato de texto de Prometheus; falla si una línea no es válida."""
+    valores, tipos = {}, {}
+    for linea in texto.splitlines():
+        if linea.startswith("# TYPE "):
+            _, _, nombre, tipo = linea.split(" ")
+            tipos[nombre] = tipo
+            continue
+        if linea.startswith("# HELP ") or not linea:
+            continue
+        m = LINEA_PROMETHEUS.match(linea)
+        if m is None:
+            raise AssertionError(f"Línea inválida: {linea!r}")
+        nombre = m.group(1)
+        familia = re.sub(r"_(bucket|sum|count)$", "", nombre) if nombre not in tipos else nombre
+        if familia not in tipos:
+            raise AssertionError(f"{nombre} sin # TYPE")
+        valores[(nombre, m.group(2) or "")] = float(m.group(3))
+    return valores
+
+
+class MetricasTests(ApiPrediccion, TransactionTestCase):
+    def metricas(self):
+        response = self.client.get("/metrics")
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return leer_metricas(response.content.decode())
+
+    def test_formato_prometheus(self):
+        valores = self.metricas()
+        self.assertIn(("prediccion_cola_pendientes", ""), valores)
+        # Los buckets de un histograma son acumulados y +Inf es el total
+        for (nombre, etiquetas), total in valores.items():
+            if not nombre.endswith("_count"):
+                continue
+            base = nombre[:-len("_count")]
+            cuentas = [
+                v for (n, e), v in valores.items()
+                if n == base + "_bucket" and e.startswith(etiquetas[:-1]) and 'le="+Inf"' not in e
+            ]
+            self.assertEqual(cuentas, sorted(cuentas))
+            infinito = etiquetas[:-1] + ',le="+Inf"}' if etiquetas else '{le="+Inf"}'
+            self.assertEqual(valores[(base + "_bucket", infinito)], total)
+
+    def test_contadores_e_histogramas_despues_de_una_prediccion(self):
+        antes = self.metricas()
+        response = self.client.post(f"/modelos/predict/{self.modelo.pk}/", {"image": png("a.png", forma=(300, 400, 3))})
+        self.assertIn("prediccion_id", response.json())
+        EjecutorModeloFalso(ModeloFalso()).ejecutar(self.ejecutor._cola.popleft())
+        despues = self.metricas()
+
+        def delta(nombre, etiquetas=""):
+            return despues.get((nombre, etiquetas), 0) - antes.get((nombre, etiquetas), 0)
+
+        self.assertEqual(delta("prediccion_trabajos_total", '{estado="done"}'), 1)
+        # 300x400 con stride 128: 2x3 patches
+        self.assertEqual(delta("prediccion_patches_total"), 6)
+        etapas = (
+            "upload", "decodificacion", "publicacion", "cola", "inferencia", "fusion", "render", "guardado", "total",
+        )
+        for etapa in etapas:
+            self.assertEqual(delta("prediccion_etapa_segundos_count", f'{{etapa="{etapa}"}}'), 1, etapa)
+        self.assertEqual(
+            delta("http_peticion_segundos_count", '{vista="model-detail",metodo="POST"}'), 1,
+        )
+
+    def test_server_timing(self):
+        response = self.client.get("/modelos/predicciones/")
+        partes = dict(parte.split(";", 1) for parte in response["Server-Timing"].split(", "))
+        self.assertRegex(partes["total"], r"^dur=[0-9.]+$")
+        self.assertRegex(partes["db"], r'^dur=[0-9.]+;desc="1 consultas"$')
+
+        response = self.client.post(f"/modelos/predict/{self.modelo.pk}/", {"image": png("a.png")})
+        etapas = [parte.split(";")[0] for parte in response["Server-Timing"].split(", ")]
+        self.assertEqual(etapas, ["total", "db", "upload", "decodificacion", "publicacion"])
+
+
+def eventos_sse(texto):
+    """[(id, event, data)] de un bloque de Server-Sent Events; los comentarios quedan como (None, ":", texto)."""
+    eventos = []
+    for bloque in texto.strip().split("\n\n"):
+        if bloque.startswith(":"):
+            eventos.append((None, ":", bloque))
+            continue
+        campos = dict(linea.split(": ", 1) for linea in bloque.splitlines())
+        if "event" in campos:
+            eventos.append((campos["id"], campos["event"], json.loads(campos["data"])))
+    return eventos
+
+
+@override_settings(PREDICCION_EVENTOS_INTERVALO_DB=0.05)
+class ProgresoVistasTests(TestCase):
+    def setUp(self):
+        modelo = IA_Model.objects.create(title="m", model_file="m")
+        self.pred = Prediccion.objects.create(ia_model=modelo, input_image="/media/a.png", status="running")
+        self.addCleanup(canal_progreso._estados.pop, self.pred.id, None)
+        canal_progreso.publicar(self.pred.id, status="running", stage="inferencia", progress_done=1, progress_total=4)
+
+    async def leer(self, response):
+        """Próximo evento del stream, salteando los fragmentos vacíos."""
+        async for fragmento in response.streaming_content:
+            eventos = eventos_sse(fragmento.decode())
+            if eventos:
+                return eventos[0]
+
+    async def test_sse_progreso_y_fin(self):
+        response = await self.async_client.get(f"/modelos/predicciones/{self.pred.id}/eventos/")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        _, tipo, datos = await self.leer(response)
+        self.assertEqual((tipo, datos["progress_done"]), ("progreso", 1))
+        canal_progreso.publicar(self.pred.id, status="done", output_image="/media/salida.png")
+        _, tipo, datos = await self.leer(response)
+        self.assertEqual((tipo, datos["output_image"]), ("fin", "/media/salida.png"))
+        # Después de `fin` el stream termina
+        self.assertEqual([f async for f in response.streaming_content], [])
+
+    async def test_sse_reanuda_desde_last_event_id(self):
+        response = await self.async_client.get(f"/modelos/predicciones/{self.pred.id}/eventos/")
+        version, _, _ = await self.leer(response)
+        await response.streaming_content.aclose()
+
+        response = await self.async_client.get(
+            f"/modelos/predicciones/{self.pred.id}/eventos/", headers={"Last-Event-ID": version},
+        )
+        # El estado ya enviado no se repite: primero llega un latido
+        self.assertEqual((await self.leer(response))[1], ":")
+        canal_progreso.publicar(self.pred.id, progress_done=2)
+        nueva, tipo, datos = await self.leer(response)
+        self.assertNotEqual(nueva, version)
+        self.assertEqual((tipo, datos["progress_done"]), ("progreso", 2))
+        await response.streaming_content.aclose()
+
+    async def test_long_poll(self):
+        url = f"/modelos/predicciones/{self.pred.id}/esperar/"
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        response = await self.async_client.get(url, {"timeout": "0.1"}, headers={"If-None-Match": etag})
+        self.assertEqual((response.status_code, response["ETag"]), (304, etag))
+
+        asyncio.get_running_loop().call_later(0.1, lambda: canal_progreso.publicar(self.pred.id, status="done"))
+        inicio = time.monotonic()
+        response = await self.async_client.get(url, {"timeout": "10"}, headers={"If-None-Match": etag})
+        self.assertLess(time.monotonic() - inicio, 5)
+        self.assertEqual((response.status_code, json.loads(response.content)["status"]), (200, "done"))
+        self.assertNotEqual(response["ETag"], etag)
+
+        response = await self.async_client.get(url, {"timeout": "x"})
+        self.assertEqual(response.status_code, 400)
+
+
+class EscritorProgresoTests(TestCase):
+    def test_agrupa_el_ultimo_avance_en_una_transaccion(self):
+        modelo = IA_Model.objects.create(title="m", model_file="m")
+        a, b, cancelada = (
+            Prediccion.objects.create(ia_model=modelo, input_image="/media/a.png", status=status)
+            for status in ("running", "running", "cancelled")
+        )
+        escritor = EscritorProgreso(intervalo=3600)
+        for hechos in range(1, 11):
+            for pred in (a, b, cancelada):
+                escritor.anotar(pred.id, {"stage": "inferencia", "progress_done": hechos})
+        escrituras = progreso_escrituras_total.valor()
+
+        with self.assertNumQueries(5):  # SAVEPOINT, tres UPDATE y RELEASE
+            self.assertEqual(escritor.vaciar(), 2)
+        self.assertEqual(progreso_escrituras_total.valor() - escrituras, 1)
+        self.assertEqual(
+            list(Prediccion.objects.filter(id__in=(a.id, b.id)).values_list("progress_done", flat=True)), [10, 10],
+        )
+        self.assertTrue(escritor.cancelada(cancelada.id))
+        self.assertFalse(escritor.cancelada(a.id))
+        self.assertEqual(escritor.vaciar(), 0)
+
+
+def patches_de_referencia(img, patch_size, stride):
+    """Extracción patch por patch, como el bucle original con np.linspace."""
+    h, w, _ = img.shape
+    patches, coords = [], []
+    for y in calcular_inicios(h, patch_size, stride):
+        for x in calcular_inicios(w, patch_size, stride):
+            patch = img[y:y + patch_size, x:x + patch_size].astype(np.float32) / 255.0
+            cx = np.linspace(x / w, (x + patch_size) / w, patch_size, endpoint=False)
+            cy = np.linspace(y / h, (y + patch_size) / h, patch_size, endpoint=False)
+            canal_x = np.tile(cx, (patch_size, 1))
+            canal_y = np.tile(cy[:, np.newaxis], (1, patch_size))
+            patches.append(np.dstack([patch, canal_x, canal_y]))
+            coords.append((int(y), int(x)))
+    return np.stack(patches).astype(np.float32), coords
+
+
+class ExtraccionPatchesTests(SimpleTestCase):
+    def test_lotes_iguales_a_la_extraccion_patch_por_patch(self):
+        for forma, patch_size, stride, batch_size in (
+            ((300, 520, 3), 64, 32, 7),
+            ((256, 256, 3), 256, 128, 32),
+            ((97, 130, 3), 32, 32, 5),
+        ):
+            with self.subTest(forma=forma, stride=stride):
+                img = np.random.RandomState(3).randint(0, 255, forma, dtype=np.uint8)
+                esperado, coords_esperadas = patches_de_referencia(img, patch_size, stride)
+                lotes = list(iterar_lotes_patches(img, patch_size, stride, batch_size))
+                self.assertTrue(all(len(lote) <= batch_size for lote, _ in lotes))
+                np.testing.assert_allclose(np.concatenate([lote for lote, _ in lotes]), esperado, rtol=0, atol=1e-6)
+                self.assertEqual([c for _, coords in lotes for c in coords], coords_esperadas)
+
+                lote, coords = generar_patches_img(img, patch_size, stride)
+                np.testing.assert_allclose(lote, esperado, rtol=0, atol=1e-6)
+                self.assertEqual(coords, coords_esperadas)
+
+    def test_region_igual_a_la_imagen_entera(self):
+        img = np.random.RandomState(4).randint(0, 255, (300, 200, 3), dtype=np.uint8)
+        y_starts, x_starts = calcular_inicios(300, 64, 32), calcular_inicios(200, 64, 32)
+        completo = {c: p for lote, coords in iterar_lotes_patches(img, 64, 32, 16) for c, p in zip(coords, lote)}
+        banda = y_starts[(y_starts >= 96) & (y_starts <= 160)]
+        y0, y1 = banda[0], banda[-1] + 64
+        for lote, coords in iterar_lotes_region(img[y0:y1], banda, x_starts, 300, 200, 64, 16, y0=y0):
+            for c, patch in zip(coords, lote):
+                np.testing.assert_array_equal(patch, completo[c])
+
+
+class FusionPatchesTests(SimpleTestCase):
+    def test_promedio_plano_igual_al_de_referencia(self):
+        h, w, p = 200, 260, 64
+        preds, coords = [], []
+        rng = np.random.RandomState(5)
+        for y in calcular_inicios(h, p, 32):
+            for x in calcular_inicios(w, p, 32):
+                preds.append(rng.rand(p, p).astype(np.float32))
+                coords.append((int(y), int(x)))
+        suma, cuenta = np.zeros((h, w)), np.zeros((h, w))
+        for (y, x), pred in zip(coords, preds):
+            suma[y:y + p, x:x + p] += pred
+            cuenta[y:y + p, x:x + p] += 1
+
+        acumulador = AcumuladorMosaico(h, w, p)
+        acumulador.agregar_lote(np.stack(preds), coords)
+        np.testing.assert_allclose(acumulador.finalizar(), suma / cuenta, rtol=0, atol=1e-6)
+
+    def test_ventanas_reconstruyen_un_mapa_exacto(self):
+        h, w, p = 180, 300, 64
+        mapa = np.random.RandomState(6).rand(h, w).astype(np.float32)
+        for ventana in ("plana", "coseno", "gauss"):
+            with self.subTest(ventana=ventana):
+                acumulador = AcumuladorMosaico(h, w, p, ventana)
+                for y in calcular_inicios(h, p, 32):
+                    for x in calcular_inicios(w, p, 32):
+                        acumulador.agregar(mapa[y:y + p, x:x + p], y, x)
+                np.testing.assert_allclose(acumulador.finalizar(), mapa, rtol=0, atol=1e-5)
+
+    def test_pixeles_sin_cobertura_quedan_en_cero(self):
+        acumulador = AcumuladorMosaico(100, 100, 32)
+        acumulador.agregar(np.full((32, 32), 0.7, dtype=np.float32), 0, 0)
+        resultado = acumulador.finalizar()
+        self.assertAlmostEqual(float(resultado[10, 10]), 0.7, places=6)
+        self.assertEqual(float(resultado[50:, 50:].max()), 0.0)
@@ -0,0 +1,478 @@
+"""
+Ejecución de trabajos de `Prediccion` con un pool fijo de workers.
+
+Los pedidos se encolan en una cola acotada (`PREDICCION_COLA_MAX`) y los
+procesan `PREDICCION_WORKERS` hilos. El estado de cada trabajo se guarda en
+`Prediccion.status` (queued -> running -> done / error), así que al reiniciar
+el proceso los trabajos pendientes se vuelven a encolar. Cada proceso renueva
+`heartbeat_at` de sus trabajos running cada `PREDICCION_LATIDO_SEGUNDOS`; la
+recuperación solo reencola los running con el latido vencido, no los que está
+corriendo otro proceso vivo. Un trabajo cancelado (status 'cancelled') se
+corta en el próximo aviso de progreso.
+
+Con `PREDICCION_BACKEND = "procesos"` cada hilo delega el trabajo en su propio
+proceso de inferencia (modelos/procesos.py); si ese proceso se cae, el trabajo
+vuelve al frente de la cola hasta `PREDICCION_PROCESOS_REINTENTOS` veces.
+
+Las hijas de un lote que están seguidas al frente de la cola las toma un mismo
+worker, hasta `PREDICCION_LOTE_PARALELAS` a la vez, y las corre en paralelo con
+el modelo cargado una sola vez: el motor (modelos/motor.py) junta los patches
+de todas esas imágenes en llamadas completas al modelo.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.utils import timezone
+
+from albertidl.metrics import PicoRSS
+from capa_nitrurada.testing_model import PrediccionCancelada, procesar_prediccion
+from .metricas import etapa_segundos, procesos_reinicios_total, registrar_tiempos, rss_pico_bytes, trabajos_total
+from .models import Prediccion
+from .motor import reservar_sesiones, sesion_motor
+from .procesos import ProcesoCaido, ProcesoInferencia
+from .progreso import canal_progreso, publicador
+from .registro import registro
+
+logger = logging.getLogger(__name__)
+
+
+class ColaLlena(Exception):
+    """La cola de predicciones alcanzó su profundidad máxima."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Cola de predicciones llena, reintentar en {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Trabajo:
+    """
+    `imagen` es el array uint8 ya decodificado al recibir el upload; los
+    trabajos recuperados tras un reinicio, las imágenes que se procesan por
+    bandas y las que no entran en `max_bytes_imagenes` de la cola no lo tienen
+    y leen `input_path`. `lote` es el id del lote de las hijas.
+    """
+    __slots__ = (
+        "prediccion_id", "model_file", "input_path", "request", "imagen", "encolado", "reintentos", "lote",
+    )
+
+    def __init__(self, prediccion_id, model_file, input_path, request=None, imagen=None, lote=None):
+        self.prediccion_id = prediccion_id
+        self.lote = lote
+        self.model_file = model_file
+        self.input_path = input_path
+        self.request = request
+        self.imagen = imagen
+        self.encolado = time.monotonic()
+        self.reintentos = 0
+
+
+def ruta_media(url):
+    """Ruta en disco de un archivo publicado bajo MEDIA_URL."""
+    nombre = url.split(settings.MEDIA_URL, 1)[-1]
+    return os.path.join(settings.MEDIA_ROOT, nombre)
+
+
+def forzar_https(url):
+    if url.startswith('http://'):
+        url = url.replace('http://', 'https://', 1)
+    return url
+
+
+class EjecutorPredicciones:
+    def __init__(
+        self, workers=2, profundidad=16, backend="hilos", procesos=None, latido=30.0, max_bytes_imagenes=None,
+        lote_paralelas=1,
+    ):
+        self.workers = workers
+        # Hijas de un mismo lote que un worker corre juntas (ver `_tomar`)
+        self.lote_paralelas = lote_paralelas
+        # Tope de los arrays decodificados que retienen los trabajos en cola
+        self.max_bytes_imagenes = max_bytes_imagenes
+        self.bytes_imagenes = 0
+        self.latido = latido
+        self.profundidad = profundidad
+        self.backend = backend
+        # kwargs de ProcesoInferencia (hilos_intra, hilos_inter, max_rss, reintentos)
+        self.opciones_procesos = dict(procesos or {})
+        self.reintentos = self.opciones_procesos.pop("reintentos", 1)
+        self._cola = deque()
+        self._cond = threading.Condition()
+        self._hilos = []
+        self._local = threading.local()
+        self.procesos = []
+        self.en_curso = 0
+        # Lugares de la cola apartados por lotes que todavía se están creando
+        self._reservados = 0
+        # Predicciones running en este proceso, cuyo latido renueva `_latir`
+        self._corriendo = set()
+        # Promedio móvil de la duración de un trabajo, para estimar Retry-After
+        self.duracion_media = 30.0
+
+    @property
+    def iniciado(self):
+        return bool(self._hilos)
+
+    def iniciar(self, recuperar=True):
+        with self._cond:
+            if self._hilos:
+                return
+            for i in range(self.workers):
+                hilo = threading.Thread(target=self._worker, args=(i,), name=f"prediccion-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+            threading.Thread(target=self._latir, name="prediccion-latido", daemon=True).start()
+        if recuperar:
+            try:
+                self.recuperar_pendientes()
+            except Exception:
+                logger.exception("No se pudieron recuperar las predicciones pendientes")
+
+    def pendientes(self):
+        with self._cond:
+            return len(self._cola)
+
+    def retry_after(self):
+        """Segundos estimados hasta que se libere un lugar en la cola."""
+        return max(1, math.ceil(self.duracion_media / self.workers))
+
+    def verificar_capacidad(self, cantidad=1):
+        """Lanza ColaLlena si `cantidad` trabajos nuevos no entrarían en la cola."""
+        with self._cond:
+            if len(self._cola) + self._reservados + cantidad > self.profundidad:
+                raise ColaLlena(self.retry_after())
+
+    @contextmanager
+    def reservar(self, cantidad):
+        """
+        Reserva `cantidad` lugares de la cola mientras dura el bloque, para
+        encolar con `forzar` los trabajos de un lote sin pasarse de la
+        profundidad. Lanza ColaLlena si no entran todos.
+        """
+        with self._cond:
+            if len(self._cola) + self._reservados + cantidad > self.profundidad:
+                raise ColaLlena(self.retry_after())
+            self._reservados += cantidad
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._reservados -= cantidad
+
+    def encolar(self, trabajo, forzar=False):
+        """
+        Encola un trabajo. `forzar` ignora la profundidad (trabajos recuperados
+        o con un lugar ya reservado).
+        """
+        if not self._hilos:
+            self.iniciar(recuperar=False)
+        with self._cond:
+            if not forzar and len(self._cola) + self._reservados >= self.profundidad:
+                raise ColaLlena(self.retry_after())
+            self._agregar(trabajo)
+            self._cond.notify()
+
+    def encolar_lote(self, trabajos):
+        """
+        Encola juntas las hijas de un lote, con sus lugares ya reservados: un
+        worker no toma la primera antes de que estén las demás.
+        """
+        if not self._hilos:
+            self.iniciar(recuperar=False)
+        with self._cond:
+            for trabajo in trabajos:
+                self._agregar(trabajo)
+            self._cond.notify_all()
+
+    def _agregar(self, trabajo):
+        if trabajo.imagen is not None:
+            if (
+                self.max_bytes_imagenes is not None
+                and self.bytes_imagenes + trabajo.imagen.nbytes > self.max_bytes_imagenes
+            ):
+                # El archivo ya está publicado: el worker lo vuelve a decodificar
+                trabajo.imagen = None
+            else:
+                self.bytes_imagenes += trabajo.imagen.nbytes
+        self._cola.append(trabajo)
+
+    def recuperar_pendientes(self):
+        """
+        Vuelve a encolar las predicciones que quedaron en queued y las running
+        sin latido en los últimos tres intervalos. Un trabajo en queued que ya
+        está en la cola de otro proceso lo toma solo uno de los dos (ver `ejecutar`).
+        """
+        vencido = timezone.now() - timedelta(seconds=3 * self.latido)
+        pendientes = (
+            Prediccion.objects.filter(status__in=['queued', 'running'])
+            .select_related('ia_model').order_by('created_at')
+        )
+        recuperadas = 0
+        for pred in pendientes:
+            if pred.status == 'running':
+                if pred.heartbeat_at is not None and pred.heartbeat_at >= vencido:
+                    continue
+                if not Prediccion.objects.filter(id=pred.id, status='running', heartbeat_at=pred.heartbeat_at).update(
+                    status='queued', queued_at=timezone.now(), started_at=None, heartbeat_at=None,
+                ):
+                    continue
+            self.encolar(
+                Trabajo(pred.id, pred.ia_model.model_file, ruta_media(pred.input_image), lote=pred.lote_id),
+                forzar=True,
+            )
+            recuperadas += 1
+        if recuperadas:
+            logger.info("Se recuperaron %d predicciones pendientes", recuperadas)
+        return recuperadas
+
+    def _latir(self):
+        while True:
+            time.sleep(self.latido)
+            with self._cond:
+                ids = list(self._corriendo)
+            if not ids:
+                continue
+            try:
+                Prediccion.objects.filter(id__in=ids, status='running').update(heartbeat_at=timezone.now())
+            except DatabaseError:
+                logger.warning("No se pudo renovar el latido de %d predicciones", len(ids), exc_info=True)
+            finally:
+                close_old_connections()
+
+    def _worker(self, indice=0):
+        if self.backend == "procesos":
+            proceso = ProcesoInferencia(f"inferencia-{indice}", **self.opciones_procesos)
+            proceso.iniciar()
+            self._local.proceso = proceso
+            self.procesos.append(proceso)
+        while True:
+            with self._cond:
+                while not self._cola:
+                    self._cond.wait()
+                trabajos = self._tomar()
+                self.en_curso += len(trabajos)
+            inicio = time.monotonic()
+            # Cada trabajo usa su propia conexión, como un request: no queda
+            # abierta (ni rota tras un error) mientras el hilo espera en la cola
+            close_old_connections()
+            try:
+                if len(trabajos) == 1:
+                    self.ejecutar(trabajos[0])
+                else:
+                    self._ejecutar_juntos(trabajos)
+            finally:
+                close_old_connections()
+                with self._cond:
+                    self.en_curso -= len(trabajos)
+                    duracion = (time.monotonic() - inicio) / len(trabajos)
+                    self.duracion_media = 0.8 * self.duracion_media + 0.2 * duracion
+
+    def _tomar(self):
+        """
+        Saca de la cola el próximo trabajo y, si es hija de un lote, las hijas
+        del mismo lote que le siguen (hasta `lote_paralelas`). Solo con el
+        backend de hilos y el micro-batching activo, que es donde el motor
+        junta sus patches. Se llama con `_cond` tomado.
+        """
+        trabajos = [self._cola.popleft()]
+        lote = trabajos[0].lote
+        if lote is not None and self.backend == "hilos" and getattr(settings, 'PREDICCION_MICROBATCH', True):
+            while self._cola and self._cola[0].lote == lote and len(trabajos) < self.lote_paralelas:
+                trabajos.append(self._cola.popleft())
+        for trabajo in trabajos:
+            if trabajo.imagen is not None:
+                self.bytes_imagenes -= trabajo.imagen.nbytes
+        return trabajos
+
+    def _ejecutar_juntos(self, trabajos):
+        """
+        Corre en paralelo hijas de un lote del mismo modelo. El modelo queda
+        fijado en el registro y cada hija tiene una sesión del motor reservada
+        desde antes de empezar, así el motor espera los patches de todas y
+        arma llamadas completas con patches de varias imágenes en vez de
+        despachar el lote de la primera que llega.
+        """
+        model_file = trabajos[0].model_file
+        with self._usar_modelo(model_file) as model:
+            # Sin modelo no hay sesiones que reservar: cada hija falla sola
+            soltar = reservar_sesiones(model_file, model, len(trabajos)) if model is not None else []
+
+            def correr(trabajo, soltar_reserva):
+                self._local.soltar_reserva = soltar_reserva
+                close_old_connections()
+                try:
+                    self.ejecutar(trabajo)
+                finally:
+                    # Una hija cancelada o tomada por otro worker no abrió su sesión
+                    if soltar_reserva is not None:
+                        soltar_reserva()
+                    close_old_connections()
+
+            hilos = [
+                threading.Thread(
+                    target=correr, args=(trabajo, soltar[i] if soltar else None),
+                    name=f"{threading.current_thread().name}-{i}", daemon=True,
+                )
+                for i, trabajo in enumerate(trabajos)
+            ]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+
+    def ejecutar(self, trabajo):
+        # Solo un worker puede tomar el trabajo (evita duplicados al recuperar)
+        tomado = Prediccion.objects.filter(id=trabajo.prediccion_id, status='queued').update(
+            status='running', started_at=timezone.now(), heartbeat_at=timezone.now(),
+        )
+        if not tomado:
+            return
+        with self._cond:
+            self._corriendo.add(trabajo.prediccion_id)
+        inicio = time.monotonic()
+        etapa_segundos.observar(inicio - trabajo.encolado, 'cola')
+        canal_progreso.publicar(trabajo.prediccion_id, status='running')
+        estado = 'error'
+        proceso = getattr(self._local, 'proceso', None)
+        try:
+            with PicoRSS() as memoria:
+                estado = self._procesar(trabajo, proceso)
+        except ProcesoCaido as e:
+            procesos_reinicios_total.inc()
+            estado = self._reencolar(trabajo, e)
+        except PrediccionCancelada:
+            logger.info("Predicción %s cancelada", trabajo.prediccion_id)
+            estado = 'cancelled'
+            canal_progreso.publicar(trabajo.prediccion_id, status='cancelled')
+        except Exception:
+            logger.exception("Error procesando predicción %s", trabajo.prediccion_id)
+            Prediccion.objects.filter(id=trabajo.prediccion_id, status='running').update(
+                status='error', finished_at=timezone.now(),
+            )
+            canal_progreso.publicar(trabajo.prediccion_id, status='error')
+        finally:
+            with self._cond:
+                self._corriendo.discard(trabajo.prediccion_id)
+            etapa_segundos.observar(time.monotonic() - inicio, 'total')
+            trabajos_total.inc(estado)
+            # Con procesos, el pico de RSS lo informa el hijo con el evento "memoria"
+            if proceso is None and memoria.pico is not None:
+                rss_pico_bytes.observar(memoria.pico)
+
+    def _reencolar(self, trabajo, error):
+        """Vuelve a poner al frente de la cola un trabajo cuyo proceso se cayó."""
+        trabajo.reintentos += 1
+        if trabajo.reintentos > self.reintentos:
+            logger.error("Predicción %s: %s, sin más reintentos", trabajo.prediccion_id, error)
+            Prediccion.objects.filter(id=trabajo.prediccion_id, status='running').update(
+                status='error', finished_at=timezone.now(),
+            )
+            canal_progreso.publicar(trabajo.prediccion_id, status='error')
+            return 'error'
+        logger.warning("Predicción %s: %s, se vuelve a encolar", trabajo.prediccion_id, error)
+        if not Prediccion.objects.filter(id=trabajo.prediccion_id, status='running').update(
+            status='queued', queued_at=timezone.now(), started_at=None,
+        ):
+            return 'cancelled'
+        canal_progreso.publicar(trabajo.prediccion_id, status='queued')
+        # La imagen ya está publicada en disco: el reintento la lee de input_path
+        trabajo.imagen = None
+        trabajo.encolado = time.monotonic()
+        with self._cond:
+            self._cola.appendleft(trabajo)
+            self._cond.notify()
+        return 'reencolado'
+
+    def _procesar(self, trabajo, proceso=None):
+        extras = {}
+        progreso = publicador(trabajo.prediccion_id)
+
+        def notificar(evento, **datos):
+            if evento == 'mapa':
+                extras['output_map'] = forzar_https(datos['url'])
+            elif evento == 'progreso':
+                progreso.progreso(**datos)
+            elif evento == 'previa':
+                url = forzar_https(datos['url'])
+                extras['preview_image'] = url
+                progreso.verificar()
+                Prediccion.objects.filter(id=trabajo.prediccion_id).update(preview_image=url)
+                canal_progreso.publicar(trabajo.prediccion_id, preview_image=url)
+            elif evento == 'tiempos':
+                extras['inference_ms'] = int(datos['etapas'].get('inferencia', 0) * 1000)
+                extras['skipped_patches'] = datos.get('omitidos', 0)
+                registrar_tiempos(datos['etapas'], datos['patches'], datos.get('omitidos', 0))
+            elif evento == 'carga_modelo':
+                etapa_segundos.observar(datos['segundos'], 'carga_modelo')
+            elif evento == 'memoria':
+                rss_pico_bytes.observar(datos['pico'])
+
+        opciones = {
+            'batch_size': getattr(settings, 'PREDICCION_BATCH_SIZE', None),
+            'formato_mapa': getattr(settings, 'PREDICCION_FORMATO_MAPA', None),
+            'ventana': getattr(settings, 'PREDICCION_VENTANA', 'plana'),
+            'filtro': getattr(settings, 'PREDICCION_FILTRO_PATCHES', {}).get(trabajo.model_file),
+            'vista_previa': getattr(settings, 'PREDICCION_VISTA_PREVIA', None),
+        }
+        entrada = trabajo.imagen if trabajo.imagen is not None else trabajo.input_path
+        trabajo.imagen = None
+        try:
+            if proceso is not None:
+                output_url = proceso.ejecutar(trabajo.model_file, entrada, trabajo.request, opciones, notificar)
+            else:
+                output_url = self._procesar_local(trabajo.model_file, entrada, trabajo.request, opciones, notificar)
+        finally:
+            progreso.cerrar()
+        extras['output_image'] = forzar_https(output_url)
+        # Si se canceló mientras terminaba, queda cancelada
+        if not Prediccion.objects.filter(id=trabajo.prediccion_id, status='running').update(
+            status='done', finished_at=timezone.now(), **progreso.ultimo, **extras
+        ):
+            raise PrediccionCancelada()
+        canal_progreso.publicar(trabajo.prediccion_id, status='done', **extras)
+        return 'done'
+
+    def _procesar_local(self, model_file, entrada, request, opciones, notificar):
+        inicio = time.monotonic()
+        # Fijado en el registro mientras dura la predicción: no se desaloja en uso
+        with self._usar_modelo(model_file) as model:
+            notificar('carga_modelo', segundos=time.monotonic() - inicio)
+            if model is None:
+                raise FileNotFoundError(f"El modelo '{model_file}.h5' no existe.")
+
+            opciones = dict(opciones, notificar=notificar)
+            if getattr(settings, 'PREDICCION_MICROBATCH', True):
+                # Los lotes de trabajos concurrentes del mismo modelo se juntan en el motor
+                with sesion_motor(model_file, model) as motor:
+                    # Hija de un lote que corre junto a otras: su sesión reemplaza a la reservada
+                    soltar_reserva = getattr(self._local, 'soltar_reserva', None)
+                    if soltar_reserva is not None:
+                        soltar_reserva()
+                    return procesar_prediccion(entrada, motor, request, **opciones)
+            return procesar_prediccion(entrada, model, request, **opciones)
+
+    def _usar_modelo(self, model_file):
+        return registro.usar(model_file)
+
+
+ejecutor = EjecutorPredicciones(
+    workers=getattr(settings, 'PREDICCION_WORKERS', 2),
+    profundidad=getattr(settings, 'PREDICCION_COLA_MAX', 16),
+    backend=getattr(settings, 'PREDICCION_BACKEND', 'hilos'),
+    latido=getattr(settings, 'PREDICCION_LATIDO_SEGUNDOS', 30.0),
+    max_bytes_imagenes=getattr(settings, 'PREDICCION_COLA_MAX_BYTES_IMAGENES', 512 * 1024 * 1024),
+    lote_paralelas=getattr(settings, 'PREDICCION_LOTE_PARALELAS', 4),
+    procesos={
+        'hilos_intra': getattr(settings, 'PREDICCION_PROCESOS_HILOS_INTRA', None),
+        'hilos_inter': getattr(settings, 'PREDICCION_PROCESOS_HILOS_INTER', None),
+        'max_rss': getattr(settings, 'PREDICCION_PROCESOS_MAX_RSS', None),
+        'reintentos': getattr(settings, 'PREDICCION_PROCESOS_REINTENTOS', 1),
+    },
+)
@@ -1,10 +1,21 @@
 from django.urls import path
-from .views import ModelListCreateView, ModelDetailView, IA_ModelDetailView, PrediccionStatusView
+from .views import (
+    ModelListCreateView, ModelDetailView, IA_ModelDetailView, PrediccionStatusView,
+    PrediccionEventosView, PrediccionEsperarView, PrediccionListView, PrediccionCancelarView,
+    LotePrediccionView, LoteEstadoView, LoteCancelarView,
+)
 
 urlpatterns = [
     path('', ModelListCreateView.as_view(), name='blog_list_create'),
     path('<int:pk>/', ModelDetailView.as_view(), name='blog_detail'),
     path('predict/<int:pk>/', IA_ModelDetailView.as_view(), name='model-detail'),
+    path('predict/<int:pk>/lote/', LotePrediccionView.as_view(), name='lote_create'),
+    path('lotes/<int:lote_id>/', LoteEstadoView.as_view(), name='lote_estado'),
+    path('lotes/<int:lote_id>/cancelar/', LoteCancelarView.as_view(), name='lote_cancelar'),
+    path('predicciones/', PrediccionListView.as_view(), name='prediccion_list'),
     path('predicciones/<int:prediccion_id>/', PrediccionStatusView.as_view(), name='prediccion_status'),
+    path('predicciones/<int:prediccion_id>/eventos/', PrediccionEventosView.as_view(), name='prediccion_eventos'),
+    path('predicciones/<int:prediccion_id>/esperar/', PrediccionEsperarView.as_view(), name='prediccion_esperar'),
+    path('predicciones/<int:prediccion_id>/cancelar/', PrediccionCancelarView.as_view(), name='prediccion_cancelar'),
 
 ] 
\ No newline at end of file
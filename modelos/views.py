@@ -1,32 +1,70 @@
 from django.shortcuts import render
 from rest_framework import generics
-from .models import IA_Model, Prediccion
-from .serializers import IA_ModelSerializer
-import os
+from .models import IA_Model, LotePrediccion, Prediccion
+from .serializers import IA_ModelSerializer, PrediccionSerializer
 from django.conf import settings
+from django.db import transaction
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.views import APIView
-from capa_nitrurada.testing_model import procesar_prediccion
-import matplotlib.pyplot as plt
-import numpy as np
-from tensorflow.keras.models import load_model
-from capa_nitrurada.testing_model import shape_aware_loss, iou_metric
-import tensorflow as tf
-import threading
-import os
-
-# global para cachear modelos
-loaded_models = {}
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.views import View
+from albertidl.cache import cachear_respuesta
+from albertidl.metrics import medir
+from .cache import cache_resultados
+from .metricas import etapa_segundos
+from .ingesta import (
+    IngestaUploadHandler, ImagenInvalida, decodificar, es_zip, extraer_zip, max_bytes, max_imagenes_lote, publicar,
+)
+from .progreso import TERMINALES, cambios_estado, canal_progreso, leer_estado
+from .registro import ruta_servida, version_modelo
+from .retencion import accesos
+from .trabajos import ejecutor, ColaLlena, Trabajo
+
+class CacheVencido(Exception):
+    """La retención expiró un resultado del caché entre la búsqueda y la copia."""
+
+
+def copiar_de_cache(anterior, ia_model, **campos):
+    """
+    Nueva predicción terminada que reusa las salidas de `anterior`, o None si
+    la retención la expiró mientras tanto. La verificación y el INSERT van en
+    una transacción, igual que la expiración y el borrado de archivos en
+    modelos/retencion.py: o la retención ve la copia como referencia viva, o
+    la copia ve la expiración.
+    """
+    with transaction.atomic():
+        if not Prediccion.objects.select_for_update().filter(id=anterior.id, status='done').exists():
+            return None
+        return Prediccion.objects.create(
+            ia_model=ia_model,
+            input_image=anterior.input_image,
+            output_image=anterior.output_image,
+            output_map=anterior.output_map,
+            status='done',
+            finished_at=timezone.now(),
+            input_hash=anterior.input_hash,
+            model_version=anterior.model_version,
+            **campos,
+        )
 
 # Lista todos los blogs o crea uno nuevo
+@method_decorator(cachear_respuesta('modelos'), name='dispatch')
 class ModelListCreateView(generics.ListCreateAPIView):
     queryset = IA_Model.objects.all()
     serializer_class = IA_ModelSerializer
 
 # Devuelve, actualiza o borra un IA_Model específico
+@method_decorator(cachear_respuesta('modelos'), name='dispatch')
 class ModelDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = IA_Model.objects.all()
     serializer_class = IA_ModelSerializer
@@ -34,6 +72,12 @@ class ModelDetailView(generics.RetrieveUpdateDestroyAPIView):
 class IA_ModelDetailView(APIView):
     parser_classes = [MultiPartParser, FormParser]
 
+    def initialize_request(self, request, *args, **kwargs):
+        # La imagen se hashea y escribe por chunks en MEDIA_ROOT mientras se recibe
+        if request.method == 'POST':
+            request.upload_handlers = [IngestaUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
     def get(self, request, pk, format=None):
         try:
             model = IA_Model.objects.get(pk=pk)
@@ -42,58 +86,89 @@ class IA_ModelDetailView(APIView):
         serializer = IA_ModelSerializer(model)
         return Response(serializer.data)
 
-    def get_model(self, model_file):
-        MODEL_PATH = os.path.join("capa_nitrurada", "modelos", f"{model_file}.h5")
-        if not os.path.exists(MODEL_PATH):
-            return None
-
-        # Solo aplicar memory growth si hay GPU
-        gpus = tf.config.list_physical_devices('GPU')
-        if gpus:
-            try:
-                for gpu in gpus:
-                    tf.config.experimental.set_memory_growth(gpu, True)
-            except RuntimeError as e:
-                print("⚠️ No se pudo setear memory growth:", e)
-
-        model = load_model(
-            MODEL_PATH,
-            custom_objects={"shape_aware_loss": shape_aware_loss, "iou_metric": iou_metric}
-        )
-        return model
-
     def post(self, request, pk, format=None):
         try:
             ia_model = IA_Model.objects.get(pk=pk)
         except IA_Model.DoesNotExist:
             return Response({'error': 'Modelo no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         
+        # El modelo se carga en el worker; acá solo se verifica que exista
         model_file = ia_model.model_file
-        model = self.get_model(model_file)
-        if model is None:
+        if ruta_servida(model_file) is None:
             return Response({"error": f"El modelo '{model_file}.h5' no existe."}, status=404)
 
-        image_file = request.FILES.get('image')
+        # El upload se recibe al acceder a request.FILES
+        with medir('upload', etapa_segundos, 'upload'):
+            image_file = request.FILES.get('image')
+        if getattr(request._request, 'upload_excedido', False):
+            return Response(
+                {'error': f'La imagen supera el máximo de {max_bytes()} bytes'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
         if not image_file:
             return Response({'error': 'No se envió imagen'}, status=status.HTTP_400_BAD_REQUEST)
 
-        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
-        input_path = os.path.join(settings.MEDIA_ROOT, image_file.name)
-        with open(input_path, 'wb+') as f:
-            for chunk in image_file.chunks():
-                f.write(chunk)
+        input_hash = image_file.sha256
+        model_version = version_modelo(model_file)
+        with cache_resultados.bloqueo(input_hash, model_version):
+            return self._crear_prediccion(request, ia_model, image_file, input_hash, model_version)
 
-        input_url = settings.MEDIA_URL + image_file.name
+    def _crear_prediccion(self, request, ia_model, image_file, input_hash, model_version):
+        # Mismo archivo + misma versión del modelo: reusar el resultado
+        if getattr(settings, 'PREDICCION_CACHE', True):
+            anterior = cache_resultados.buscar(input_hash, model_version)
+            prediccion = copiar_de_cache(anterior, ia_model) if anterior is not None else None
+            if prediccion is not None:
+                return Response({
+                    'message': 'Predicción obtenida del caché',
+                    'prediccion_id': prediccion.id,
+                    'input_image_url': prediccion.input_image,
+                    'cache': True,
+                }, status=200)
 
-        # Crear objeto Prediccion en estado pendiente
-        prediccion = Prediccion.objects.create(
-            ia_model=ia_model,
-            input_image=input_url,
-            status='pending'
-        )
+            # La misma imagen ya se está procesando: esperar ese trabajo
+            en_curso = cache_resultados.en_curso(input_hash, model_version)
+            if en_curso is not None:
+                return Response({
+                    'message': 'Predicción en proceso',
+                    'prediccion_id': en_curso.id,
+                    'input_image_url': en_curso.input_image,
+                    'deduplicada': True,
+                }, status=200)
+
+        try:
+            ejecutor.verificar_capacidad()
+        except ColaLlena as e:
+            return self._cola_llena(e)
 
-        # Iniciar procesamiento en segundo plano
-        threading.Thread(target=self._procesar_prediccion_async, args=(prediccion.id, model, input_path, request)).start()
+        # Validar antes de encolar: la imagen decodificada va directo al worker
+        try:
+            with medir('decodificacion', etapa_segundos, 'decodificacion'):
+                imagen, formato = decodificar(image_file.temporary_file_path())
+        except ImagenInvalida as e:
+            return Response({'error': str(e)}, status=e.status)
+        with medir('publicacion', etapa_segundos, 'publicacion'):
+            input_path, input_url = publicar(image_file, formato)
+
+        # Crear objeto Prediccion en cola
+        with transaction.atomic():
+            prediccion = Prediccion.objects.create(
+                ia_model=ia_model,
+                input_image=input_url,
+                status='queued',
+                queued_at=timezone.now(),
+                input_hash=input_hash,
+                model_version=model_version,
+            )
+            # Si la retención borró la entrada ya publicada antes del INSERT, se vuelve a publicar
+            publicar(image_file, formato)
+
+        # Encolar el procesamiento en el pool de workers
+        try:
+            ejecutor.encolar(Trabajo(prediccion.id, ia_model.model_file, input_path, request, imagen))
+        except ColaLlena as e:
+            prediccion.delete()
+            return self._cola_llena(e)
 
         # Responder de inmediato con ID
         return Response({
@@ -102,23 +177,12 @@ class IA_ModelDetailView(APIView):
             'input_image_url': input_url
         }, status=200)
 
-    def _procesar_prediccion_async(self, prediccion_id, model, input_path, request):
-        from django.db import transaction
-        try:
-            pred = Prediccion.objects.get(id=prediccion_id)
-            output_url = procesar_prediccion(input_path, model, request)
-            if output_url.startswith('http://'):
-                output_url = output_url.replace('http://', 'https://', 1)
-            
-            with transaction.atomic():
-                pred.output_image = output_url
-                pred.status = 'done'
-                pred.save()
-        except Exception as e:
-            print("❌ Error procesando predicción:", e)
-            pred = Prediccion.objects.get(id=prediccion_id)
-            pred.status = 'error'
-            pred.save()
+    def _cola_llena(self, error):
+        return Response(
+            {'error': 'Hay demasiadas predicciones en proceso, reintentá más tarde'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={'Retry-After': str(error.retry_after)},
+        )
 
 class PrediccionStatusView(APIView):
     def get(self, request, prediccion_id):
@@ -126,10 +190,379 @@ class PrediccionStatusView(APIView):
             pred = Prediccion.objects.get(id=prediccion_id)
         except Prediccion.DoesNotExist:
             return Response({'error': 'Predicción no encontrada'}, status=404)
+        accesos.anotar(pred.id)
 
         return Response({
             'id': pred.id,
             'status': pred.status,
             'input_image': pred.input_image,
-            'output_image': pred.output_image
+            'preview_image': pred.preview_image,
+            'output_image': pred.output_image,
+            'output_map': pred.output_map,
+            'stage': pred.stage,
+            'progress_done': pred.progress_done,
+            'progress_total': pred.progress_total,
+            'skipped_patches': pred.skipped_patches,
         })
+
+class PrediccionCancelarView(APIView):
+    """
+    Cancela una predicción en cola o en proceso. El worker la corta en su
+    próximo aviso de progreso; la vista previa ya publicada se conserva.
+    """
+    def post(self, request, prediccion_id):
+        cancelada = Prediccion.objects.filter(id=prediccion_id, status__in=['queued', 'running']).update(
+            status='cancelled', finished_at=timezone.now(),
+        )
+        if not cancelada:
+            pred = Prediccion.objects.filter(id=prediccion_id).values('status').first()
+            if pred is None:
+                return Response({'error': 'Predicción no encontrada'}, status=404)
+            return Response(
+                {'error': 'La predicción ya terminó', 'status': pred['status']}, status=status.HTTP_409_CONFLICT,
+            )
+        canal_progreso.publicar(prediccion_id, status='cancelled')
+        return Response({'id': prediccion_id, 'status': 'cancelled'})
+
+class LotePrediccionView(APIView):
+    """
+    Crea un lote de predicciones para un modelo: varias imágenes en `images`
+    (cada archivo puede ser también un ZIP de imágenes). Cada imagen es una
+    Prediccion hija; las que ya están en el caché se resuelven al instante.
+    El lote se acepta o rechaza entero.
+
+    Las hijas entran juntas a la cola y un worker las corre de a
+    PREDICCION_LOTE_PARALELAS con el modelo cargado una vez; el motor
+    (modelos/motor.py) empaqueta los patches de esas imágenes en llamadas
+    completas al modelo.
+    """
+    parser_classes = [MultiPartParser, FormParser]
+
+    def initialize_request(self, request, *args, **kwargs):
+        if request.method == 'POST':
+            request.upload_handlers = [IngestaUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
+    def post(self, request, pk, format=None):
+        try:
+            ia_model = IA_Model.objects.get(pk=pk)
+        except IA_Model.DoesNotExist:
+            return Response({'error': 'Modelo no encontrado'}, status=status.HTTP_404_NOT_FOUND)
+        model_file = ia_model.model_file
+        if ruta_servida(model_file) is None:
+            return Response({"error": f"El modelo '{model_file}.h5' no existe."}, status=404)
+
+        with medir('upload', etapa_segundos, 'upload'):
+            archivos = request.FILES.getlist('images')
+        if getattr(request._request, 'upload_excedido', False):
+            return Response(
+                {'error': f'Un archivo supera el máximo de {max_bytes()} bytes'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
+        if not archivos:
+            return Response({'error': 'No se enviaron imágenes'}, status=status.HTTP_400_BAD_REQUEST)
+
+        extraidos = []
+        try:
+            imagenes = []
+            for archivo in archivos:
+                if es_zip(archivo):
+                    contenido = extraer_zip(archivo, max_imagenes_lote() - len(imagenes))
+                    extraidos.extend(contenido)
+                    imagenes.extend(contenido)
+                else:
+                    imagenes.append(archivo)
+            if not imagenes:
+                return Response({'error': 'El lote no tiene imágenes'}, status=status.HTTP_400_BAD_REQUEST)
+            if len(imagenes) > max_imagenes_lote():
+                raise ImagenInvalida(f'El lote tiene más de {max_imagenes_lote()} imágenes', 413)
+
+            try:
+                try:
+                    return self._crear_lote(request, ia_model, imagenes)
+                except CacheVencido:
+                    # Ese resultado ya no está en el caché: el segundo intento lo procesa
+                    return self._crear_lote(request, ia_model, imagenes)
+            except ColaLlena as e:
+                return Response(
+                    {'error': 'Hay demasiadas predicciones en proceso, reintentá más tarde'},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={'Retry-After': str(e.retry_after)},
+                )
+        except ImagenInvalida as e:
+            return Response({'error': str(e)}, status=e.status)
+        finally:
+            for extraido in extraidos:
+                extraido.close()
+
+    def _crear_lote(self, request, ia_model, imagenes):
+        # Solo se valida el encabezado: los workers leen cada imagen del archivo,
+        # así un lote grande no queda decodificado en memoria mientras espera
+        entradas = []
+        for imagen in imagenes:
+            try:
+                with medir('decodificacion', etapa_segundos, 'decodificacion'):
+                    _, formato = decodificar(imagen.temporary_file_path(), pixeles=False)
+            except ImagenInvalida as e:
+                raise ImagenInvalida(f'{imagen.name}: {e}', e.status)
+            entradas.append((imagen, formato))
+
+        model_version = version_modelo(ia_model.model_file)
+        usar_cache = getattr(settings, 'PREDICCION_CACHE', True)
+        anteriores = [
+            cache_resultados.buscar(imagen.sha256, model_version) if usar_cache else None
+            for imagen, _ in entradas
+        ]
+        nuevas = anteriores.count(None)
+        if nuevas > ejecutor.profundidad:
+            raise ImagenInvalida(
+                f'El lote tiene {nuevas} imágenes para procesar y la cola admite {ejecutor.profundidad}', 413,
+            )
+
+        # Los lugares de la cola se reservan para todas las hijas antes de crear
+        # nada: el lote entra entero o se responde 503
+        with ejecutor.reservar(nuevas):
+            # Los archivos se publican fuera de la transacción, que solo inserta
+            # las filas: no se retiene el lock de escritura de SQLite copiando
+            publicadas = []
+            for (imagen, formato), anterior in zip(entradas, anteriores):
+                if anterior is None:
+                    with medir('publicacion', etapa_segundos, 'publicacion'):
+                        publicadas.append(publicar(imagen, formato))
+                else:
+                    publicadas.append(None)
+
+            pendientes = []
+            with transaction.atomic():
+                lote = LotePrediccion.objects.create(ia_model=ia_model, name=request.data.get('name', '')[:200])
+                for (imagen, _), anterior, publicada in zip(entradas, anteriores, publicadas):
+                    nombre = (imagen.name or '')[:255]
+                    if anterior is not None:
+                        if copiar_de_cache(anterior, ia_model, lote=lote, original_name=nombre) is None:
+                            raise CacheVencido()
+                        continue
+                    input_path, input_url = publicada
+                    prediccion = Prediccion.objects.create(
+                        ia_model=ia_model,
+                        lote=lote,
+                        original_name=nombre,
+                        input_image=input_url,
+                        status='queued',
+                        queued_at=timezone.now(),
+                        input_hash=imagen.sha256,
+                        model_version=model_version,
+                    )
+                    pendientes.append(
+                        Trabajo(prediccion.id, ia_model.model_file, input_path, request, lote=lote.id)
+                    )
+                    # Si la retención borró la entrada ya publicada antes del INSERT, se vuelve a publicar
+                    publicar(imagen, formato)
+
+            # Las hijas entran juntas y los workers las toman seguidas
+            ejecutor.encolar_lote(pendientes)
+
+        return Response({
+            'message': 'Lote en proceso',
+            'lote_id': lote.id,
+            'total': len(entradas),
+            'cache': len(entradas) - len(pendientes),
+            'predicciones': manifiesto_lote(lote),
+        }, status=200)
+
+def manifiesto_lote(lote):
+    return [
+        {
+            'prediccion_id': pred['id'],
+            'original_name': pred['original_name'],
+            'status': pred['status'],
+            'input_image': pred['input_image'],
+            'preview_image': pred['preview_image'],
+            'output_image': pred['output_image'],
+            'output_map': pred['output_map'],
+            'progress_done': pred['progress_done'],
+            'progress_total': pred['progress_total'],
+        }
+        for pred in lote.predicciones.order_by('id').values(
+            'id', 'original_name', 'status', 'input_image', 'preview_image', 'output_image', 'output_map',
+            'progress_done', 'progress_total',
+        )
+    ]
+
+def estado_lote(estados):
+    """queued si ninguna hija empezó, running mientras quede alguna sin terminar, si no done."""
+    if estados.get('queued', 0) + estados.get('running', 0) == 0:
+        return 'done'
+    if estados.get('queued', 0) == sum(estados.values()):
+        return 'queued'
+    return 'running'
+
+class LoteEstadoView(APIView):
+    """
+    Estado agregado de un lote y manifiesto de sus salidas. `status` es done
+    cuando todas las hijas terminaron, aunque alguna sea error o cancelled:
+    el detalle está en `estados` y en el manifiesto.
+    """
+    def get(self, request, lote_id):
+        lote = LotePrediccion.objects.filter(id=lote_id).first()
+        if lote is None:
+            return Response({'error': 'Lote no encontrado'}, status=404)
+
+        manifiesto = manifiesto_lote(lote)
+        accesos.anotar(*(pred['prediccion_id'] for pred in manifiesto))
+        estados = {}
+        for pred in manifiesto:
+            estados[pred['status']] = estados.get(pred['status'], 0) + 1
+        terminadas = sum(n for estado, n in estados.items() if estado in TERMINALES)
+        return Response({
+            'id': lote.id,
+            'ia_model': lote.ia_model_id,
+            'name': lote.name,
+            'created_at': lote.created_at,
+            'status': estado_lote(estados),
+            'total': len(manifiesto),
+            'terminadas': terminadas,
+            'estados': estados,
+            'progress_done': sum(pred['progress_done'] for pred in manifiesto),
+            'progress_total': sum(pred['progress_total'] for pred in manifiesto),
+            'predicciones': manifiesto,
+        })
+
+class LoteCancelarView(APIView):
+    """Cancela las predicciones del lote que siguen en cola o en proceso."""
+    def post(self, request, lote_id):
+        if not LotePrediccion.objects.filter(id=lote_id).exists():
+            return Response({'error': 'Lote no encontrado'}, status=404)
+        with transaction.atomic():
+            ids = list(
+                Prediccion.objects.select_for_update()
+                .filter(lote_id=lote_id, status__in=['queued', 'running']).values_list('id', flat=True)
+            )
+            Prediccion.objects.filter(id__in=ids, status__in=['queued', 'running']).update(
+                status='cancelled', finished_at=timezone.now(),
+            )
+        for prediccion_id in ids:
+            canal_progreso.publicar(prediccion_id, status='cancelled')
+        return Response({'id': lote_id, 'canceladas': len(ids)})
+
+class PrediccionCursorPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
+    page_size = getattr(settings, 'PREDICCION_LISTADO_PAGINA', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+class PrediccionListView(generics.ListAPIView):
+    """
+    Estado de muchas predicciones en una sola consulta, paginado por cursor.
+    Filtros: ?ids=1,2,3  ?ia_model=<pk>  ?lote=<id>  ?status=queued,running
+    ?desde=<ISO 8601>  ?hasta=<ISO 8601> (sobre created_at).
+    """
+    serializer_class = PrediccionSerializer
+    pagination_class = PrediccionCursorPagination
+    max_ids = 500
+
+    def get_queryset(self):
+        params = self.request.query_params
+        queryset = Prediccion.objects.all()
+
+        if params.get('ids'):
+            try:
+                ids = [int(valor) for valor in params['ids'].split(',') if valor]
+            except ValueError:
+                raise ValidationError({'ids': 'Lista de ids inválida'})
+            if len(ids) > self.max_ids:
+                raise ValidationError({'ids': f'Máximo {self.max_ids} ids por consulta'})
+            queryset = queryset.filter(id__in=ids)
+
+        if params.get('ia_model'):
+            if not params['ia_model'].isdigit():
+                raise ValidationError({'ia_model': 'Debe ser un id'})
+            queryset = queryset.filter(ia_model_id=int(params['ia_model']))
+
+        if params.get('lote'):
+            if not params['lote'].isdigit():
+                raise ValidationError({'lote': 'Debe ser un id'})
+            queryset = queryset.filter(lote_id=int(params['lote']))
+
+        if params.get('status'):
+            estados = params['status'].split(',')
+            validos = dict(Prediccion.STATUS_CHOICES)
+            if any(estado not in validos for estado in estados):
+                raise ValidationError({'status': f'Valores posibles: {", ".join(validos)}'})
+            queryset = queryset.filter(status__in=estados)
+
+        for param, lookup in (('desde', 'created_at__gte'), ('hasta', 'created_at__lt')):
+            if params.get(param):
+                fecha = parse_datetime(params[param])
+                if fecha is None:
+                    raise ValidationError({param: 'Fecha ISO 8601 inválida'})
+                if timezone.is_naive(fecha):
+                    fecha = timezone.make_aware(fecha)
+                queryset = queryset.filter(**{lookup: fecha})
+
+        return queryset
+
+    def paginate_queryset(self, queryset):
+        pagina = super().paginate_queryset(queryset)
+        if pagina is not None:
+            accesos.anotar(*(pred.id for pred in pagina))
+        return pagina
+
+# Vistas async: conviene servirlas con albertidl/asgi.py (uvicorn, daphne).
+# Con WSGI funcionan, pero cada conexión abierta ocupa un hilo del servidor.
+class PrediccionEventosView(View):
+    """
+    Server-Sent Events con el avance de una predicción: un evento `progreso`
+    por cada cambio y un evento `fin` con las URLs de salida al terminar.
+    El `id` de cada evento es la versión del estado, así al reconectar con
+    Last-Event-ID solo se envían cambios nuevos.
+    """
+
+    async def get(self, request, prediccion_id):
+        if await leer_estado(prediccion_id) is None:
+            return JsonResponse({'error': 'Predicción no encontrada'}, status=404)
+        accesos.anotar(prediccion_id)
+
+        async def eventos():
+            yield "retry: 2000\n\n"
+            async for estado, version in cambios_estado(
+                prediccion_id, request.headers.get('Last-Event-ID'),
+                limite=getattr(settings, 'PREDICCION_SSE_MAX_SEGUNDOS', 300),
+            ):
+                if estado is None:
+                    yield ": ping\n\n"
+                    continue
+                tipo = 'fin' if estado['status'] in TERMINALES else 'progreso'
+                datos = json.dumps(estado, cls=DjangoJSONEncoder)
+                yield f"id: {version}\nevent: {tipo}\ndata: {datos}\n\n"
+
+        response = StreamingHttpResponse(eventos(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # que nginx no acumule los eventos
+        return response
+
+class PrediccionEsperarView(View):
+    """
+    Long-poll: responde en cuanto el estado difiere de la versión enviada en
+    If-None-Match (o enseguida si no se envía), o 304 si pasan `timeout`
+    segundos sin cambios. La versión nueva vuelve en el ETag.
+    """
+
+    async def get(self, request, prediccion_id):
+        if await leer_estado(prediccion_id) is None:
+            return JsonResponse({'error': 'Predicción no encontrada'}, status=404)
+        accesos.anotar(prediccion_id)
+        version = request.headers.get('If-None-Match', '').strip('"') or None
+        maximo = getattr(settings, 'PREDICCION_LONGPOLL_MAX_SEGUNDOS', 30)
+        try:
+            timeout = min(float(request.GET.get('timeout', maximo)), maximo)
+        except ValueError:
+            return JsonResponse({'error': 'timeout inválido'}, status=400)
+
+        async for estado, actual in cambios_estado(prediccion_id, version, limite=timeout):
+            if estado is not None:
+                response = JsonResponse(estado, encoder=DjangoJSONEncoder)
+                response['ETag'] = f'"{actual}"'
+                return response
+        response = HttpResponse(status=304)
+        response['ETag'] = f'"{version}"'
+        return response